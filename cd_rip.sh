@@ -1,2 +1,9 @@
 #!/usr/bin/env sh
-python3 -m rip_lib
+# Hand the job to the rip daemon if it is running (python3 -m rip_lib
+# --daemon), else rip here and now
+python3 -m rip_lib.client "$@"
+status=$?
+if [ $status -eq 3 ]; then
+    exec python3 -m rip_lib "$@"
+fi
+exit $status
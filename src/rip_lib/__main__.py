@@ -13,6 +13,14 @@ import argparse
 
 import rip_lib.main as rip
 import rip_lib.discover as discover
+import rip_lib.retag as retag
+import rip_lib.verify as verify
+import rip_lib.daemon as daemon
+import rip_lib.distribute as distribute
+import rip_lib.priority as priority
+import rip_lib.rank as rank
+import rip_lib.session as session
+import rip_lib.sync as sync
 
 def config_logging(logfile="log.txt"):
     if os.path.exists(logfile):
@@ -43,9 +51,83 @@ if __name__ == "__main__":
             default=False, help='Only convert flac to OGGs and MP3')
     parser.add_argument('--discover-flacs', action='store_const', const=True,
             default=False, help='Look for flacs to convert')
+    parser.add_argument('--retag', action='store_const', const=True,
+            default=False, help='Refresh the metadata and fix the tags '
+            'of already converted albums')
+    parser.add_argument('--48k', dest='do48k', action='store_const',
+            const=True, default=False, help='Use 48K sample rate without '
+            'asking')
+    parser.add_argument('--ogg', action='store_const', const=True,
+            default=False, help='Convert to OGG without asking')
+    parser.add_argument('--mp3', action='store_const', const=True,
+            default=False, help='Convert to MP3 without asking')
+    parser.add_argument('--album-ogg', action='store_const', const=True,
+            default=False, help='Also join the track OGGs into one '
+            'gapless album OGG')
+    parser.add_argument('--session', action='store_const', const=True,
+            default=False, help='Rip disc after disc, each is ejected once '
+            'read and converted while the next is read')
+    parser.add_argument('--daemon', action='store_const', const=True,
+            default=False, help='Run as a daemon taking jobs from '
+            'rip_lib.client (see cd_rip.sh)')
+    parser.add_argument('--coordinate', action='store_const', const=True,
+            default=False, help='Hand the conversion of the albums found '
+            'in the working directory to --worker processes')
+    parser.add_argument('--port', type=int, default=distribute.DEF_PORT,
+            help='TCP port the coordinator listens on')
+    parser.add_argument('--worker', default=None, metavar='HOST[:PORT]',
+            help='Convert albums for the coordinator at HOST')
+    parser.add_argument('--verify', action='store_const', const=True,
+            default=False, help='Check the archived albums in the library '
+            '(or working directory) for corruption')
+    parser.add_argument('--plan', action='store_const', const=True,
+            default=False, help='Only print how long the rip or conversion '
+            'of each album would take and the disk it needs, from the '
+            'speeds measured in earlier runs')
+    parser.add_argument('--sync', default=None, metavar='TARGET',
+            help='Copy the converted tracks (--mp3 and/or --ogg, default '
+            'MP3) in the library or working directory to TARGET, only '
+            'what changed since the last sync is written')
+    parser.add_argument('--jobs', type=int, default=None,
+            help='Files checked or synced at the same time (default is '
+            'one per CPU)')
+    parser.add_argument('--bwlimit', type=float, default=None,
+            help='Limit the I/O of --verify or --sync to this many MB/s')
+    parser.add_argument('--library', default=None,
+            help='Library of archived albums, a disc already in it is '
+            'not ripped again')
+    parser.add_argument('--scratch', default=None,
+            help='Directory for intermediate files (default is tmpfs '
+            'if there is room, else the working directory)')
+    parser.add_argument('--scratch-budget', type=int, default=2048,
+            help='Space in MB that intermediate files may use')
+    parser.add_argument('--cpu-quota', type=int, default=None,
+            metavar='PERCENT', help='Cap the CPU used by all the encoders '
+            'together, 100 is one core (needs systemd)')
+    parser.add_argument('--country', default=None, metavar='CC[,CC...]',
+            help='Preferred release countries when a disc matches several '
+            'releases, best first (e.g. GB,XE)')
+    parser.add_argument('--latest', action='store_const', const=True,
+            default=False, help='Prefer the latest of matching releases, '
+            'not the earliest')
+    parser.add_argument('--no-ask', action='store_const', const=True,
+            default=False, help='Never ask which release a disc is, take '
+            'the best match')
+    parser.add_argument('--tracks', type=rip.parse_tracks, default=None,
+            metavar='N[-M][,...]', help='Only read these tracks (e.g. 2,5-7), '
+            'a later rip of the disc reads just the tracks missing')
     parser.add_argument('wdir', nargs='?',
             help='Working directory', default=os.getcwd())
     args = parser.parse_args()
+    args.answers = dict([(name, True) for name, given in
+        (("48k", args.do48k), ("ogg", args.ogg), ("mp3", args.mp3))
+        if given])
+    if args.cpu_quota:
+        priority.set_cpu_quota(args.cpu_quota)
+    rank.set_preferences(args.country.split(",") if args.country else None,
+        args.latest)
+    if args.no_ask:
+        rank.set_interactive(False)
     dont = False
     directories = [args.wdir]
     if args.only_rip:
@@ -55,12 +137,53 @@ if __name__ == "__main__":
         if args.discover_flacs:
             print("Cannot both only-rip and discover-flacs")
             dont = True
+        if args.retag:
+            print("Cannot both only-rip and retag")
+            dont = True
     elif args.discover_flacs:
-        if not args.only_convert:
+        if not (args.only_convert or args.retag):
             print("Cannot both discover FLACs and RIP")
             dont = True
         directories = discover.find_directories(args.wdir)
 
-    if not dont:
-        for src_dir in directories:
-            rip.main(args, src_dir)
+    if args.verify and (args.only_rip or args.only_convert or args.retag):
+        print("Cannot verify and rip, convert or retag")
+        dont = True
+    if args.sync and (args.only_rip or args.only_convert or args.retag
+            or args.verify):
+        print("Cannot sync and rip, convert, retag or verify")
+        dont = True
+    if args.plan and (args.retag or args.verify or args.sync or
+            args.session):
+        print("Cannot plan a retag, verify, sync or session")
+        dont = True
+    if args.session and (args.only_rip or args.only_convert or args.retag):
+        print("A session always rips and converts")
+        dont = True
+
+    if dont:
+        pass
+    elif args.coordinate:
+        distribute.coordinate(args)
+    elif args.worker:
+        distribute.work(args.worker)
+    elif args.session:
+        session.main(args, args.wdir)
+    elif args.daemon:
+        daemon.serve(args)
+    elif args.sync:
+        formats = [ext for ext, given in ((".mp3", args.mp3),
+            (".ogg", args.ogg)) if given]
+        bandwidth = args.bwlimit * 1024 * 1024 if args.bwlimit else None
+        sync.sync_library(args.library or args.wdir, args.sync, formats,
+            args.jobs, bandwidth)
+    elif args.verify:
+        bandwidth = args.bwlimit * 1024 * 1024 if args.bwlimit else None
+        verify.verify_library(args.library or args.wdir, args.jobs,
+            bandwidth)
+    elif args.retag:
+        retag.retag_library(directories)
+    elif args.plan:
+        rip.plan_all(args, directories)
+    else:
+        rip.main_all(args, directories)
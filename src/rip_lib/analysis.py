@@ -0,0 +1,123 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Look at the PCM of each track on its way to the encoders, for silence
+at the ends, audio hidden after a long silence, the peak and RMS levels
+and clipping"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+SILENCE_LEVEL = 10 ** (-60 / 20.0)  # Quieter than -60 dBFS is silence
+FULL_SCALE = 32767 / 32768.0        # Samples this loud have been clipped
+HIDDEN_SECS = 10.0                  # Audio after this much silence is hidden
+LONG_SILENCE = 2.0                  # Silence worth a mention in the report
+DEF_LEAD_IN = 150
+
+
+def db(level):
+    return 20 * np.log10(level) if level > 0 else float("-inf")
+
+
+class TrackAnalyser(object):
+    """Measures a stream of float samples as (samples, channels)"""
+
+    def __init__(self, rate, channels=2):
+        self.rate = rate
+        self.frames = 0
+        self.lead = None        # Frames before the first sound
+        self.trail = 0          # Frames since the last sound
+        self.gap = 0            # Longest silence between sounds
+        self.gap_end = None     # Frame at which it ended
+        self.peak = 0.0
+        self.square_sum = 0.0
+        self.clipped = 0
+
+    def process(self, x):
+        if not len(x):
+            return
+        level = np.abs(x).max(axis=1)
+        self.peak = max(self.peak, float(level.max()))
+        self.square_sum += float((x * x).sum()) / x.shape[1]
+        self.clipped += int(np.count_nonzero(np.abs(x) >= FULL_SCALE))
+        loud = np.flatnonzero(level > SILENCE_LEVEL)
+        if not len(loud):
+            self.trail += len(x)
+        else:
+            if self.lead is None:
+                self.lead = self.frames + int(loud[0])
+            else:
+                # The silence running on from the last block
+                self._gap(self.trail + int(loud[0]),
+                    self.frames + int(loud[0]))
+            if len(loud) > 1:
+                gaps = np.diff(loud) - 1
+                longest = int(gaps.argmax())
+                self._gap(int(gaps[longest]),
+                    self.frames + int(loud[longest + 1]))
+            self.trail = len(x) - 1 - int(loud[-1])
+        self.frames += len(x)
+
+    def _gap(self, length, end):
+        if length > self.gap:
+            self.gap = length
+            self.gap_end = end
+
+    def result(self):
+        """Return the report to keep with the track, times in seconds"""
+        rate = float(self.rate)
+        silent = self.lead is None
+        hidden = None
+        if not silent and self.gap >= HIDDEN_SECS * rate:
+            hidden = self.gap_end / rate
+        return {
+            "length": self.frames / rate,
+            "lead_silence": (self.frames if silent else self.lead) / rate,
+            "trail_silence": (0 if silent else self.trail) / rate,
+            "longest_silence": self.gap / rate,
+            "hidden_at": hidden,
+            "peak": self.peak,
+            "rms": (self.square_sum / self.frames) ** 0.5
+                if self.frames else 0.0,
+            "clipped": self.clipped,
+        }
+
+
+def report(info):
+    """Log what the analysis of the tracks found, return the warnings"""
+    warnings = []
+    pregap = info.lead_in - DEF_LEAD_IN
+    if pregap > 0:
+        warnings.append("Track 1 has a {:.1f}s pregap that may hide a "
+            "track, it is not ripped".format(pregap / float(info.fps)))
+    for track in info.tracks:
+        result = getattr(track, "analysis", None)
+        if result is None:
+            continue
+        logger.info("Track %i peak %.1f dBFS RMS %.1f dBFS silence %.1fs "
+            "+ %.1fs clipped %i", track.num, db(result["peak"]),
+            db(result["rms"]), result["lead_silence"],
+            result["trail_silence"], result["clipped"])
+        if result["lead_silence"] >= result["length"]:
+            warnings.append("Track {} is silent".format(track.num))
+            continue
+        if result["hidden_at"] is not None:
+            warnings.append("Track {} has audio at {:.1f}s after {:.1f}s "
+                "of silence, a hidden track?".format(track.num,
+                result["hidden_at"], result["longest_silence"]))
+        if track.num == 1 and result["lead_silence"] >= LONG_SILENCE:
+            warnings.append("Track 1 starts with {:.1f}s of silence".format(
+                result["lead_silence"]))
+        if result["clipped"]:
+            warnings.append("Track {} has {} clipped samples".format(
+                track.num, result["clipped"]))
+    for warning in warnings:
+        logger.warning(warning)
+    return warnings
@@ -0,0 +1,105 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Page cache hints for batch conversions. The archive of the next album
+is read ahead while the current one encodes, and files that have been
+used are dropped from the cache so they do not push out everything else"""
+
+import os
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+BLOCK_SIZE = 1024 * 1024
+PREFETCH_LIMIT = 1024 * 1024 * 1024     # Most read ahead of one file
+
+
+def advise(fd, advice, offset=0, length=0):
+    """posix_fadvise where there is one, it is only a hint so failures
+    are ignored"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as e:
+        logger.debug("fadvise failed: %s", e)
+        return False
+    return True
+
+
+def drop(filename, written=False):
+    """Tell the kernel filename is no longer needed. Dirty pages are not
+    dropped so a file just written is flushed first"""
+    if not hasattr(os, "POSIX_FADV_DONTNEED"):
+        return
+    try:
+        fd = os.open(filename, os.O_RDWR if written else os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if written:
+            os.fdatasync(fd)
+        advise(fd, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        logger.debug("Cannot drop %s: %s", filename, e)
+    finally:
+        os.close(fd)
+
+
+def prefetch(filename, limit=PREFETCH_LIMIT):
+    """Bring the start of filename into the page cache. WILLNEED is not
+    acted on by every filesystem (e.g. NFS) so the file is also read"""
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return 0
+    done = 0
+    try:
+        if hasattr(os, "POSIX_FADV_WILLNEED"):
+            advise(fd, os.POSIX_FADV_WILLNEED, 0, limit)
+        while done < limit:
+            data = os.read(fd, BLOCK_SIZE)
+            if not data:
+                break
+            done += len(data)
+    except OSError as e:
+        logger.debug("Prefetch of %s stopped: %s", filename, e)
+    finally:
+        os.close(fd)
+    logger.debug("Prefetched %i bytes of %s", done, filename)
+    return done
+
+
+class Prefetcher(object):
+    """Reads files ahead on a background thread"""
+
+    def __init__(self, limit=PREFETCH_LIMIT):
+        self.limit = limit
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def add(self, filename):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put(filename)
+
+    def _run(self):
+        while 1:
+            filename = self.queue.get()
+            if filename is None:
+                break
+            prefetch(filename, self.limit)
+
+    def close(self):
+        """Wait for the read ahead to finish"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
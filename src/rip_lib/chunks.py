@@ -0,0 +1,318 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import sys
+import shutil
+import pickle
+import hashlib
+import subprocess
+import logging
+import wave
+import time
+
+import rip_lib.priority as priority
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+SECTOR_SIZE = 2352          # Bytes of CD audio in one sector
+SAMPLES_PER_SECTOR = 588
+CHUNK_SECTORS = 75 * 30     # 30 seconds of audio per chunk
+CHUNK_DIR = "chunks"
+MANIFEST = "chunks.info"
+
+
+def audio_sectors(info, num_tracks=None):
+    """Number of sectors from the start of track 1 to the end of
+    track num_tracks"""
+    if num_tracks is None:
+        num_tracks = info.num_tracks
+    return sum([track.length for track in info.tracks[:num_tracks]])
+
+
+def track_span(info, num):
+    """The (first, last) sectors of track num"""
+    first = 0
+    for track in info.tracks:
+        if track.num == num:
+            return first, first + track.length - 1
+        first += track.length
+    raise IndexError(num)
+
+
+def selected_spans(info, tracks):
+    """The sorted (first, last) sector spans of the tracks, with the spans
+    of neighbouring tracks joined"""
+    spans = []
+    for first, last in sorted([track_span(info, num) for num in tracks]):
+        if spans and first == spans[-1][1] + 1:
+            spans[-1] = (spans[-1][0], last)
+        else:
+            spans.append((first, last))
+    return spans
+
+
+def silence(first, last):
+    """Yield the audio data of sectors first..last of silence"""
+    todo = (last - first + 1) * SECTOR_SIZE
+    while todo > 0:
+        size = min(todo, 1 << 20)
+        todo -= size
+        yield bytes(size)
+
+
+def sector_span(first, last):
+    """cdparanoia span covering sectors first..last (inclusive), relative
+    to the start of the audio"""
+    return "[.{}]-[.{}]".format(first, last)
+
+
+def sha1_file(filename):
+    chksum = hashlib.sha1()
+    with open(filename, "rb") as in_fp:
+        while 1:
+            data = in_fp.read(1 << 20)
+            if not data:
+                break
+            chksum.update(data)
+    return chksum.hexdigest()
+
+
+def rm_file(temp_file):
+    try:
+        os.unlink(temp_file)
+    except FileNotFoundError:
+        pass
+
+
+class ChunkStore(object):
+    """Checkpointed rip, the audio is held as fixed size sector chunks
+    each with its own checksum. All sector numbers are relative to the
+    start of track 1"""
+
+    def __init__(self, tmp_dir, disc_id, chunk_sectors=CHUNK_SECTORS):
+        self.chunk_dir = os.path.join(tmp_dir, CHUNK_DIR)
+        self.disc_id = disc_id
+        self.chunk_sectors = chunk_sectors
+        self.chunks = {}    # first sector -> (last sector, sha1)
+        self._load()
+
+    def _manifest(self):
+        return os.path.join(self.chunk_dir, MANIFEST)
+
+    def _chunk_file(self, first, last):
+        return os.path.join(self.chunk_dir,
+            "{:07d}-{:07d}.raw".format(first, last)
+        )
+
+    def _load(self):
+        try:
+            with open(self._manifest(), "rb") as pkl_fd:
+                disc_id, chunks = pickle.load(pkl_fd)
+        except FileNotFoundError:
+            return
+        if disc_id != self.disc_id:
+            logger.warning("Chunks are from another disc, discarding them")
+            self.clear()
+            return
+        self.chunks = chunks
+
+    def _save(self):
+        try:
+            os.mkdir(self.chunk_dir)
+        except FileExistsError:
+            pass
+        temp_file = self._manifest() + ".tmp"
+        with open(temp_file, "wb") as pkl_fd:
+            pickle.dump((self.disc_id, self.chunks), pkl_fd)
+        os.rename(temp_file, self._manifest())
+
+    def verify(self):
+        """Re-check the chunks already written, dropping missing or bad
+        ones. Return the number of good sectors"""
+        good = 0
+        for first, (last, chksum) in sorted(self.chunks.items()):
+            chunk_file = self._chunk_file(first, last)
+            size = (last - first + 1) * SECTOR_SIZE
+            try:
+                ok = os.path.getsize(chunk_file) == size and \
+                    sha1_file(chunk_file) == chksum
+            except FileNotFoundError:
+                ok = False
+            if ok:
+                good += last - first + 1
+            else:
+                logger.warning("Chunk %i-%i is bad, will read again",
+                    first, last)
+                rm_file(chunk_file)
+                del self.chunks[first]
+        self._save()
+        logger.info("%i good sectors already read", good)
+        return good
+
+    def present(self):
+        """Return the sorted list of (first, last) ranges held"""
+        return sorted([(first, last) for first, (last, _) in
+            self.chunks.items()])
+
+    def missing(self, first, last):
+        """Return the chunk sized (first, last) ranges not yet held within
+        first..last. Chunks are aligned to a fixed grid so that a later
+        rip of a larger span lines up with what is already present"""
+        gaps = []
+        pos = first
+        for c_first, c_last in self.present():
+            if c_last < pos:
+                continue
+            if c_first > last:
+                break
+            if c_first > pos:
+                gaps.append((pos, c_first - 1))
+            pos = max(pos, c_last + 1)
+        if pos <= last:
+            gaps.append((pos, last))
+
+        ranges = []
+        for g_first, g_last in gaps:
+            while g_first <= g_last:
+                end = (g_first // self.chunk_sectors + 1) * \
+                    self.chunk_sectors - 1
+                end = min(end, g_last)
+                ranges.append((g_first, end))
+                g_first = end + 1
+        return ranges
+
+    def add(self, first, last, temp_file):
+        """Move a completed chunk file into the store, return False if
+        it is the wrong size"""
+        size = (last - first + 1) * SECTOR_SIZE
+        try:
+            got = os.path.getsize(temp_file)
+        except FileNotFoundError:
+            got = 0
+        if got != size:
+            logger.error("Chunk %i-%i size %i != %i", first, last, got, size)
+            rm_file(temp_file)
+            return False
+        chksum = sha1_file(temp_file)
+        if not os.path.isdir(self.chunk_dir):
+            os.mkdir(self.chunk_dir)
+        os.rename(temp_file, self._chunk_file(first, last))
+        self.chunks[first] = (last, chksum)
+        self._save()
+        return True
+
+    def rip_chunk(self, device, first, last):
+        """Read one chunk of the CD"""
+        temp_file = os.path.join(self.chunk_dir, "temp.raw")
+        if not os.path.isdir(self.chunk_dir):
+            os.mkdir(self.chunk_dir)
+        args = priority.reader([
+            "cdparanoia",
+            "-d", device,
+            "-r",
+            sector_span(first, last),
+            temp_file
+        ])
+        rm_file(temp_file)
+        try:
+            print(args)
+            subprocess.call(args)
+        except FileNotFoundError:
+            print("Check %s is installed\n" % args[0])
+            rm_file(temp_file)
+            sys.exit(-1)
+        return self.add(first, last, temp_file)
+
+    def import_flac(self, flac_file, first, last):
+        """Take sectors first..last from a FLAC of the same disc rather
+        than reading them from the CD"""
+        temp_file = os.path.join(self.chunk_dir, "temp.raw")
+        if not os.path.isdir(self.chunk_dir):
+            os.mkdir(self.chunk_dir)
+        args = [
+            "flac", "-d", "-s",
+            "--force-raw-format", "--endian=little", "--sign=signed",
+            "--skip={}".format(first * SAMPLES_PER_SECTOR),
+            "--until={}".format((last + 1) * SAMPLES_PER_SECTOR),
+            "-o", temp_file, flac_file
+        ]
+        rm_file(temp_file)
+        try:
+            print(args)
+            subprocess.call(args)
+        except FileNotFoundError:
+            print("Check %s is installed\n" % args[0])
+            return False
+        return self.add(first, last, temp_file)
+
+    def rip(self, device, first, last, monitor=None):
+        """Read all of first..last that is not already held, monitor if
+        given is told the sectors and seconds taken by each chunk"""
+        for c_first, c_last in self.missing(first, last):
+            logger.info("Reading sectors %i-%i of %i", c_first, c_last, last)
+            start = time.monotonic()
+            if not self.rip_chunk(device, c_first, c_last):
+                return False
+            if monitor:
+                monitor(c_last - c_first + 1, time.monotonic() - start)
+        return True
+
+    def read_sectors(self, first, last, fill=False):
+        """Yield the audio data for sectors first..last, if fill the
+        sectors not held are given as silence"""
+        pos = first
+        for c_first, c_last in self.present():
+            if c_last < pos:
+                continue
+            if c_first > pos:
+                if not fill or c_first > last:
+                    break
+                for data in silence(pos, c_first - 1):
+                    yield data
+                pos = c_first
+            end = min(c_last, last)
+            with open(self._chunk_file(c_first, c_last), "rb") as in_fp:
+                in_fp.seek((pos - c_first) * SECTOR_SIZE)
+                todo = (end - pos + 1) * SECTOR_SIZE
+                while todo > 0:
+                    data = in_fp.read(min(todo, 1 << 20))
+                    if not data:
+                        raise RuntimeError("Chunk truncated")
+                    todo -= len(data)
+                    yield data
+            pos = end + 1
+            if pos > last:
+                break
+        if pos <= last:
+            if not fill:
+                raise RuntimeError("Sector {} not read".format(pos))
+            for data in silence(pos, last):
+                yield data
+
+    def assemble(self, wav_file, first, last, fill=False):
+        """Join the chunks into a WAV file, if fill the sectors not held
+        are silent"""
+        temp_file = wav_file + ".tmp"
+        out_fp = wave.open(temp_file, "wb")
+        try:
+            out_fp.setnchannels(2)
+            out_fp.setsampwidth(2)
+            out_fp.setframerate(44100)
+            for data in self.read_sectors(first, last, fill):
+                out_fp.writeframesraw(data)
+        except:
+            out_fp.close()
+            rm_file(temp_file)
+            raise
+        out_fp.close()
+        os.rename(temp_file, wav_file)
+
+    def clear(self):
+        """Remove all chunks"""
+        shutil.rmtree(self.chunk_dir, ignore_errors=True)
+        self.chunks = {}
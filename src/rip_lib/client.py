@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Thin client of the rip daemon, it only imports what it needs to talk
+to the socket so submitting a job is quick"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+NO_DAEMON = 3       # Exit status when there is no daemon to talk to, 2 is
+                    # taken by argparse for a usage error
+POLL_SECS = 1.0
+
+
+def socket_path():
+    """Where the daemon listens, private to the user"""
+    run_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(run_dir, "rip_lib-{}.sock".format(os.getuid()))
+
+
+def send(sock, message):
+    sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def receive(sock_fp):
+    line = sock_fp.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
+def request(message, path=None):
+    """Send one request to the daemon and return its reply, raises
+    OSError if the daemon is not running"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or socket_path())
+        send(sock, message)
+        with sock.makefile("rb") as sock_fp:
+            reply = receive(sock_fp)
+    finally:
+        sock.close()
+    if reply is None:
+        raise ConnectionError("No reply from the daemon")
+    return reply
+
+
+def running(path=None):
+    """True if a daemon answers on the socket"""
+    try:
+        request({"cmd": "list"}, path)
+    except OSError:
+        return False
+    return True
+
+
+def ask(question):
+    """Like main.yes_or_no, without importing main"""
+    print(question)
+    while 1:
+        answer = input("?").lower()
+        if answer.startswith("y"):
+            return True
+        if answer.startswith("n"):
+            return False
+        print("Please type 'y' or 'n'")
+
+
+def show(status):
+    stages = status["stages"]
+    print("[{}] {} {} {} ({}/{} stages{})".format(
+        status["id"], status["kind"], status["wdir"], status["state"],
+        stages["done"], stages["total"],
+        ", " + ", ".join(stages["running"]) if stages["running"] else ""))
+    if status.get("error"):
+        print("    {}".format(status["error"]))
+
+
+def main(argv=None):
+    # Before parsing, so that without a daemon any option rip_lib takes
+    # is passed on to it by cd_rip.sh
+    if not running():
+        logger.debug("The rip daemon is not running")
+        return NO_DAEMON
+    parser = argparse.ArgumentParser(
+        description='Send a job to the rip daemon')
+    parser.add_argument('--only-rip', action='store_const', const=True,
+            default=False, help='Only RIP to FLAC')
+    parser.add_argument('--only-convert', action='store_const', const=True,
+            default=False, help='Only convert flac to OGGs and MP3')
+    parser.add_argument('--library', default=None,
+            help='Library of archived albums, a disc already in it is '
+            'not ripped again')
+    parser.add_argument('--48k', dest='do48k', action='store_const',
+            const=True, default=False, help='Use 48K sample rate')
+    parser.add_argument('--ogg', action='store_const', const=True,
+            default=False, help='Convert to OGG')
+    parser.add_argument('--mp3', action='store_const', const=True,
+            default=False, help='Convert to MP3')
+    parser.add_argument('--reread', action='store_const', const=True,
+            default=False, help='If the disc is in the library, read again '
+            'the tracks that fail verification rather than skip it')
+    parser.add_argument('--wait', action='store_const', const=True,
+            default=False, help='Wait for the job to finish')
+    parser.add_argument('--status', action='store_const', const=True,
+            default=False, help='Show the jobs of the daemon')
+    parser.add_argument('--shutdown', action='store_const', const=True,
+            default=False, help='Stop the daemon once its jobs are done')
+    parser.add_argument('wdir', nargs='?',
+            help='Working directory', default=os.getcwd())
+    args, unknown = parser.parse_known_args(argv)
+    if unknown:
+        print("The rip daemon does not take {}, run python3 -m rip_lib "
+            "once it is idle".format(" ".join(unknown)))
+        return 1
+    formats = {"48k": args.do48k, "ogg": args.ogg, "mp3": args.mp3}
+    if not (args.only_rip or args.status or args.shutdown or
+            any(formats.values())):
+        # The daemon has nobody to ask, so ask now
+        if not sys.stdin.isatty():
+            print("Give --ogg, --mp3 and/or --48k, or --only-rip")
+            return 1
+        formats["48k"] = ask("Use 48K sample rate?")
+        formats["ogg"] = ask("Convert to OGG?")
+        formats["mp3"] = ask("Convert to MP3?")
+
+    try:
+        if args.status:
+            for status in request({"cmd": "list"})["jobs"]:
+                show(status)
+            return 0
+        if args.shutdown:
+            request({"cmd": "shutdown"})
+            return 0
+        reply = request({
+            "cmd": "submit",
+            "kind": "convert" if args.only_convert else "rip",
+            "wdir": os.path.abspath(args.wdir),
+            "only_rip": args.only_rip,
+            "library": args.library and os.path.abspath(args.library),
+            "answers": {
+                "48k": formats["48k"],
+                "ogg": formats["ogg"],
+                "mp3": formats["mp3"],
+                "tags": False,
+                "rename": True,
+                "skip": not args.reread,
+                "reread": args.reread
+            }
+        })
+        if not reply["ok"]:
+            print(reply["error"])
+            return 1
+        print("Job {} submitted".format(reply["id"]))
+        while args.wait:
+            status = request({"cmd": "status", "id": reply["id"]})["job"]
+            if status["state"] in ("done", "failed"):
+                show(status)
+                return 0 if status["state"] == "done" else 1
+            time.sleep(POLL_SECS)
+    except OSError:
+        logger.debug("The rip daemon is not running")
+        return NO_DAEMON
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import copy
+import time
+import queue
+import threading
+import collections
+import socketserver
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.main as rip
+import rip_lib.rank as rank
+import rip_lib.musicbrainz as musz
+import rip_lib.client as client
+
+MAX_JOBS = 100      # Finished jobs remembered for status requests
+KINDS = ("rip", "convert")
+
+
+class Job(object):
+    """A rip or convert job and its progress"""
+
+    def __init__(self, job_id, kind, wdir, options):
+        self.id = job_id
+        self.kind = kind
+        self.wdir = wdir
+        self.options = options
+        self.state = "queued"
+        self.error = None
+        self.stages = collections.OrderedDict()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def progress(self, name, state):
+        """Called by the pipeline as the stages run"""
+        self.stages[name] = state
+
+    def status(self):
+        states = list(self.stages.values())
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "wdir": self.wdir,
+            "state": self.state,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "stages": {
+                "total": len(states),
+                "done": states.count("done"),
+                "failed": states.count("failed"),
+                "running": [name for name, state in self.stages.items()
+                    if state == "start"]
+            }
+        }
+
+
+class Daemon(object):
+    """Runs the jobs sent to its socket one at a time, while keeping the
+    encoder threads, metadata cache and library index from one job to the
+    next"""
+
+    def __init__(self, defaults, path=None, workers=None):
+        self.defaults = defaults
+        self.path = path or client.socket_path()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers or os.cpu_count())
+        self.jobs = collections.OrderedDict()
+        self.todo = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.server = None
+
+    def submit(self, message):
+        kind = message.get("kind")
+        if kind not in KINDS:
+            raise ValueError("Unknown job kind {}".format(kind))
+        wdir = message.get("wdir")
+        if not wdir or not os.path.isdir(wdir):
+            raise ValueError("No such directory {}".format(wdir))
+        with self.lock:
+            job = Job(self.next_id, kind, wdir, message)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            finished = [x for x in self.jobs.values()
+                if x.state in ("done", "failed")]
+            for old in finished[:max(0, len(finished) - MAX_JOBS)]:
+                del self.jobs[old.id]
+        self.todo.put(job)
+        logger.info("Job %i %s %s queued", job.id, kind, wdir)
+        return job
+
+    def job_args(self, job):
+        """The arguments main() would get from the command line"""
+        args = copy.copy(self.defaults)
+        args.only_convert = job.kind == "convert"
+        args.only_rip = bool(job.options.get("only_rip"))
+        args.discover_flacs = False
+        args.retag = False
+        args.library = job.options.get("library") or self.defaults.library
+        args.answers = job.options.get("answers") or {}
+        args.executor = self.executor
+        args.progress = job.progress
+        return args
+
+    def run_job(self, job):
+        job.state = "running"
+        job.started = time.time()
+        logger.info("Job %i started", job.id)
+        try:
+            rip.main(self.job_args(job), job.wdir)
+        except (Exception, SystemExit) as err:
+            logger.exception("Job %i failed", job.id)
+            job.error = repr(err)
+            job.state = "failed"
+        else:
+            job.state = "done"
+        job.finished = time.time()
+        logger.info("Job %i %s", job.id, job.state)
+
+    def worker(self):
+        while 1:
+            job = self.todo.get()
+            if job is None:
+                break
+            self.run_job(job)
+
+    def handle(self, message):
+        """Return the reply to a request"""
+        if not isinstance(message, dict):
+            raise ValueError("Bad request")
+        cmd = message.get("cmd")
+        if cmd == "submit":
+            return {"ok": True, "id": self.submit(message).id}
+        if cmd == "status":
+            with self.lock:
+                job = self.jobs.get(message.get("id"))
+            if job is None:
+                return {"ok": False, "error": "No such job"}
+            return {"ok": True, "job": job.status()}
+        if cmd == "list":
+            with self.lock:
+                jobs = list(self.jobs.values())
+            return {"ok": True, "jobs": [job.status() for job in jobs]}
+        if cmd == "shutdown":
+            self.todo.put(None)
+            threading.Thread(target=self.server.shutdown).start()
+            return {"ok": True}
+        return {"ok": False, "error": "Unknown command {}".format(cmd)}
+
+    def _claim_socket(self):
+        """Remove the socket left by a daemon that died, refuse to start
+        if one is still running"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            client.request({"cmd": "list"}, self.path)
+        except OSError:
+            os.unlink(self.path)
+            return
+        raise RuntimeError("A daemon is already listening on " + self.path)
+
+    def serve(self):
+        self._claim_socket()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    self.serve_client()
+                except OSError:
+                    pass    # The client went away
+
+            def serve_client(self):
+                while 1:
+                    try:
+                        message = client.receive(self.rfile)
+                        if message is None:
+                            break
+                        reply = daemon.handle(message)
+                    except ValueError as err:
+                        reply = {"ok": False, "error": str(err)}
+                    client.send(self.connection, reply)
+
+        old_umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path,
+                Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.worker)
+        thread.start()
+        logger.info("Listening on %s", self.path)
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            self.todo.put(None)
+        finally:
+            self.server.server_close()
+            os.unlink(self.path)
+        thread.join()
+        self.executor.shutdown()
+
+
+def serve(args):
+    """Run the daemon until it is asked to shut down"""
+    rank.set_interactive(False)     # Jobs have nobody to ask
+    musz.keep_alive()
+    Daemon(args).serve()
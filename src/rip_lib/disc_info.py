@@ -6,9 +6,12 @@
 ##
 
 import sys
+import copy
 import subprocess
 import logging
 
+import rip_lib.toc as toc
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -289,7 +292,35 @@ class DiscInfo(object):
             break
         return True
 
-    def read_disk(self, devname=DEVICE):
+    def _read_ioctl(self, devname=DEVICE):
+        """Read the TOC straight from the drive"""
+        try:
+            entries, disc_len = toc.read_entries(devname)
+        except OSError as err:
+            logger.debug("No TOC from ioctl %s", repr(err))
+            return False
+        if not entries:
+            return False
+        self.fps = DEF_FPS
+        self.lead_in = entries[0][1]
+        offsets = [offset for _, offset, _ in entries] + [disc_len]
+        for i, (num, offset, ctrl) in enumerate(entries):
+            track = self.add_track(num, offset)
+            track.add_toc_info(bool(ctrl & toc.CTRL_PRE_EMPHASIS),
+                offsets[i+1] - offset)
+        # cdparanoia leaves out the data track of an enhanced CD, and the
+        # audio session ends with its own lead out before the data session
+        data = False
+        while len(self.tracks) > 1 and entries[len(self.tracks)-1][2] & \
+                toc.CTRL_DATA:
+            logger.warning("Data track %i, removing it...", self.tracks[-1].num)
+            del self.tracks[-1]
+            data = True
+        if data:
+            self.tracks[-1].length -= toc.SESSION_GAP
+        return True
+
+    def _read_tools(self, devname=DEVICE):
         got = self._read_discid(devname)
         got = self._read_toc(devname) or got
         if got:
@@ -303,6 +334,26 @@ class DiscInfo(object):
             return True
         return False
 
+    def read_disk(self, devname=DEVICE):
+        """Read the TOC, from the drive once per disc inserted and then
+        from the cache. The ioctls are tried before cd-discid and
+        cdparanoia"""
+        def probe():
+            info = DiscInfo()
+            if info._read_ioctl(devname) or info._read_tools(devname):
+                return info
+            return None
+        found = toc.cached(devname, probe)
+        if found is None:
+            return False
+        found = copy.deepcopy(found)
+        self.fps = found.fps
+        self.lead_in = found.lead_in
+        self.tracks = found.tracks
+        for track in self.tracks:
+            track.disc = self
+        return True
+
 
     @property
     def num_tracks(self):
@@ -358,6 +409,11 @@ class DiscInfo(object):
     def write_cuefile(self, out_fp):
         out_fp.write('PERFORMER "{}"\n'.format(self.artist))
         out_fp.write('TITLE "{}"\n'.format(self.title))
+        selected = getattr(self, "selected", None)
+        if selected:
+            # Only these tracks were read, the rest of the file is silence
+            out_fp.write('REM SELECTED {}\n'.format(
+                ",".join([str(num) for num in selected])))
         out_fp.write('FILE "disc.ogg" WAVE\n')
         for track in self.tracks:
             track.write_cue(out_fp)
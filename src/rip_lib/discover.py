@@ -11,16 +11,31 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def recursive_search(root):
-    possible = 0
+def recursive_search(root, cache=None):
+    """Find the album directories under root. cache if given maps each
+    directory to its mtime and what was found in it, a directory whose
+    mtime has not changed is not listed again"""
+    mtime = os.stat(root).st_mtime
+    if cache is not None and cache.get(root, (None,))[0] == mtime:
+        possible, subdirs = cache[root][1:]
+    else:
+        possible = 0
+        subdirs = []
+        for entry in os.listdir(root):
+            if entry in ["pickle.info", "disc.flac", "disc.cue"]:
+                possible += 1
+            else:
+                path = os.path.join(root, entry)
+                if os.path.isdir(path):
+                    subdirs.append(path)
+        if cache is not None:
+            cache[root] = (mtime, possible, subdirs)
     directories = []
-    for entry in os.listdir(root):
-        if entry in ["pickle.info", "disc.flac", "disc.cue"]:
-            possible += 1
-        else:
-            path = os.path.join(root, entry)
-            if os.path.isdir(path):
-                directories += recursive_search(path)
+    for path in subdirs:
+        try:
+            directories += recursive_search(path, cache)
+        except FileNotFoundError:
+            pass    # Removed since the parent was listed
     if possible > 2:
         directories += [root]
     elif possible > 0:
@@ -28,6 +43,6 @@ def recursive_search(root):
     return directories
 
 
-def find_directories(root):
-    directories = recursive_search(root)
+def find_directories(root, cache=None):
+    directories = recursive_search(root, cache)
     return directories
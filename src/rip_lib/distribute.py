@@ -0,0 +1,452 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import json
+import time
+import uuid
+import socket
+import shutil
+import tempfile
+import functools
+import threading
+import subprocess
+import collections
+import socketserver
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.main as rip
+import rip_lib.ogg as ogg
+import rip_lib.dsp as dsp
+import rip_lib.chunks as chunks
+import rip_lib.stream as stream
+import rip_lib.discover as discover
+import rip_lib.loudness as loudness
+import rip_lib.analysis as analysis
+
+DEF_PORT = 8765
+LEASE_SECS = 300    # A track goes back in the pool if its worker is silent
+RETRY_SECS = 5      # How long a worker waits when no track is free
+MAX_TRIES = 3       # Times a track is handed out before it is given up
+FLAC_EXE = "flac"
+FORMATS = ("ogg", "mp3")
+
+
+def send_msg(sock, header, payloads=()):
+    """Send a JSON header line followed by binary payloads"""
+    header = dict(header)
+    header["sizes"] = [len(x) for x in payloads]
+    sock.sendall(json.dumps(header).encode("utf-8") + b"\n")
+    for payload in payloads:
+        sock.sendall(payload)
+
+
+def recv_msg(sock_fp):
+    """Return the (header, payloads) sent by send_msg, or None if the
+    connection has closed"""
+    line = sock_fp.readline()
+    if not line:
+        return None
+    header = json.loads(line.decode("utf-8"))
+    payloads = []
+    for size in header.get("sizes", []):
+        payload = sock_fp.read(size)
+        if len(payload) != size:
+            raise ConnectionError("Connection closed mid message")
+        payloads.append(payload)
+    return header, payloads
+
+
+def out_filename(album_dir, fmt, idx):
+    if fmt == "ogg":
+        return rip.ogg_filename(album_dir, idx)
+    return rip.mp3_filename(album_dir, idx)
+
+
+def flac_segment(flac_file, first, last):
+    """Sectors first..last of the archive as a FLAC stream"""
+    args = [
+        FLAC_EXE, "-s", "-c", "--fast",
+        "--skip={}".format(first * chunks.SAMPLES_PER_SECTOR),
+        "--until={}".format((last + 1) * chunks.SAMPLES_PER_SECTOR),
+        flac_file
+    ]
+    print(args)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    data = proc.stdout.read()
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError("{} failed".format(args[0]))
+    return data
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Album(object):
+    """An album directory waiting to be converted"""
+
+    def __init__(self, album_id, album_dir, info, formats, do48k=False):
+        self.id = album_id
+        self.dir = album_dir
+        self.info = info
+        self.formats = formats
+        self.do48k = do48k
+        self.todo = set([track.num for track in rip.selected_tracks(info)])
+        self.leases = {}    # Track number to [worker, expiry time]
+        self.tries = collections.Counter()
+        self.failed = []
+
+    def job(self, idx):
+        """What the worker needs to know to encode track idx"""
+        album_title, performer, title = rip.process_tags(self.info, idx)
+        track = {
+            "idx": idx,
+            "album": album_title,
+            "performer": performer,
+            "title": title,
+            "pre_emphasis": bool(getattr(self.info.get_track(idx),
+                "pre_emphasis", False))
+        }
+        return {"album": self.id, "formats": self.formats,
+            "48k": self.do48k, "tracks": [track]}
+
+
+class Coordinator(object):
+    """Hands out the tracks of the albums to workers, each track is leased
+    to one worker at a time and the lease lapses if the worker stops
+    talking. Leasing tracks rather than albums lets every worker help
+    with an album, however few albums are left"""
+
+    def __init__(self, directories, formats, lease_secs=LEASE_SECS,
+        do48k=False
+    ):
+        self.lease_secs = lease_secs
+        self.lock = threading.Lock()
+        self.albums = collections.OrderedDict()
+        self.server = None
+        for album_dir in directories:
+            info = rip.load_pickle(album_dir)
+            if info is None:
+                logger.error("No disc information in %s", album_dir)
+                continue
+            album = Album(len(self.albums) + 1, album_dir, info, formats,
+                do48k)
+            for track in rip.selected_tracks(info):
+                if all([os.path.exists(out_filename(album_dir, fmt,
+                        track.num)) for fmt in formats]):
+                    album.todo.discard(track.num)
+            if album.todo:
+                self.albums[album.id] = album
+        logger.info("%i albums to convert", len(self.albums))
+
+    def _leased(self, worker):
+        for album in self.albums.values():
+            for idx, lease in album.leases.items():
+                if lease[0] == worker:
+                    return album, idx
+        return None
+
+    def lease(self, worker):
+        """Return the (album, track number) leased to the worker, or
+        None"""
+        now = time.monotonic()
+        with self.lock:
+            for album in self.albums.values():
+                for idx, lease in list(album.leases.items()):
+                    if lease[1] < now:
+                        logger.warning("Lease of %s track %i by %s lapsed",
+                            album.dir, idx, lease[0])
+                        del album.leases[idx]
+            held = self._leased(worker)
+            if held is None:
+                for album in self.albums.values():
+                    free = sorted(album.todo - set(album.leases))
+                    if free:
+                        held = album, free[0]
+                        album.tries[free[0]] += 1
+                        logger.info("%s track %i leased to %s", album.dir,
+                            free[0], worker)
+                        break
+                else:
+                    return None
+            album, idx = held
+            album.leases[idx] = [worker, now + self.lease_secs]
+            return held
+
+    def held(self, worker, album_id, idx):
+        """Return the album if the worker still holds the lease of track
+        idx"""
+        now = time.monotonic()
+        with self.lock:
+            album = self.albums.get(album_id)
+            lease = album.leases.get(idx) if album else None
+            if lease is None or lease[0] != worker or lease[1] < now:
+                raise ValueError("Track {} of album {} is not leased to "
+                    "{}".format(idx, album_id, worker))
+            lease[1] = now + self.lease_secs
+            return album
+
+    def finished(self):
+        with self.lock:
+            return not self.albums
+
+    def segment(self, worker, album_id, idx):
+        album = self.held(worker, album_id, idx)
+        first, last = chunks.track_span(album.info, idx)
+        return flac_segment(os.path.join(album.dir, rip.FLACFILE), first,
+            last)
+
+    def result(self, worker, album_id, idx, measured, payloads,
+        report=None
+    ):
+        """Store the encoded files of a track and what was measured"""
+        album = self.held(worker, album_id, idx)
+        if idx not in album.todo or len(payloads) != len(album.formats):
+            raise ValueError("Unexpected result for track {}".format(idx))
+        for fmt, data in zip(album.formats, payloads):
+            out_file = out_filename(album.dir, fmt, idx)
+            temp_file = rip.temp_name(out_file)
+            with open(temp_file, "wb") as out_fp:
+                out_fp.write(data)
+            os.rename(temp_file, out_file)
+        album.info.get_track(idx).loudness = loudness.unpack(measured)
+        if report is not None:
+            album.info.get_track(idx).analysis = report
+        self._done(album, idx)
+
+    def failed(self, worker, album_id, idx, error):
+        """The worker could not encode the track, it goes back in the pool
+        unless it has failed too often"""
+        with self.lock:
+            album = self.albums.get(album_id)
+            lease = album.leases.get(idx) if album else None
+            if lease is None or lease[0] != worker:
+                return      # Already lapsed and handed out again
+            del album.leases[idx]
+            logger.error("%s track %i failed on %s %s", album.dir, idx,
+                worker, error)
+            if album.tries[idx] < MAX_TRIES:
+                return
+            album.failed.append(idx)
+        self._done(album, idx)
+
+    def _done(self, album, idx):
+        """Track idx needs nothing more, finish the album if it was the
+        last"""
+        with self.lock:
+            album.todo.discard(idx)
+            album.leases.pop(idx, None)
+            done = not album.todo
+            if done:
+                del self.albums[album.id]
+        if done:
+            if album.failed:
+                logger.error("%s tracks %s not converted", album.dir,
+                    sorted(album.failed))
+            logger.info("%s converted", album.dir)
+            analysis.report(album.info)
+            rip.write_replaygain(album.dir, album.info,
+                "ogg" in album.formats, "mp3" in album.formats)
+            if "mp3" in album.formats:
+                rip.fix_mp3_tags(album.dir, album.info)
+            if self.finished() and self.server:
+                threading.Thread(target=self.server.shutdown).start()
+
+    def handle(self, header, payloads):
+        """Return the (header, payloads) of the reply to a request"""
+        cmd = header.get("cmd")
+        worker = header.get("worker")
+        if cmd == "lease":
+            held = self.lease(worker)
+            if held is None:
+                return {"album": None, "finished": self.finished(),
+                    "retry": RETRY_SECS}, []
+            album, idx = held
+            return album.job(idx), []
+        if cmd == "segment":
+            return {"ok": True}, [self.segment(worker, header["album"],
+                header["track"])]
+        if cmd == "result":
+            self.result(worker, header["album"], header["track"],
+                header["loudness"], payloads, header.get("analysis"))
+            return {"ok": True}, []
+        if cmd == "failed":
+            self.failed(worker, header["album"], header["track"],
+                header.get("error"))
+            return {"ok": True}, []
+        raise ValueError("Unknown command {}".format(cmd))
+
+    def bind(self, host="", port=DEF_PORT):
+        """Start listening, return the address in use"""
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while 1:
+                    try:
+                        msg = recv_msg(self.rfile)
+                        if msg is None:
+                            break
+                        reply = coordinator.handle(*msg)
+                    except (ValueError, KeyError, RuntimeError) as err:
+                        logger.error("Request failed %s", repr(err))
+                        reply = {"error": str(err)}, []
+                    except OSError:
+                        break
+                    try:
+                        send_msg(self.connection, *reply)
+                    except OSError:
+                        break
+
+        self.server = Server((host, port), Handler)
+        logger.info("Coordinator listening on port %i",
+            self.server.server_address[1])
+        return self.server.server_address
+
+    def serve(self):
+        """Serve workers until every album is converted"""
+        if self.finished():
+            self.server.server_close()
+            return
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+
+class Worker(object):
+    """Takes tracks from a coordinator and encodes them"""
+
+    def __init__(self, host, port=DEF_PORT, name=None, work_dir=None):
+        self.address = (host, port)
+        self.name = name or "{}-{}".format(socket.gethostname(),
+            uuid.uuid4().hex[:8])
+        self.work_dir = work_dir
+        self.album = None
+        self.sock = None
+        self.sock_fp = None
+
+    def call(self, header, payloads=()):
+        header = dict(header)
+        header["worker"] = self.name
+        send_msg(self.sock, header, payloads)
+        msg = recv_msg(self.sock_fp)
+        if msg is None:
+            raise ConnectionError("Coordinator closed the connection")
+        if "error" in msg[0]:
+            raise RuntimeError(msg[0]["error"])
+        return msg
+
+    def encode(self, tmp_dir, formats, track, do48k=False):
+        """Encode one track from its FLAC segment, return the encoded files,
+        the loudness measurement and the analysis. If do48k the PCM is
+        resampled to 48K on the way to the encoders"""
+        idx = track["idx"]
+        seg_file = os.path.join(tmp_dir, "segment.flac")
+        wav_file = os.path.join(tmp_dir, "segment.wav")
+        with open(seg_file, "wb") as out_fp:
+            out_fp.write(self.call({"cmd": "segment", "album": self.album,
+                "track": idx})[1][0])
+        args = [FLAC_EXE, "-d", "-s", "-f", "-o", wav_file, seg_file]
+        print(args)
+        if subprocess.call(args) != 0:
+            raise RuntimeError("{} failed".format(args[0]))
+
+        def encoder(fmt, rate, channels):
+            out_file = out_filename(tmp_dir, fmt, idx)
+            temp_file = rip.temp_name(out_file)
+            tags = (track["performer"], track["album"], track["title"], idx)
+            if fmt == "ogg":
+                args = ogg.oggenc_cmd(None, temp_file, *tags,
+                    raw=(rate, channels))
+            else:
+                args = rip.lame_cmd(None, temp_file, *tags,
+                    raw=(rate, channels))
+            return args, temp_file, out_file
+
+        encoders = [lambda r, c, fmt=fmt: encoder(fmt, r, c)
+            for fmt in formats]
+        filters = [dsp.deemphasis_filter] if track["pre_emphasis"] else []
+        if do48k:
+            filters.append(functools.partial(dsp.resampler, rip.RATE48K))
+        analysers = stream.convert(wav_file, encoders,
+            [loudness.LoudnessMeter], filters, [analysis.TrackAnalyser])
+        if analysers is None:
+            raise RuntimeError("Track {} failed to encode".format(idx))
+        payloads = []
+        for fmt in formats:
+            out_file = out_filename(tmp_dir, fmt, idx)
+            with open(out_file, "rb") as in_fp:
+                payloads.append(in_fp.read())
+            os.unlink(out_file)
+        return payloads, loudness.pack(analysers[0].result()), \
+            analysers[1].result()
+
+    def run(self):
+        """Work until the coordinator has nothing left"""
+        self.sock = socket.create_connection(self.address)
+        self.sock_fp = self.sock.makefile("rb")
+        tmp_dir = tempfile.mkdtemp(prefix="rip_worker-", dir=self.work_dir)
+        converted = 0
+        try:
+            while 1:
+                job = self.call({"cmd": "lease"})[0]
+                if job["album"] is None:
+                    if job["finished"]:
+                        break
+                    time.sleep(job["retry"])
+                    continue
+                self.album = job["album"]
+                for track in job["tracks"]:
+                    try:
+                        payloads, measured, report = self.encode(tmp_dir,
+                            job["formats"], track, job.get("48k", False))
+                        self.call({"cmd": "result", "album": self.album,
+                            "track": track["idx"], "loudness": measured,
+                            "analysis": report}, payloads)
+                    except ConnectionError:
+                        raise
+                    except (RuntimeError, OSError) as err:
+                        # Give the track back, the worker carries on
+                        logger.error("Track %i failed %s", track["idx"],
+                            repr(err))
+                        self.call({"cmd": "failed", "album": self.album,
+                            "track": track["idx"], "error": str(err)})
+                        continue
+                    converted += 1
+        except ConnectionError:
+            logger.info("Coordinator has gone")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.sock_fp.close()
+            self.sock.close()
+        logger.info("%s converted %i tracks", self.name, converted)
+        return converted
+
+
+def coordinate(args):
+    """Convert the albums under args.wdir with remote workers"""
+    formats = [fmt for fmt in FORMATS if args.answers.get(fmt)]
+    if not formats:
+        print("Give --ogg and/or --mp3 to say what to convert to")
+        return
+    directories = discover.find_directories(args.wdir)
+    coordinator = Coordinator(directories, formats,
+        do48k=bool(args.answers.get("48k")))
+    coordinator.bind(port=args.port)
+    coordinator.serve()
+
+
+def work(address, work_dir=None):
+    """Run a worker for the coordinator at host[:port]"""
+    host, _, port = address.partition(":")
+    Worker(host, int(port) if port else DEF_PORT, work_dir=work_dir).run()
@@ -0,0 +1,279 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import math
+import functools
+
+import numpy as np
+
+BLOCK = 4096    # Largest block processed in one go
+
+
+@functools.lru_cache()
+def _iir_responses(b, a, block):
+    """Precompute what the filter needs to process a block with numpy.
+    Returns the FFT of the impulse response (the zero state response is a
+    convolution) and, for each past input and output held in the state,
+    the response it causes over a block (the zero input response)"""
+    order = len(a) - 1
+    nfft = 2 * block
+
+    def run(x_hist, y_hist, impulse):
+        # Plain difference equation, only run here, once per filter
+        out = np.zeros(block)
+        for n in range(block):
+            acc = b[0] if (impulse and n == 0) else 0.0
+            for j in range(1, order + 1):
+                if n - j >= 0:
+                    if impulse and n == j:
+                        acc += b[j]
+                    acc -= a[j] * out[n - j]
+                else:
+                    acc += b[j] * x_hist[j - n - 1]
+                    acc -= a[j] * y_hist[j - n - 1]
+            out[n] = acc
+        return out
+
+    zeros = [0.0] * order
+    h = run(zeros, zeros, True)
+    state = np.zeros((block, 2 * order))
+    for k in range(order):
+        unit = [0.0] * order
+        unit[k] = 1.0
+        state[:, k] = run(unit, zeros, False)
+        state[:, order + k] = run(zeros, unit, False)
+    return np.fft.rfft(h, nfft), state
+
+
+class IIRFilter(object):
+    """IIR filter applied to multi-channel blocks with numpy, the filter
+    state is carried from one block to the next so the output is the same
+    as filtering the whole stream in one go"""
+
+    def __init__(self, b, a, channels=2, block=BLOCK):
+        a0 = float(a[0])
+        order = max(len(a), len(b)) - 1
+        b = [x / a0 for x in b] + [0.0] * (order + 1 - len(b))
+        a = [x / a0 for x in a] + [0.0] * (order + 1 - len(a))
+        self.order = order
+        self.block = block
+        self.freq, self.state_resp = _iir_responses(tuple(b), tuple(a),
+            block)
+        self.x_hist = np.zeros((order, channels))   # Most recent first
+        self.y_hist = np.zeros((order, channels))
+
+    def _process(self, x):
+        num = len(x)
+        nfft = 2 * self.block
+        y = np.fft.irfft(np.fft.rfft(x, nfft, axis=0) * self.freq[:, None],
+            nfft, axis=0)[:num]
+        hist = np.concatenate((self.x_hist, self.y_hist))
+        y += np.dot(self.state_resp[:num], hist)
+        order = self.order
+        self.x_hist = np.concatenate((x[::-1], self.x_hist))[:order]
+        self.y_hist = np.concatenate((y[::-1], self.y_hist))[:order]
+        return y
+
+    def process(self, x):
+        """Filter x, an array of (samples, channels)"""
+        if len(x) <= self.block:
+            return self._process(x)
+        return np.concatenate([self._process(x[i:i+self.block])
+            for i in range(0, len(x), self.block)])
+
+
+def biquad_shelf(rate, f0, gain_db, q, vb_exp):
+    """High shelf stage of the BS.1770 K weighting"""
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain_db / 20.0)
+    vb = vh ** vb_exp
+    a0 = 1 + k / q + k * k
+    b = [(vh + vb * k / q + k * k) / a0,
+        2 * (k * k - vh) / a0,
+        (vh - vb * k / q + k * k) / a0]
+    a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return b, a
+
+
+def biquad_highpass(rate, f0, q):
+    """High pass (RLB) stage of the BS.1770 K weighting"""
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    b = [1.0, -2.0, 1.0]
+    a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return b, a
+
+
+def k_weighting(rate):
+    """Return (b, a) of the BS.1770 K weighting filter at any sample
+    rate, both stages combined into one 4th order filter"""
+    b1, a1 = biquad_shelf(rate, 1681.974450955533, 3.999843853973347,
+        0.7071752369554196, 0.4996667741545416)
+    b2, a2 = biquad_highpass(rate, 38.13547087602444, 0.5003270373238773)
+    return list(np.convolve(b1, b2)), list(np.convolve(a1, a2))
+
+
+DEEMPH_F0 = 5283.0      # De-emphasis shelf matching the 50/15us curve
+DEEMPH_GAIN = -9.477
+DEEMPH_SLOPE = 0.4845
+
+
+def deemphasis(rate):
+    """Return (b, a) of the CD de-emphasis filter. A first order bilinear
+    transform of the 50/15us curve is 2dB out near 20kHz, this high shelf
+    biquad is within 0.1dB of it over the audio band"""
+    amp = 10 ** (DEEMPH_GAIN / 40.0)
+    w0 = 2 * math.pi * DEEMPH_F0 / rate
+    cos_w0 = math.cos(w0)
+    alpha = math.sin(w0) / 2 * math.sqrt(
+        (amp + 1 / amp) * (1 / DEEMPH_SLOPE - 1) + 2)
+    sq = 2 * math.sqrt(amp) * alpha
+    a0 = (amp + 1) - (amp - 1) * cos_w0 + sq
+    b = [amp * ((amp + 1) + (amp - 1) * cos_w0 + sq) / a0,
+        -2 * amp * ((amp - 1) + (amp + 1) * cos_w0) / a0,
+        amp * ((amp + 1) + (amp - 1) * cos_w0 - sq) / a0]
+    a = [1.0, 2 * ((amp - 1) - (amp + 1) * cos_w0) / a0,
+        ((amp + 1) - (amp - 1) * cos_w0 - sq) / a0]
+    return b, a
+
+
+def deemphasis_filter(rate, channels=2):
+    """A streaming de-emphasis filter for a pre-emphasised track"""
+    b, a = deemphasis(rate)
+    return IIRFilter(b, a, channels)
+
+
+@functools.lru_cache()
+def _oversample_taps(factor, taps_per_phase):
+    """Windowed sinc interpolation filter split into phases"""
+    num = factor * taps_per_phase
+    n = np.arange(num) - (num - 1) / 2.0
+    h = np.sinc(n / factor) * np.kaiser(num, 8.0)
+    h *= factor / h.sum()
+    return h.reshape(taps_per_phase, factor).T.copy()
+
+
+class TruePeak(object):
+    """Estimate the true (inter-sample) peak by oversampling"""
+
+    def __init__(self, channels=2, factor=4, taps_per_phase=12):
+        self.phases = _oversample_taps(factor, taps_per_phase)
+        self.tail = np.zeros((taps_per_phase - 1, channels))
+        self.peak = 0.0
+
+    def process(self, x):
+        """Update the peak with x, an array of (samples, channels)"""
+        taps = self.phases.shape[1]
+        xx = np.concatenate((self.tail, x))
+        self.tail = xx[len(xx) - (taps - 1):]
+        if len(xx) < taps:
+            return self.peak
+        for chan in xx.T:
+            for phase in self.phases:
+                out = np.convolve(chan, phase, "valid")
+                self.peak = max(self.peak, float(np.abs(out).max()))
+        return self.peak
+
+
+RESAMPLE_TAPS = 96      # Filter taps per output sample
+RESAMPLE_BETA = 9.0     # Kaiser window, about 90dB of stop band
+RESAMPLE_CUTOFF = 0.955     # Of the lower Nyquist frequency
+
+
+@functools.lru_cache()
+def _resample_phases(up, down, taps, beta, cutoff):
+    """Design the low pass filter for resampling by up/down once, split
+    into its polyphase parts. Returns the filter of each output phase
+    and the delay of the filter in output samples"""
+    num = up * taps
+    delay = (num - 1) // 2 // down
+    centre = delay * down   # So the delay is whole output samples
+    n = np.arange(num) - centre
+    fc = cutoff * min(1.0, float(up) / down)
+    x = np.clip(n / float(centre), -1.0, 1.0)
+    window = np.i0(beta * np.sqrt(1.0 - x * x)) / np.i0(beta)
+    window[np.abs(n) > centre] = 0.0
+    h = fc * np.sinc(fc * n / up) * window
+    h *= up / h.sum()
+    phases = np.empty((up, taps))
+    starts = np.empty(up, dtype=int)
+    for j in range(up):
+        p = (j * down) % up
+        # Coefficient i weighs input floor(j*down/up) + i of the group
+        phases[j] = h[p + (taps - 1 - np.arange(taps)) * up]
+        starts[j] = (j * down) // up
+    return phases, starts, delay
+
+
+class Resampler(object):
+    """Polyphase resampler, e.g. 44.1kHz to 48kHz is up 160 down 147. The
+    output is processed a group of up samples at a time (one per phase)
+    for as many groups as the block holds. Being a filter of the stream,
+    flush() gives the samples still held once the input has ended"""
+
+    def __init__(self, rate, out_rate, channels=2, dither=True, seed=None):
+        gcd = math.gcd(rate, out_rate)
+        self.up = out_rate // gcd
+        self.down = rate // gcd
+        self.out_rate = out_rate
+        self.phases, self.starts, self.delay = _resample_phases(self.up,
+            self.down, RESAMPLE_TAPS, RESAMPLE_BETA, RESAMPLE_CUTOFF)
+        taps = self.phases.shape[1]
+        self.buf = np.zeros((taps - 1, channels))
+        self.skip = self.delay      # Outputs before the first real one
+        self.samples_in = 0
+        self.samples_out = 0
+        self.rng = np.random.default_rng(seed) if dither else None
+
+    def _run(self, x):
+        up, down = self.up, self.down
+        taps = self.phases.shape[1]
+        buf = np.ascontiguousarray(np.concatenate((self.buf, x)))
+        groups = (len(buf) - taps + 1) // down
+        if groups <= 0:
+            self.buf = buf
+            return np.zeros((0, buf.shape[1]))
+        out = np.empty((groups, up, buf.shape[1]))
+        step, chan = buf.strides
+        for j in range(up):
+            view = np.lib.stride_tricks.as_strided(buf[self.starts[j]:],
+                shape=(groups, buf.shape[1], taps),
+                strides=(down * step, chan, step))
+            out[:, j, :] = np.dot(view, self.phases[j])
+        self.buf = buf[groups * down:]
+        out = out.reshape(-1, buf.shape[1])
+        if self.skip:
+            skipped = min(self.skip, len(out))
+            out = out[skipped:]
+            self.skip -= skipped
+        return out
+
+    def _finish(self, y):
+        if self.rng is not None and len(y):
+            # TPDF dither of one 16 bit LSB peak to peak each side
+            lsb = 1.0 / 32768.0
+            y = y + (self.rng.random(y.shape) - self.rng.random(y.shape)) * lsb
+        self.samples_out += len(y)
+        return y
+
+    def process(self, x):
+        """Resample x, an array of (samples, channels)"""
+        self.samples_in += len(x)
+        return self._finish(self._run(x))
+
+    def flush(self):
+        """The rest of the output once the input has ended"""
+        wanted = -(-self.samples_in * self.up // self.down) - self.samples_out
+        pad = np.zeros((self.phases.shape[1] + self.down * (self.delay //
+            self.up + 2), self.buf.shape[1]))
+        return self._finish(self._run(pad)[:max(wanted, 0)])
+
+
+def resampler(out_rate, rate, channels=2):
+    """A streaming resampler to out_rate, e.g. for the 48k outputs"""
+    if rate == out_rate:
+        return None
+    return Resampler(rate, out_rate, channels)
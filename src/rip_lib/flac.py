@@ -0,0 +1,203 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Edit the metadata blocks of a FLAC file. The blocks are written into
+the space the old ones and the padding took, so the audio frames are not
+moved unless the padding has run out"""
+
+import os
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+STREAMINFO = 0
+PADDING = 1
+APPLICATION = 2
+SEEKTABLE = 3
+VORBIS_COMMENT = 4
+CUESHEET = 5
+PICTURE = 6
+
+PADDING_SIZE = 64 * 1024    # Room left for tags and cover art
+MAX_BLOCK = (1 << 24) - 1
+LAST = 0x80
+VENDOR = "rip_lib"
+
+
+def read_blocks(in_fp):
+    """Return the [block_type, data] metadata blocks and the offset of the
+    first audio frame"""
+    in_fp.seek(0)
+    if in_fp.read(4) != b"fLaC":
+        raise ValueError("Not a FLAC file")
+    blocks = []
+    while 1:
+        header = in_fp.read(4)
+        if len(header) < 4:
+            raise ValueError("Truncated FLAC metadata")
+        size = struct.unpack(">I", b"\0" + header[1:])[0]
+        data = in_fp.read(size)
+        if len(data) < size:
+            raise ValueError("Truncated FLAC metadata")
+        blocks.append([header[0] & 0x7F, data])
+        if header[0] & LAST:
+            break
+    return blocks, in_fp.tell()
+
+
+def pack_blocks(blocks):
+    parts = []
+    for num, (block_type, data) in enumerate(blocks):
+        if len(data) > MAX_BLOCK:
+            raise ValueError("FLAC metadata block too big")
+        flags = LAST if num == len(blocks) - 1 else 0
+        parts.append(bytes([flags | block_type]))
+        parts.append(struct.pack(">I", len(data))[1:])
+        parts.append(data)
+    return b"".join(parts)
+
+
+def unpack_comments(data):
+    """The vendor string and the (name, value) list of a VORBIS_COMMENT"""
+    size = struct.unpack("<I", data[:4])[0]
+    vendor = data[4:4 + size].decode("utf-8", "replace")
+    pos = 4 + size
+    count = struct.unpack("<I", data[pos:pos + 4])[0]
+    pos += 4
+    comments = []
+    for i in range(count):
+        size = struct.unpack("<I", data[pos:pos + 4])[0]
+        text = data[pos + 4:pos + 4 + size].decode("utf-8", "replace")
+        pos += 4 + size
+        name, _, value = text.partition("=")
+        comments.append((name, value))
+    return vendor, comments
+
+
+def pack_comments(vendor, comments):
+    vendor = vendor.encode("utf-8")
+    parts = [struct.pack("<I", len(vendor)), vendor,
+        struct.pack("<I", len(comments))]
+    for name, value in comments:
+        text = "{}={}".format(name, value).encode("utf-8")
+        parts.append(struct.pack("<I", len(text)))
+        parts.append(text)
+    return b"".join(parts)
+
+
+def picture(image, mimetype, width, height, depth, description="coverart",
+    picture_type=3
+):
+    """The body of a PICTURE block, type 3 is the front cover"""
+    mimetype = mimetype.encode("ascii")
+    description = description.encode("utf-8")
+    return b"".join([
+        struct.pack(">II", picture_type, len(mimetype)), mimetype,
+        struct.pack(">I", len(description)), description,
+        struct.pack(">IIIII", width, height, depth, 0, len(image)), image
+    ])
+
+
+class Metadata(object):
+    """The metadata blocks of a FLAC file, changed in memory then written
+    back with save()"""
+
+    def __init__(self, flac_file):
+        self.flac_file = flac_file
+        with open(flac_file, "rb") as in_fp:
+            blocks, self.audio_offset = read_blocks(in_fp)
+        self.blocks = [x for x in blocks if x[0] != PADDING]
+
+    def find(self, block_type):
+        return [x for x in self.blocks if x[0] == block_type]
+
+    def comments(self):
+        found = self.find(VORBIS_COMMENT)
+        if not found:
+            return []
+        return unpack_comments(found[0][1])[1]
+
+    def set_comments(self, comments):
+        found = self.find(VORBIS_COMMENT)
+        vendor = unpack_comments(found[0][1])[0] if found else VENDOR
+        self.set_block(VORBIS_COMMENT, pack_comments(vendor, comments))
+
+    def update_comments(self, new_comments):
+        """Set the comments, replacing any existing ones with the same
+        names"""
+        names = set([name.upper() for name, _ in new_comments])
+        self.set_comments([(name, value) for name, value in self.comments()
+            if name.upper() not in names] + list(new_comments))
+
+    def set_block(self, block_type, data):
+        """Replace the blocks of the type (e.g. CUESHEET) with one holding
+        data"""
+        for num, block in enumerate(self.blocks):
+            if block[0] == block_type:
+                block[1] = data
+                self.blocks = self.blocks[:num + 1] + [x for x in
+                    self.blocks[num + 1:] if x[0] != block_type]
+                return
+        self.blocks.append([block_type, data])
+
+    def add_picture(self, data):
+        """Add a PICTURE block, replacing one of the same picture type"""
+        picture_type = data[:4]
+        self.blocks = [x for x in self.blocks if x[0] != PICTURE or
+            x[1][:4] != picture_type]
+        self.blocks.append([PICTURE, data])
+
+    def save(self):
+        """Write the blocks back, in place if they fit in the space of the
+        old metadata, else rewrite the file with fresh padding. Returns
+        True if written in place"""
+        room = self.audio_offset - 4
+        size = len(pack_blocks(self.blocks))
+        if size == room or size + 4 <= room:
+            blocks = self.blocks
+            if size < room:
+                blocks = blocks + [[PADDING, bytes(room - size - 4)]]
+            with open(self.flac_file, "r+b") as out_fp:
+                out_fp.seek(4)
+                out_fp.write(pack_blocks(blocks))
+            return True
+        logger.info("No room for the metadata of %s, rewriting it",
+            self.flac_file)
+        blocks = self.blocks + [[PADDING, bytes(PADDING_SIZE)]]
+        data = pack_blocks(blocks)
+        head, tail = os.path.split(self.flac_file)
+        temp_file = os.path.join(head, "temp." + tail)
+        try:
+            with open(self.flac_file, "rb") as in_fp, \
+                    open(temp_file, "wb") as out_fp:
+                out_fp.write(b"fLaC")
+                out_fp.write(data)
+                in_fp.seek(self.audio_offset)
+                while 1:
+                    chunk = in_fp.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    out_fp.write(chunk)
+            os.rename(temp_file, self.flac_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+        self.audio_offset = 4 + len(data)
+        return False
+
+
+def read_comments(flac_file):
+    """Return the list of (name, value) comments in the flac file"""
+    return Metadata(flac_file).comments()
+
+
+def update_comments(flac_file, new_comments):
+    """Set the comments, replacing any existing ones with the same names"""
+    metadata = Metadata(flac_file)
+    metadata.update_comments(new_comments)
+    return metadata.save()
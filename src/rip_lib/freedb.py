@@ -7,6 +7,7 @@
 
 import os
 import socket
+import threading
 import urllib.request
 import urllib.parse
 import functools
@@ -15,6 +16,8 @@ import time
 
 logger = logging.getLogger(__name__)
 
+import rip_lib.rank as rank
+
 #DEF_SERVER = 'http://freedb.freedb.org/~cddb/cddb.cgi'
 DEF_SERVER = 'http://freedb.musicbrainz.org/~cddb/cddb.cgi'
 
@@ -22,6 +25,11 @@ CLIENT_NAME = 'CDDB.py'
 CLIENT_VER = 1.4
 CDDB_PROTO = 5
 
+CDDBP_PORT = 8888       # Native CDDB protocol port on the same host
+CDDBP_TIMEOUT = 10
+use_cddbp = True        # Try CDDBP before falling back to HTTP
+INEXACT_COST = 1.0      # Rank cost of a fuzzy match
+
 
 def split_on_slash(value):
     """Split on hash"""
@@ -90,7 +98,7 @@ def get_proto_str(proto_ver=CDDB_PROTO):
     return "proto={}".format(proto_ver)
 
 
-def get_query_str(disc_info):
+def get_query_cmd(disc_info):
     """disc_info is an object that should contain following methods:
        - disc_id, num_tracks, disc_len and tracks.
        tracks should be a list of track objects each containing following:
@@ -101,16 +109,30 @@ def get_query_str(disc_info):
     for track in disc_info.tracks:
         parts.append(str(track.offset))
     parts.append(str(disc_info.calc_disc_len_in_secs()))
-    return "cmd=cddb+query+{}".format(
-        urllib.parse.quote_plus(" ".join(parts))
-    )
+    return "cddb query {}".format(" ".join(parts))
+
+
+def get_query_str(disc_info):
+    """The query command as a HTTP query string"""
+    return "cmd=" + urllib.parse.quote_plus(get_query_cmd(disc_info))
+
+
+def get_read_cmd(disc_info, disc_id):
+    """Return the command to send to server to read disc info"""
+    return "cddb read {} {}".format(disc_info.category, disc_id)
 
 
 def get_read_str(disc_info, disc_id):
-    """Return the string to send to server to read disc info"""
-    return "cmd=cddb+read+{}+{}".format(
-        disc_info.category, disc_id
-    )
+    """The read command as a HTTP query string"""
+    return "cmd=" + urllib.parse.quote_plus(get_read_cmd(disc_info, disc_id))
+
+
+def decode_line(line):
+    try:
+        line = line.decode("utf-8")
+    except UnicodeDecodeError:
+        line = line.decode("iso-8859-1")
+    return line.strip()
 
 
 def perform_request(server_url, query_str, hello_str, proto_str):
@@ -136,19 +158,127 @@ def perform_request(server_url, query_str, hello_str, proto_str):
         response = None
 
     if response:
-        lines = []
-        for line in response.readlines():
-            try:
-                line = line.decode("utf-8")
-            except UnicodeDecodeError:
-                line = line.decode("iso-8859-1")
-            line = line.strip()
-            lines.append(line)
+        lines = [decode_line(line) for line in response.readlines()]
         response.close()
         return lines
     return None
 
 
+class CddbpSession(object):
+    """A CDDBP connection, the handshake is done once and then any number
+    of commands are sent over it. Replies are returned as the same lines
+    the HTTP interface gives"""
+
+    def __init__(self, host, port=None, timeout=CDDBP_TIMEOUT):
+        self.sock = socket.create_connection((host, port or CDDBP_PORT),
+            timeout)
+        self.sock_fp = self.sock.makefile("rb")
+        try:
+            banner = self._read_reply()
+            if banner[0][:3] not in ("200", "201"):
+                raise ConnectionError("Refused: " + banner[0])
+            # Send hello and proto together rather than waiting for each
+            hello = "cddb hello {} {} {} {}".format(get_username(),
+                get_hostname(), CLIENT_NAME, CLIENT_VER)
+            replies = self.commands([hello, "proto {}".format(CDDB_PROTO)])
+            if replies[0][0][:3] not in ("200", "402"):
+                raise ConnectionError("Hello failed: " + replies[0][0])
+            if replies[1][0][:3] not in ("201", "502"):
+                raise ConnectionError("Proto failed: " + replies[1][0])
+        except:
+            self.close()
+            raise
+
+    def _read_line(self):
+        line = self.sock_fp.readline()
+        if not line:
+            raise ConnectionError("CDDBP server closed the connection")
+        return decode_line(line)
+
+    def _read_reply(self):
+        """A status line, and if its code is x1x, the lines that follow
+        up to the terminating '.'"""
+        lines = [self._read_line()]
+        if lines[0][1:2] == "1":
+            while 1:
+                line = self._read_line()
+                lines.append(line)
+                if line == ".":
+                    break
+        return lines
+
+    def commands(self, cmds):
+        """Send the commands in one go then read each reply in turn"""
+        for cmd in cmds:
+            logger.debug("CDDBP %s", cmd)
+        data = "".join([cmd + "\r\n" for cmd in cmds])
+        self.sock.sendall(data.encode("utf-8"))
+        return [self._read_reply() for cmd in cmds]
+
+    def command(self, cmd):
+        return self.commands([cmd])[0]
+
+    def close(self):
+        try:
+            self.sock.sendall(b"quit\r\n")
+        except OSError:
+            pass
+        self.sock_fp.close()
+        self.sock.close()
+
+
+_sessions = {}      # Open sessions by host, kept for the next disc
+_no_cddbp = set()   # Hosts where CDDBP failed
+_lock = threading.Lock()    # Discs may be looked up from several threads
+
+
+def cddbp_session(server_url):
+    """The open CDDBP session to the host of server_url, or None if the
+    server does not talk CDDBP"""
+    host = urllib.parse.urlparse(server_url).hostname
+    if not use_cddbp or not host or host in _no_cddbp:
+        return None
+    session = _sessions.get(host)
+    if session is None:
+        try:
+            session = _sessions[host] = CddbpSession(host)
+        except OSError as err:
+            logger.info("No CDDBP on %s (%s), using HTTP", host, repr(err))
+            _no_cddbp.add(host)
+            return None
+    return session
+
+
+def close_sessions():
+    """Close the CDDBP sessions, e.g. at the end of a batch of discs"""
+    with _lock:
+        while _sessions:
+            _sessions.popitem()[1].close()
+
+
+def cddb_request(server_url, cmd):
+    """Send a CDDB command, over CDDBP if possible else over HTTP"""
+    with _lock:
+        session = cddbp_session(server_url)
+        if session:
+            try:
+                return session.command(cmd)
+            except OSError as err:
+                # Dropped, maybe timed out while idle, so try a new one
+                logger.info("CDDBP session lost %s", repr(err))
+                host = urllib.parse.urlparse(server_url).hostname
+                _sessions.pop(host).close()
+                session = cddbp_session(server_url)
+                if session:
+                    try:
+                        return session.command(cmd)
+                    except OSError:
+                        _sessions.pop(host).close()
+    return perform_request(server_url,
+        "cmd=" + urllib.parse.quote_plus(cmd),
+        get_hello_str(), get_proto_str())
+
+
 class CddbEntry(object):
     """Hold a CBBD entry"""
 
@@ -165,8 +295,7 @@ class CddbEntry(object):
 
 def query_cddb(disc_info, server_url=DEF_SERVER):
     """Query the CDDB server"""
-    lines = perform_request(server_url, get_query_str(disc_info),
-                            get_hello_str(), get_proto_str())
+    lines = cddb_request(server_url, get_query_cmd(disc_info))
     if lines is None:
         return None
     # Four elements in header: status, category, disc-id, title
@@ -197,29 +326,19 @@ def query_cddb(disc_info, server_url=DEF_SERVER):
     else:
         logger.error("Error code %i received", status_code)
         logger.error("Header = '%s'", header)
-    if possible_discs is None:
-        return None
-
-    for i, entry in enumerate(possible_discs):
-        print("[{}]\t{}\t{}".format(i, entry.category, entry.name()))
-
-    if len(possible_discs) > 1:
-        selection = input("Select an entry [default=0]?")
-        selection = 0 if selection == "" else int(selection)
-    else:
-        selection = 0
-    return possible_discs[selection]
+    candidates = []
+    for entry in possible_discs:
+        # An inexact match may be another pressing with other track times
+        cost = 0.0 if status_code != 211 else INEXACT_COST
+        candidates.append(rank.Candidate(entry, cost, "{}\t{}".format(
+            entry.category, entry.name()), entry.name().lower()))
+    return rank.choose(candidates)
 
 
 def read_cddb_metadata(disc_info, disc_id, server_url=DEF_SERVER):
     """Read Metadata from the CBBD server"""
     assert disc_info.category
-    lines = perform_request(
-        server_url,
-        get_read_str(disc_info, disc_id),
-        get_hello_str(),
-        get_proto_str()
-    )
+    lines = cddb_request(server_url, get_read_cmd(disc_info, disc_id))
     if lines is None:
         return None
 
@@ -0,0 +1,353 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+PADDING = 4096      # Room left in a new tag so later edits fit in place
+
+ID3V1_FIELDS = (
+    # Frame, offset, length
+    ("TIT2", 3, 30),
+    ("TPE1", 33, 30),
+    ("TALB", 63, 30),
+)
+
+V23_RENAMED = {"TORY": "TDOR", "IPLS": "TIPL"}
+V23_DROPPED = ("TYER", "TDAT", "TIME", "TRDA", "TSIZ", "EQUA", "RVAD")
+
+
+def syncsafe(data):
+    """Decode a 4 byte syncsafe integer"""
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 7) | (byte & 0x7F)
+    return value
+
+
+def decode_text(data):
+    """Decode the body of a text frame"""
+    encoding, data = data[0], data[1:]
+    if encoding == 0:
+        text = data.decode("iso-8859-1")
+    elif encoding == 1:
+        text = data.decode("utf-16")
+    elif encoding == 2:
+        text = data.decode("utf-16-be")
+    else:
+        text = data.decode("utf-8")
+    # v2.4 can hold several values separated by nulls
+    return text.rstrip("\x00").split("\x00")[0]
+
+
+def to_syncsafe(value):
+    """Encode a 4 byte syncsafe integer"""
+    return bytes(bytearray([(value >> shift) & 0x7F
+        for shift in (21, 14, 7, 0)]))
+
+
+def unsync(data):
+    """Undo unsynchronisation"""
+    return data.replace(b"\xff\x00", b"\xff")
+
+
+def decode_frame(major, flags, body):
+    """Undo what the frame format flags say was done to the body, return
+    None if it cannot be"""
+    if major == 4:
+        if flags & 0x04:
+            return None     # Encrypted
+        if flags & 0x40:
+            body = body[1:]     # Group id
+        if flags & 0x01:
+            body = body[4:]     # Data length indicator
+        if flags & 0x02:
+            body = unsync(body)
+        compressed = flags & 0x08
+    else:
+        if flags & 0x40:
+            return None     # Encrypted
+        compressed = flags & 0x80
+        if compressed:
+            body = body[4:]     # Decompressed size
+        if flags & 0x20:
+            body = body[1:]     # Group id
+    if compressed:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            return None
+    return body
+
+
+def read_frames(in_fp):
+    """Return the ID3v2 version, the raw (frame_id, body) frames and the
+    size of the whole tag, or None if there is no tag. Compressed and
+    unsynchronised frames are decoded, frames that should not outlive an
+    edit of the tag are dropped"""
+    in_fp.seek(0)
+    header = in_fp.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return None
+    major = bytearray(header)[3]
+    flags = bytearray(header)[5]
+    size = syncsafe(header[6:10])
+    data = in_fp.read(size)
+    if major == 4 and flags & 0x10:
+        size += 10  # Footer
+    if major not in (3, 4):
+        logger.warning("ID3v2.%i tag not supported, dropping it", major)
+        return major, [], size + 10
+    if flags & 0x80 and major < 4:
+        # Undo unsynchronisation of the whole tag
+        data = unsync(data)
+    pos = 0
+    if flags & 0x40:
+        # Skip the extended header
+        if major == 4:
+            pos = syncsafe(data[:4])
+        else:
+            pos = struct.unpack(">I", data[:4])[0] + 4
+    frames = []
+    while pos + 10 <= len(data):
+        frame_id = data[pos:pos+4]
+        if frame_id[0:1] == b"\x00":
+            break   # Padding
+        status, format_flags = bytearray(data[pos+8:pos+10])
+        if major == 4:
+            frame_size = syncsafe(data[pos+4:pos+8])
+            if flags & 0x80:
+                format_flags |= 0x02    # The whole tag is unsynchronised
+            discard = status & 0x40
+        else:
+            frame_size = struct.unpack(">I", data[pos+4:pos+8])[0]
+            discard = status & 0x80
+        body = data[pos+10:pos+10+frame_size]
+        pos += 10 + frame_size
+        frame_id = frame_id.decode("ascii", "replace")
+        if discard:
+            logger.debug("Dropping frame %s as the tag is altered", frame_id)
+            continue
+        body = decode_frame(major, format_flags, body)
+        if body is None:
+            logger.warning("Dropping frame %s", frame_id)
+            continue
+        frames.append((frame_id, body))
+    return major, frames, size + 10
+
+
+def read_id3v2(in_fp):
+    """Return the text frames of the ID3v2 tag as a dictionary, or None
+    if there is no tag"""
+    tag = read_frames(in_fp)
+    if tag is None:
+        return None
+    frames = {}
+    for frame_id, body in tag[1]:
+        if frame_id.startswith("T") and frame_id != "TXXX" and body:
+            try:
+                frames[frame_id] = decode_text(body)
+            except UnicodeDecodeError:
+                logger.warning("Bad text in frame %s", frame_id)
+    return frames
+
+
+def read_id3v1(in_fp):
+    """Return the fields of the ID3v1 tag as text frames, or None if
+    there is no tag"""
+    try:
+        in_fp.seek(-128, 2)
+    except OSError:
+        return None
+    data = in_fp.read(128)
+    if data[:3] != b"TAG":
+        return None
+    frames = {}
+    for frame_id, offset, length in ID3V1_FIELDS:
+        value = data[offset:offset+length].split(b"\x00")[0]
+        frames[frame_id] = value.decode("iso-8859-1").strip()
+    if data[125:126] == b"\x00" and data[126:127] != b"\x00":
+        frames["TRCK"] = str(bytearray(data)[126])
+    return frames
+
+
+def read_tags(filename):
+    """Return the text frames of the MP3, from the ID3v2 tag if there is
+    one, else from the ID3v1 tag"""
+    with open(filename, "rb") as in_fp:
+        frames = read_id3v2(in_fp)
+        if frames is None:
+            frames = read_id3v1(in_fp)
+    return frames or {}
+
+
+def text_frame(frame_id, text):
+    """A UTF-8 text frame"""
+    return frame_id, b"\x03" + text.encode("utf-8")
+
+
+def txxx_frame(description, value):
+    """A UTF-8 user defined text frame"""
+    return "TXXX", b"\x03" + description.encode("utf-8") + b"\x00" + \
+        value.encode("utf-8")
+
+
+def frame_key(frame_id, body):
+    """Frames with the same key replace each other, for TXXX frames the
+    description is part of the key"""
+    if frame_id != "TXXX":
+        return frame_id
+    try:
+        if bytearray(body)[0] in (1, 2):
+            text = body[1:].decode("utf-16" if body[0] == 1 else "utf-16-be")
+        else:
+            text = body[1:].decode("utf-8")
+    except UnicodeDecodeError:
+        return frame_id, body
+    return frame_id, text.split("\x00")[0].upper()
+
+
+def apic_frame(image, mimetype="image/jpeg", description="",
+    picture_type=3
+):
+    """An attached picture frame, type 3 is the front cover"""
+    return "APIC", b"\x03" + mimetype.encode("ascii") + b"\x00" + \
+        bytes([picture_type]) + description.encode("utf-8") + b"\x00" + image
+
+
+def build_tag(frames, padding=PADDING):
+    """An ID3v2.4 tag holding frames followed by padding"""
+    parts = []
+    for frame_id, body in frames:
+        parts.append(frame_id.encode("ascii"))
+        parts.append(to_syncsafe(len(body)))
+        parts.append(b"\x00\x00")
+        parts.append(body)
+    parts.append(bytes(padding))
+    data = b"".join(parts)
+    return b"ID3\x04\x00\x00" + to_syncsafe(len(data)) + data
+
+
+def upgrade_frames(major, frames):
+    """Convert the frames of an ID3v2.3 tag to their v2.4 equivalents, the
+    year, date and time become TDRC and frames v2.4 does not have are
+    dropped"""
+    if major != 3:
+        return list(frames)
+    texts = {}
+    result = []
+    for frame_id, body in frames:
+        if frame_id in V23_DROPPED:
+            if frame_id in ("TYER", "TDAT", "TIME") and body:
+                try:
+                    texts[frame_id] = decode_text(body).strip()
+                except UnicodeDecodeError:
+                    logger.warning("Bad text in frame %s", frame_id)
+            continue
+        result.append((V23_RENAMED.get(frame_id, frame_id), body))
+    stamp = texts.get("TYER", "")
+    date = texts.get("TDAT", "")
+    if len(stamp) == 4 and len(date) == 4:
+        stamp += "-{}-{}".format(date[2:], date[:2])
+        clock = texts.get("TIME", "")
+        if len(clock) == 4:
+            stamp += "T{}:{}".format(clock[:2], clock[2:])
+    if stamp:
+        result.append(text_frame("TDRC", stamp))
+    return result
+
+
+def id3v1_tag(frames, old):
+    """The 128 byte ID3v1 tag old with the title, artist, album and track
+    taken from frames"""
+    data = bytearray(old)
+    texts = {}
+    for frame_id, body in frames:
+        if frame_id.startswith("T") and frame_id != "TXXX" and body:
+            try:
+                texts[frame_id] = decode_text(body)
+            except UnicodeDecodeError:
+                pass
+    for frame_id, offset, length in ID3V1_FIELDS:
+        if frame_id in texts:
+            value = texts[frame_id].encode("iso-8859-1", "replace")
+            data[offset:offset+length] = value[:length].ljust(length,
+                b"\x00")
+    track = texts.get("TRCK", "").split("/")[0]
+    if track.isdigit() and 0 < int(track) < 256:
+        data[125] = 0
+        data[126] = int(track)
+    return bytes(data)
+
+
+def update_id3v1(filename, frames):
+    """Rewrite the ID3v1 tag at the end of the file, if it has one, so it
+    does not contradict frames"""
+    with open(filename, "r+b") as out_fp:
+        try:
+            out_fp.seek(-128, 2)
+        except OSError:
+            return
+        old = out_fp.read(128)
+        if old[:3] != b"TAG":
+            return
+        out_fp.seek(-128, 2)
+        out_fp.write(id3v1_tag(frames, old))
+
+
+def write_frames(filename, frames, tag=None):
+    """Replace the ID3v2 tag of the file with one holding frames. If the
+    new tag fits in the space of the old one it is written in place,
+    else the file is rewritten with a padded tag. tag is what read_frames
+    gave, if already read. An ID3v1 tag is updated to match"""
+    update_id3v1(filename, frames)
+    if tag is None:
+        with open(filename, "rb") as in_fp:
+            tag = read_frames(in_fp)
+    old_size = tag[2] if tag else 0
+    size = len(build_tag(frames, 0))
+    if size <= old_size:
+        with open(filename, "r+b") as out_fp:
+            out_fp.write(build_tag(frames, old_size - size))
+        return True
+    with open(filename, "rb") as in_fp:
+        in_fp.seek(old_size)
+        temp_file = filename + ".tmp"
+        with open(temp_file, "wb") as out_fp:
+            out_fp.write(build_tag(frames))
+            while 1:
+                data = in_fp.read(1 << 20)
+                if not data:
+                    break
+                out_fp.write(data)
+    os.rename(temp_file, filename)
+    return False
+
+
+def update_frames(filename, new_frames):
+    """Add frames to the ID3v2 tag, replacing any with the same key"""
+    with open(filename, "rb") as in_fp:
+        tag = read_frames(in_fp)
+    frames = upgrade_frames(tag[0], tag[1]) if tag else []
+    keys = set([frame_key(*frame) for frame in new_frames])
+    frames = [frame for frame in frames if frame_key(*frame) not in keys]
+    return write_frames(filename, frames + list(new_frames), tag)
+
+
+def update_album(tracks, shared=()):
+    """Update the tags of a whole album, tracks is a list of (filename,
+    frames) and the shared frames (e.g. the cover APIC) go in every file.
+    Returns the number of files written in place"""
+    in_place = 0
+    for filename, frames in tracks:
+        if update_frames(filename, list(frames) + list(shared)):
+            in_place += 1
+    return in_place
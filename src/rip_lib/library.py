@@ -0,0 +1,208 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import fcntl
+import pickle
+import subprocess
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.discover as discover
+import rip_lib.freedb as cddb
+import rip_lib.musicbrainz as musz
+import rip_lib.chunks as chunks
+
+INDEX_FILE = ".rip_index"
+PICKLE_FILE = "pickle.info"
+FLAC_FILE = "disc.flac"
+FLAC_EXE = "flac"
+
+
+def disc_ids(info):
+    """The musicbrainz and freedb disc IDs and the track offsets"""
+    return (
+        musz.musicbrainz_disc_id(info),
+        cddb.freedb_disc_id(info),
+        tuple([track.offset for track in info.tracks])
+    )
+
+
+class LibraryIndex(object):
+    """Index of every archived album in the library, keyed by album
+    directory. Each entry holds the disc IDs computed from the TOC in
+    the album's pickle.info.
+
+    Several processes may share the index (e.g. the daemon and a verify
+    run), so only the entries marked as changed are written back, merged
+    into what is on disk under a lock"""
+
+    def __init__(self, root):
+        self.root = root
+        self.filename = os.path.join(root, INDEX_FILE)
+        self.albums = {}
+        self.changed = {}   # Album directory to the entry keys changed
+        self.removed = set()
+        self.dirs = {}      # The directories scanned, see discover
+        self.load()
+
+    def _read(self):
+        try:
+            with open(self.filename, "rb") as pkl_fd:
+                return pickle.load(pkl_fd)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def load(self):
+        self.albums = self._read()
+
+    def mark(self, album_dir, *keys):
+        """Note that keys of the entry of album_dir have changed"""
+        self.changed.setdefault(album_dir, set()).update(keys)
+        self.removed.discard(album_dir)
+
+    def save(self):
+        """Write the changes back, picking up those of other processes"""
+        if not self.changed and not self.removed:
+            return
+        with open(self.filename + ".lock", "w") as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            albums = self._read()
+            for album_dir in self.removed:
+                albums.pop(album_dir, None)
+            for album_dir, keys in self.changed.items():
+                entry = albums.setdefault(album_dir, {})
+                for key in keys:
+                    entry[key] = self.albums[album_dir][key]
+            temp_file = self.filename + ".tmp"
+            with open(temp_file, "wb") as pkl_fd:
+                pickle.dump(albums, pkl_fd)
+            os.rename(temp_file, self.filename)
+        self.albums = albums
+        self.changed = {}
+        self.removed = set()
+
+    def update(self):
+        """Bring the index up to date, only directories that have changed
+        are listed again and only albums whose pickle.info has changed
+        are loaded"""
+        found = set()
+        for album_dir in discover.find_directories(self.root, self.dirs):
+            album_dir = os.path.abspath(album_dir)
+            found.add(album_dir)
+            pkl_file = os.path.join(album_dir, PICKLE_FILE)
+            mtime = os.path.getmtime(pkl_file)
+            entry = self.albums.get(album_dir)
+            if entry and entry["mtime"] == mtime:
+                continue
+            try:
+                with open(pkl_file, "rb") as pkl_fd:
+                    info = pickle.load(pkl_fd)
+                mb_id, freedb_id, offsets = disc_ids(info)
+            except Exception as err:
+                logger.error("Bad %s %s", pkl_file, repr(err))
+                continue
+            logger.debug("Indexed %s", album_dir)
+            entry = entry or {}
+            fields = {
+                "mtime": mtime,
+                "mb_id": mb_id,
+                "freedb_id": freedb_id,
+                "offsets": offsets,
+                "title": info.title,
+                "selected": getattr(info, "selected", None)
+            }
+            entry.update(fields)
+            self.albums[album_dir] = entry
+            self.mark(album_dir, *fields)
+        for album_dir in list(self.albums):
+            if album_dir not in found:
+                del self.albums[album_dir]
+                self.changed.pop(album_dir, None)
+                self.removed.add(album_dir)
+        self.save()
+
+    def lookup(self, info):
+        """Return the album directories holding this disc, matched on the
+        musicbrainz disc ID, or on the freedb disc ID and the offsets"""
+        mb_id, freedb_id, offsets = disc_ids(info)
+        matches = []
+        for album_dir, entry in sorted(self.albums.items()):
+            if entry["mb_id"] == mb_id or (entry["freedb_id"] == freedb_id
+                    and entry["offsets"] == offsets):
+                matches.append(album_dir)
+        return matches
+
+
+_indexes = {}
+
+
+def open_index(root):
+    """The up to date index of the library, the index is kept in memory so
+    a long running process only rescans for changed albums"""
+    root = os.path.abspath(root)
+    index = _indexes.get(root)
+    if index is None:
+        index = _indexes[root] = LibraryIndex(root)
+    index.update()
+    return index
+
+
+def verify_track(flac_file, info, num):
+    """Decode one track of the archive, it is good if it decodes without
+    error to the expected number of samples"""
+    first, last = chunks.track_span(info, num)
+    args = [
+        FLAC_EXE, "-d", "-s", "-c",
+        "--force-raw-format", "--endian=little", "--sign=signed",
+        "--skip={}".format(first * chunks.SAMPLES_PER_SECTOR),
+        "--until={}".format((last + 1) * chunks.SAMPLES_PER_SECTOR),
+        flac_file
+    ]
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        logger.error("Check %s is installed", args[0])
+        return False
+    size = 0
+    while 1:
+        data = proc.stdout.read(1 << 20)
+        if not data:
+            break
+        size += len(data)
+    proc.stdout.close()
+    expected = (last - first + 1) * chunks.SECTOR_SIZE
+    if proc.wait() != 0 or size != expected:
+        logger.warning("Track %i failed verification", num)
+        return False
+    return True
+
+
+def verify_tracks(album_dir, info, tracks=None):
+    """Return the track numbers that fail verification, of the tracks
+    given or all of them"""
+    flac_file = os.path.join(album_dir, FLAC_FILE)
+    return [track.num for track in info.tracks
+        if (tracks is None or track.num in tracks) and
+        not verify_track(flac_file, info, track.num)]
+
+
+def seed_rip(album_dir, tmp_dir, info, failed, tracks=None):
+    """Fill the chunk store of a new rip with the good tracks of the
+    archived copy, so only the failed tracks are read from the CD. tracks
+    are the tracks the archive holds, if it is not the whole disc"""
+    flac_file = os.path.join(album_dir, FLAC_FILE)
+    store = chunks.ChunkStore(tmp_dir, musz.musicbrainz_disc_id(info))
+    for track in info.tracks:
+        if track.num in failed or (tracks and track.num not in tracks):
+            continue
+        first, last = chunks.track_span(info, track.num)
+        if not store.import_flac(flac_file, first, last):
+            logger.warning("Could not copy track %i, will read it",
+                track.num)
@@ -0,0 +1,152 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import math
+import logging
+
+import numpy as np
+
+import rip_lib.dsp as dsp
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+REFERENCE = -18.0       # ReplayGain 2 reference loudness in LUFS
+ABS_GATE = -70.0        # BS.1770 absolute gate in LUFS
+REL_GATE = -10.0        # BS.1770 relative gate in LU
+BIN_WIDTH = 0.1         # Histogram resolution in LU
+NUM_BINS = 800          # Covers -70 to +10 LUFS
+SEGMENTS_PER_BLOCK = 4  # 400ms gating blocks made of 100ms segments
+
+
+def block_loudness(energy):
+    return -0.691 + 10 * math.log10(energy)
+
+
+class Histogram(object):
+    """Gating block loudness histogram, it holds the count and the summed
+    energy of the blocks in each bin. Histograms of tracks add up to the
+    histogram of the album"""
+
+    def __init__(self):
+        self.counts = np.zeros(NUM_BINS, dtype=np.int64)
+        self.energy = np.zeros(NUM_BINS)
+
+    def add_blocks(self, energy):
+        energy = energy[energy > 0]
+        loud = -0.691 + 10 * np.log10(energy)
+        keep = loud >= ABS_GATE
+        bins = ((loud[keep] - ABS_GATE) / BIN_WIDTH).astype(np.int64)
+        bins = np.minimum(bins, NUM_BINS - 1)
+        self.counts += np.bincount(bins, minlength=NUM_BINS)
+        self.energy += np.bincount(bins, energy[keep], minlength=NUM_BINS)
+
+    def __iadd__(self, other):
+        self.counts = self.counts + other.counts
+        self.energy = self.energy + other.energy
+        return self
+
+    def integrated(self):
+        """Gated integrated loudness in LUFS, None if all silent"""
+        total = self.counts.sum()
+        if total == 0:
+            return None
+        gate = block_loudness(self.energy.sum() / total) + REL_GATE
+        first = int(math.ceil((gate - ABS_GATE) / BIN_WIDTH))
+        first = max(0, min(first, NUM_BINS - 1))
+        count = self.counts[first:].sum()
+        if count == 0:
+            return None
+        return block_loudness(self.energy[first:].sum() / count)
+
+
+class LoudnessMeter(object):
+    """EBU R128 / ReplayGain 2 measurement of a stream of PCM blocks"""
+
+    def __init__(self, rate, channels=2):
+        b, a = dsp.k_weighting(rate)
+        self.filter = dsp.IIRFilter(b, a, channels)
+        self.true_peak = dsp.TruePeak(channels)
+        self.seg_len = rate // 10
+        self.pending = np.zeros(0)
+        self.segments = []  # Energy of the last few 100ms segments
+        self.histogram = Histogram()
+
+    def process(self, x):
+        """Measure x, float samples in -1..1 as (samples, channels)"""
+        self.true_peak.process(x)
+        y = self.filter.process(x)
+        power = np.concatenate((self.pending, (y * y).sum(axis=1)))
+        num = len(power) // self.seg_len
+        self.pending = power[num * self.seg_len:]
+        if num == 0:
+            return
+        segs = power[:num * self.seg_len].reshape(num, self.seg_len)
+        segs = np.concatenate((self.segments, segs.mean(axis=1)))
+        if len(segs) >= SEGMENTS_PER_BLOCK:
+            # Overlapping 400ms blocks, each the mean of 4 segments
+            blocks = sum([segs[i:len(segs) - SEGMENTS_PER_BLOCK + 1 + i]
+                for i in range(SEGMENTS_PER_BLOCK)]) / SEGMENTS_PER_BLOCK
+            self.histogram.add_blocks(blocks)
+        self.segments = segs[-(SEGMENTS_PER_BLOCK - 1):]
+
+    def result(self):
+        """Return the measurement to keep with the track"""
+        return {
+            "histogram": self.histogram,
+            "peak": self.true_peak.peak
+        }
+
+
+def gain(loudness):
+    """ReplayGain in dB for the integrated loudness"""
+    if loudness is None:
+        return 0.0
+    return REFERENCE - loudness
+
+
+def track_tags(result):
+    loudness = result["histogram"].integrated()
+    return {
+        "REPLAYGAIN_TRACK_GAIN": "{:.2f} dB".format(gain(loudness)),
+        "REPLAYGAIN_TRACK_PEAK": "{:.6f}".format(result["peak"])
+    }
+
+
+def album_tags(results):
+    histogram = Histogram()
+    peak = 0.0
+    for result in results:
+        histogram += result["histogram"]
+        peak = max(peak, result["peak"])
+    loudness = histogram.integrated()
+    logger.info("Album loudness %s LUFS", loudness)
+    return {
+        "REPLAYGAIN_ALBUM_GAIN": "{:.2f} dB".format(gain(loudness)),
+        "REPLAYGAIN_ALBUM_PEAK": "{:.6f}".format(peak)
+    }
+
+
+def pack(result):
+    """The measurement as plain lists, so it can be sent as JSON"""
+    return {
+        "counts": result["histogram"].counts.tolist(),
+        "energy": result["histogram"].energy.tolist(),
+        "peak": result["peak"]
+    }
+
+
+def unpack(data):
+    """The measurement sent by pack()"""
+    histogram = Histogram()
+    if len(data["counts"]) != NUM_BINS or len(data["energy"]) != NUM_BINS:
+        raise ValueError("Bad loudness histogram")
+    histogram.counts = np.array(data["counts"], dtype=np.int64)
+    histogram.energy = np.array(data["energy"], dtype=float)
+    return {
+        "histogram": histogram,
+        "peak": float(data["peak"])
+    }
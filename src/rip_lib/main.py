@@ -6,18 +6,31 @@
 ##
 
 import os
-import sys
 import subprocess
 import pickle
+import functools
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 import rip_lib.disc_info as disc_info
+import rip_lib.chunks as chunks
 import rip_lib.freedb as cddb
 import rip_lib.musicbrainz as musz
 import rip_lib.ogg as ogg
+import rip_lib.pipeline as pipeline
+import rip_lib.scratch as scratch
+import rip_lib.library as library
+import rip_lib.priority as priority
+import rip_lib.stream as stream
+import rip_lib.dsp as dsp
+import rip_lib.loudness as loudness
+import rip_lib.id3 as id3
+import rip_lib.flac as flac
+import rip_lib.cache as cache
+import rip_lib.plan as plan
+import rip_lib.analysis as analysis
 
 DEVICE = "/dev/sr0"
 
@@ -25,6 +38,8 @@ CUEFILE = "disc.cue"
 WAVFILE = "disc.wav"
 FLACFILE = "disc.flac"
 COVERFILE = "cover.jpg"
+RATE48K = 48000
+ALBUMOGGFILE = "album.ogg"
 
 def yes_or_no(question=None):
     """Get a Yes or No answer from the user"""
@@ -41,6 +56,16 @@ def yes_or_no(question=None):
             print("Please type 'y' or 'n'")
 
 
+def ask(args, name, question):
+    """Use the answer given with the job (e.g. by the daemon client) if
+    there is one, else ask the user"""
+    answers = getattr(args, "answers", None) or {}
+    if name in answers:
+        logger.info("%s %s", question, "yes" if answers[name] else "no")
+        return answers[name]
+    return yes_or_no(question)
+
+
 def extractStr(line):
     if len(line) == 0:
         return "-"
@@ -132,12 +157,17 @@ def save_pickle(tmp_dir, info):
     pkl_fd.close()
 
 
+def wip_dir(working_dir):
+    """The tmp working directory of working_dir"""
+    if os.path.exists("pickle.info"):
+        return "."
+    return os.path.join(working_dir, "tmp_rip")
+
+
 def get_wip_dir(working_dir):
     """Get or Make the tmp working directory"""
-    if os.path.exists("pickle.info"):
-        tmp_dir = "."
-    else:
-        tmp_dir = os.path.join(working_dir, "tmp_rip")
+    tmp_dir = wip_dir(working_dir)
+    if tmp_dir != ".":
         try:
             os.mkdir(tmp_dir)
         except FileExistsError:
@@ -153,36 +183,76 @@ def rm_file(temp_file):
         pass
 
 
-def execute(args, temp_file, out_file):
-    rm_file(temp_file)
-    try:
-        print(args)
-        subprocess.call(args)
-        os.rename(temp_file, out_file)
-    except FileNotFoundError:
-        print("Check %s is installed\n" % args[0])
+def temp_name(out_file):
+    """Temporary file used while creating out_file, it keeps the
+    extension so tools that look at it still work"""
+    head, tail = os.path.split(out_file)
+    return os.path.join(head, "temp." + tail)
+
+
+def parse_tracks(text):
+    """The track numbers in a list like "2,5-7", raises ValueError"""
+    tracks = set()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError("Bad track range '{}'".format(part))
+        tracks.update(range(first, last + 1))
+    return sorted(tracks)
+
+
+def selected_tracks(info):
+    """The tracks that are ripped, all of them unless only some were
+    asked for"""
+    selected = getattr(info, "selected", None)
+    if not selected:
+        return list(info.tracks)
+    return [track for track in info.tracks if track.num in selected]
+
+
+def select_tracks(info, tracks):
+    """Rip only the tracks given, return False if the disc does not have
+    them"""
+    numbers = set([track.num for track in info.tracks])
+    wrong = [num for num in tracks if num not in numbers]
+    if wrong:
+        logger.error("The disc has no track %s", ", ".join(
+            [str(x) for x in wrong]))
         return False
-    finally:
-        rm_file(temp_file)
+    info.selected = None if set(tracks) == numbers else sorted(tracks)
     return True
 
 
-def read_cd(tmp_dir, info):
-    """Read the CD"""
-    temp_file = "temp.wav"
-    wav_file = os.path.join(tmp_dir, WAVFILE)
+def read_cd(tmp_dir, info, wav_dir=None, monitor=None):
+    """Read the CD, the rip is checkpointed in chunks so that a re-run
+    only reads what is missing. monitor is told the rate of each chunk.
+    If only some tracks are selected only their sectors are read, the
+    rest of the disc is left silent so disc.wav matches the cue sheet"""
+    wav_file = os.path.join(wav_dir or tmp_dir, WAVFILE)
     flac_file = os.path.join(tmp_dir, FLACFILE)
     if not (os.path.exists(wav_file) or os.path.exists(flac_file)):
-        args = [
-            "cdparanoia",
-            "-d", DEVICE,
-            "\"-{0}\"".format(info.num_tracks),
-            temp_file
-        ]
-        if not execute(args, temp_file, wav_file):
-            args[3] = "\"-{}\"".format(info.num_tracks-1)
-            if not execute(args, temp_file, wav_file):
-                sys.exit(-1)
+        store = chunks.ChunkStore(tmp_dir, musz.musicbrainz_disc_id(info))
+        store.verify()
+        selected = getattr(info, "selected", None)
+        if selected:
+            last = chunks.audio_sectors(info) - 1
+            for first, span_last in chunks.selected_spans(info, selected):
+                if not store.rip(DEVICE, first, span_last, monitor):
+                    raise RuntimeError("Failed to read the CD")
+        else:
+            # If the last track is a data track, the read will fail so try
+            # again without it
+            for num_tracks in (info.num_tracks, info.num_tracks-1):
+                last = chunks.audio_sectors(info, num_tracks) - 1
+                if store.rip(DEVICE, 0, last, monitor):
+                    break
+            else:
+                raise RuntimeError("Failed to read the CD")
+        # The chunks are kept until disc.flac is made, as disc.wav may be
+        # on a volume (tmpfs) that does not survive a reboot
+        store.assemble(wav_file, 0, last, bool(selected))
     else:
         logger.info("CD already read")
 
@@ -190,9 +260,8 @@ def read_cd(tmp_dir, info):
 def write_cue_file(tmp_dir, info):
     cue_file = os.path.join(tmp_dir, CUEFILE)
     if not os.path.exists(cue_file):
-        temp_file = "temp.cue"
-        if os.path.exists(temp_file):
-            os.unlink(temp_file)
+        temp_file = temp_name(cue_file)
+        rm_file(temp_file)
         with open(temp_file, "w") as out_fp:
             info.write_cuefile(out_fp)
         os.rename(temp_file, cue_file)
@@ -208,54 +277,40 @@ def get_coverart(tmp_dir, info):
         logger.info("Cover Art already fetched")
 
 
-def to_flac(tmp_dir, info):
-    """Convert WAV to FLAC"""
+def to_flac_cmd(tmp_dir, wav_dir=None):
+    """Return the command to convert WAV to FLAC"""
     flac_file = os.path.join(tmp_dir, FLACFILE)
-    if not os.path.exists(flac_file):
-        wav_file = os.path.join(tmp_dir, WAVFILE)
-        cue_file = os.path.join(tmp_dir, CUEFILE)
-        temp_file = "temp.flac"
-        args = [
-            "flac",
-            "--best",
-            "--no-padding",
-            "--cuesheet={}".format(cue_file),
-            "-o", temp_file, wav_file]
-        if not execute(args, temp_file, flac_file):
-            sys.exit(-1)
-    else:
-        logger.info("FLAC archive already created")
-
-
-def flac2wav(tmp_dir, idx):
-    """Return the WAV filename"""
-    wav = os.path.join(tmp_dir, "track{:02d}.wav".format(idx))
-    if not os.path.exists(wav):
-        flac_file = os.path.join(tmp_dir, FLACFILE)
-        temp_file = "temp.wav"
-        args = [
-            "flac",
-            "-d", flac_file
-        ]
-        args.append("--cue={}.1-{}.1".format(idx, idx+1))
-        args += ["-o", temp_file]
-        if not execute(args, temp_file, wav):
-            sys.exit(-1)
-    return wav
-
-
-def flac48k2wav(tmp_dir, idx):
-    """Return the WAV filename"""
-    wav48k = os.path.join(tmp_dir, "track{:02d}.48k.wav".format(idx))
-    if not os.path.exists(wav48k):
-        temp_file = "temp.wav"
-        wav = flac2wav(tmp_dir, idx)
-        args = [
-            "sox", "-S", "-G", wav, temp_file, "rate", "-v", "48k"
-        ]
-        if not execute(args, temp_file, wav48k):
-            sys.exit(-1)
-    return wav48k
+    wav_file = os.path.join(wav_dir or tmp_dir, WAVFILE)
+    cue_file = os.path.join(tmp_dir, CUEFILE)
+    temp_file = temp_name(flac_file)
+    args = [
+        "flac",
+        "--best",
+        "--padding={}".format(flac.PADDING_SIZE),
+        "--cuesheet={}".format(cue_file),
+        "-o", temp_file, wav_file]
+    return args, temp_file, flac_file
+
+
+def wav_filename(tmp_dir, idx, do48k=False):
+    """Return the track WAV filename"""
+    if do48k:
+        return os.path.join(tmp_dir, "track{:02d}.48k.wav".format(idx))
+    return os.path.join(tmp_dir, "track{:02d}.wav".format(idx))
+
+
+def flac2wav_cmd(tmp_dir, idx, wav_dir=None):
+    """Return the command to extract a track from the FLAC"""
+    wav = wav_filename(wav_dir or tmp_dir, idx)
+    flac_file = os.path.join(tmp_dir, FLACFILE)
+    temp_file = temp_name(wav)
+    args = [
+        "flac",
+        "-d", flac_file
+    ]
+    args.append("--cue={}.1-{}.1".format(idx, idx+1))
+    args += ["-o", temp_file]
+    return args, temp_file, wav
 
 
 def ogg_filename(tmp_dir, i):
@@ -263,27 +318,30 @@ def ogg_filename(tmp_dir, i):
     return os.path.join(tmp_dir, "track{:02d}.ogg".format(i))
 
 
-def to_ogg(tmp_dir, info, do48k):
-    """Convert WAV to OGG"""
-    start_idx = 1
-    end_idx = info.num_tracks+1
-    for idx in range(start_idx, end_idx):
-        ogg_file = ogg_filename(tmp_dir, idx)
-        if not os.path.exists(ogg_file):
-            temp_file = "temp.ogg"
-            if do48k:
-                wav = flac48k2wav(tmp_dir, idx)
-            else:
-                wav = flac2wav(tmp_dir, idx)
-            album_title, performer, track_title = process_tags(
-                info, idx
-            )
-            ogg.oggenc(wav, ogg_file, performer, album_title,
-                track_title, idx
-            )
-            if idx <= 0:
-                cover_file = os.path.join(tmp_dir, COVERFILE)
-                ogg.add_coverart(ogg_file, cover_file)
+def to_ogg_cmd(tmp_dir, info, idx, do48k, wav_dir=None, raw=None):
+    """Return the command to convert a track WAV to OGG, if raw is
+    (rate, channels) the PCM is read from stdin"""
+    ogg_file = ogg_filename(tmp_dir, idx)
+    wav = wav_filename(wav_dir or tmp_dir, idx, do48k)
+    album_title, performer, track_title = process_tags(
+        info, idx
+    )
+    args = ogg.oggenc_cmd(wav, temp_name(ogg_file), performer, album_title,
+        track_title, idx, raw
+    )
+    return args, temp_name(ogg_file), ogg_file
+
+
+def album_ogg(tmp_dir, info):
+    """Join the track OGGs into one gapless chained OGG of the album"""
+    ogg_files = [ogg_filename(tmp_dir, track.num)
+        for track in selected_tracks(info)]
+    missing = [x for x in ogg_files if not os.path.exists(x)]
+    if missing:
+        logger.error("No album OGG, %s missing", ", ".join(missing))
+        return False
+    ogg.chain(ogg_files, os.path.join(tmp_dir, ALBUMOGGFILE))
+    return True
 
 
 def mp3_filename(tmp_dir, i):
@@ -317,104 +375,435 @@ def fix_ogg_tags(tmp_dir, info):
     return True
 
 
-def to_mp3(tmp_dir, info, do48k):
-    """Convert WAV to MP3"""
-    end_idx = info.num_tracks+1
-    for idx in range(1, end_idx):
-        mp3 = mp3_filename(tmp_dir, idx)
-        if not os.path.exists(mp3):
-            temp_file = "temp.mp3"
-            if do48k:
-                wav = flac48k2wav(tmp_dir, idx)
-            else:
-                wav = flac2wav(tmp_dir, idx)
-            album_title, performer, track_title = process_tags(
-                info, idx
-            )
-            args = ["lame", "-V", "5",
-                "--ta", performer,
-                "--tl", album_title,
-                "--tt", track_title,
-            ]
-            args += [
-                    "--tn", str(idx),
-            ]
-            args += [wav, temp_file]
-            if not execute(args, temp_file, mp3):
-                sys.exit(-1)
-
-
-def fix_mp3_tags(tmp_dir, info, i):
-    """Fix the MP3 tags"""
-    for idx in range(100):
-        mp3 = mp3_filename(tmp_dir, idx)
-
-        try:
-            album_title, performer, track_title = process_tags(info, idx)
-        except IndexError:
-            print("%i out of range" % i)
-            return False
-        args = [
-            "id3tag", 
-            "-a", performer,
-            "-A", album_title,
-            "-s", track_title
-        ]
+def lame_cmd(wav, temp_file, performer, album_title, track_title, idx,
+    raw=None
+):
+    """Return the lame command line, if raw is (rate, channels) the input
+    is raw PCM read from stdin"""
+    args = ["lame", "-V", "5",
+        "--ta", performer,
+        "--tl", album_title,
+        "--tt", track_title,
+    ]
+    args += [
+            "--tn", str(idx),
+            "--pad-id3v2-size", str(id3.PADDING),
+    ]
+    if raw:
         args += [
-                "-t", str(i),
+            "-r", "-s", "{:g}".format(raw[0] / 1000.0),
+            "--bitwidth", "16", "--signed", "--little-endian"
         ]
-        args.append(mp3)
-        print(args)
-        subprocess.call(args)
+        if raw[1] == 1:
+            args += ["-m", "m"]
+        wav = "-"
+    args += [wav, temp_file]
+    return args
+
+
+def to_mp3_cmd(tmp_dir, info, idx, do48k, wav_dir=None, raw=None):
+    """Return the command to convert a track WAV to MP3, if raw is
+    (rate, channels) the PCM is read from stdin"""
+    mp3 = mp3_filename(tmp_dir, idx)
+    temp_file = temp_name(mp3)
+    wav = wav_filename(wav_dir or tmp_dir, idx, do48k)
+    album_title, performer, track_title = process_tags(
+        info, idx
+    )
+    args = lame_cmd(wav, temp_file, performer, album_title, track_title,
+        idx, raw)
+    return args, temp_file, mp3
+
+
+def encode_track(tmp_dir, info, idx, do48k, do_ogg, do_mp3, wav_dir=None):
+    """Encode a track to OGG and MP3 from a single read of its WAV, the
+    loudness is measured on the same PCM that goes to the encoders. For
+    48K outputs the PCM is resampled on the way"""
+    wav = wav_filename(wav_dir or tmp_dir, idx)
+    encoders = []
+    if do_ogg:
+        encoders.append(functools.partial(to_ogg_raw, tmp_dir, info, idx))
+    if do_mp3:
+        encoders.append(functools.partial(to_mp3_raw, tmp_dir, info, idx))
+    filters = []
+    if getattr(info.get_track(idx), "pre_emphasis", False):
+        logger.info("Track %i is pre-emphasised, applying de-emphasis", idx)
+        filters.append(dsp.deemphasis_filter)
+    if do48k:
+        filters.append(functools.partial(dsp.resampler, RATE48K))
+    analysers = stream.convert(wav, encoders, [loudness.LoudnessMeter],
+        filters, [analysis.TrackAnalyser])
+    if analysers is None:
+        return False
+    info.get_track(idx).loudness = analysers[0].result()
+    info.get_track(idx).analysis = analysers[1].result()
     return True
 
 
-def rename_tmp_dir(tmp_dir, info):
-    """Rename the tmp directory"""
-    dir_name = replace_chars(remove_chars(extractStr(info.title)))
-    if yes_or_no("Rename tmp-rip?"):
-        os.rename(tmp_dir, dir_name)
+def to_ogg_raw(tmp_dir, info, idx, rate, channels):
+    return to_ogg_cmd(tmp_dir, info, idx, False, raw=(rate, channels))
 
 
-def main(args, working_dir):
-    tmp_dir = get_wip_dir(working_dir)
+def to_mp3_raw(tmp_dir, info, idx, rate, channels):
+    return to_mp3_cmd(tmp_dir, info, idx, False, raw=(rate, channels))
 
-    discInfo = disc_info.DiscInfo()
-    if args.only_convert or not discInfo.read_disk(DEVICE):
-        logger.info("Reading from pickle file (no disc detected)")
-        discInfo = load_pickle(tmp_dir)
-    if not discInfo:
-        logger.error("No disc information available")
+
+def write_replaygain(tmp_dir, info, do_ogg, do_mp3):
+    """Write the ReplayGain tags once every track has been measured"""
+    tracks = selected_tracks(info)
+    results = [getattr(track, "loudness", None) for track in tracks]
+    if None in results:
+        logger.warning("Not all tracks measured, no ReplayGain written")
         return
-    if not musz.get_track_info(discInfo):
-        cddb.get_track_info(discInfo)
-    save_pickle(tmp_dir, discInfo)
+    album = loudness.album_tags(results)
+    for track, result in zip(tracks, results):
+        tags = loudness.track_tags(result)
+        tags.update(album)
+        ogg_file = ogg_filename(tmp_dir, track.num)
+        if do_ogg and os.path.exists(ogg_file):
+            ogg.update_comments(ogg_file, sorted(tags.items()))
+        mp3 = mp3_filename(tmp_dir, track.num)
+        if do_mp3 and os.path.exists(mp3):
+            id3.update_frames(mp3, [id3.txxx_frame(name, value)
+                for name, value in sorted(tags.items())])
+    flac_file = os.path.join(tmp_dir, FLACFILE)
+    if os.path.exists(flac_file):
+        flac.update_comments(flac_file, sorted(album.items()))
+    info.replaygain = album
+    save_pickle(tmp_dir, info)
+
+
+def mp3_frames(info, idx):
+    """The ID3 frames track idx (1 based) should have"""
+    album_title, performer, track_title = process_tags(info, idx)
+    frames = [
+        id3.text_frame("TALB", album_title),
+        id3.text_frame("TPE1", performer),
+        id3.text_frame("TIT2", track_title),
+        id3.text_frame("TRCK", "{}/{}".format(idx, info.num_tracks))
+    ]
+    if getattr(info, "disc_number", None):
+        frames.append(id3.text_frame("TPOS", "{}/{}".format(
+            info.disc_number, info.disc_count)))
+    measured = getattr(info.get_track(idx), "loudness", None)
+    album = getattr(info, "replaygain", None)
+    if measured is not None and album:
+        tags = loudness.track_tags(measured)
+        tags.update(album)
+        frames += [id3.txxx_frame(name, value)
+            for name, value in sorted(tags.items())]
+    return frames
+
+
+def fix_mp3_tags(tmp_dir, info):
+    """Fix the MP3 tags, all the tracks in one go with the cover shared"""
+    tracks = []
+    for track in info.tracks:
+        mp3 = mp3_filename(tmp_dir, track.num)
+        if os.path.exists(mp3):
+            tracks.append((mp3, mp3_frames(info, track.num)))
+    shared = []
+    cover_file = os.path.join(tmp_dir, COVERFILE)
+    if os.path.exists(cover_file):
+        with open(cover_file, "rb") as in_fp:
+            shared.append(id3.apic_frame(in_fp.read()))
+    id3.update_album(tracks, shared)
+    return True
 
+
+def rename_tmp_dir(tmp_dir, info, args=None):
+    """Rename the tmp directory after the album, the discs of a box set
+    are told apart by their number and a directory already there is not
+    overwritten"""
+    dir_name = replace_chars(remove_chars(extractStr(info.title)))
+    if getattr(info, "disc_number", None) and info.disc_count > 1:
+        dir_name += "_disc_{}".format(info.disc_number)
+    if ask(args, "rename", "Rename tmp-rip?"):
+        new_dir = os.path.join(os.path.dirname(tmp_dir), dir_name)
+        count = 1
+        while os.path.exists(new_dir):
+            count += 1
+            new_dir = os.path.join(os.path.dirname(tmp_dir),
+                "{}_{}".format(dir_name, count))
+        os.rename(tmp_dir, new_dir)
+
+
+def make_scratch(args, tmp_dir, info):
+    """Create the scratch space manager for the intermediate files"""
+    budget = args.scratch_budget * 1024 * 1024
+    return scratch.Scratch(tmp_dir, budget, args.scratch)
+
+
+def wav_size(sectors, do48k=False):
+    """Estimated size of a WAV holding sectors of CD audio"""
+    size = sectors * chunks.SECTOR_SIZE
+    if do48k:
+        size = size * 160 // 147
+    return size + 44
+
+
+def build_pipeline(args, tmp_dir, info, do48k, do_ogg, do_mp3,
+    scratch=None
+):
+    """Describe the rip and conversion as a DAG of stages"""
+    wav_dir = scratch.root if scratch else tmp_dir
+    wav_file = os.path.join(wav_dir, WAVFILE)
+    cue_file = os.path.join(tmp_dir, CUEFILE)
+    cover_file = os.path.join(tmp_dir, COVERFILE)
+    flac_file = os.path.join(tmp_dir, FLACFILE)
+
+    flow = pipeline.Pipeline(scratch=scratch,
+        executor=getattr(args, "executor", None),
+        progress=getattr(args, "progress", None),
+        limiters=getattr(args, "limiters", None))
     if not args.only_convert:
-        read_cd(tmp_dir, discInfo)
-        write_cue_file(tmp_dir, discInfo)
-        get_coverart(tmp_dir, discInfo)
-        to_flac(tmp_dir, discInfo)
+        if scratch:
+            scratch.add(wav_file, wav_size(chunks.audio_sectors(info)))
+        throttle = priority.Throttle(flow, pipeline.CPU)
+        flow.add("read", lambda: read_cd(tmp_dir, info, wav_dir, throttle),
+            outputs=[wav_file], resource=pipeline.DRIVE)
+        flow.add("cue", lambda: write_cue_file(tmp_dir, info),
+            outputs=[cue_file])
+        flow.add("coverart", lambda: get_coverart(tmp_dir, info),
+            outputs=[cover_file], resource=pipeline.NETWORK)
+        flow.add("flac",
+            functools.partial(flac_stage, tmp_dir, info, wav_dir),
+            inputs=[wav_file, cue_file], outputs=[flac_file],
+            resource=pipeline.CPU)
+
+    outputs = []
+    measured = set()
+    for track in selected_tracks(info):
+        idx = track.num
+        length = track.length
+        wav = wav_filename(wav_dir, idx)
+        if scratch:
+            scratch.add(wav, wav_size(length))
+        flow.add("wav{}".format(idx),
+            functools.partial(run_cmd, flac2wav_cmd, tmp_dir, idx, wav_dir),
+            inputs=[flac_file], outputs=[wav], resource=pipeline.CPU)
+        encoded = []
+        if do_ogg:
+            encoded.append(ogg_filename(tmp_dir, idx))
+        if do_mp3:
+            encoded.append(mp3_filename(tmp_dir, idx))
+        if encoded:
+            flow.add("encode{}".format(idx),
+                functools.partial(encode_stage, measured, tmp_dir, info, idx,
+                    do48k, do_ogg, do_mp3, wav_dir),
+                inputs=[wav], outputs=encoded, resource=pipeline.CPU)
+            outputs += encoded
+    if outputs:
+        flow.add("replaygain",
+            functools.partial(album_stage, measured, tmp_dir, info, do_ogg,
+                do_mp3),
+            inputs=outputs)
+    return flow
+
+
+def album_stage(measured, tmp_dir, info, do_ogg, do_mp3):
+    """Once the tracks are encoded report what their analysis found and
+    write the ReplayGain tags"""
+    if not measured:
+        return None
+    analysis.report(info)
+    write_replaygain(tmp_dir, info, do_ogg, do_mp3)
+    return True
 
-    do48k = yes_or_no("Use 48K sample rate?")
 
-    do_ogg = yes_or_no("Convert to OGG?")
-    if do_ogg:
-        to_ogg(tmp_dir, discInfo, do48k)
+def encode_stage(measured, *args):
+    """Encode a track, noting it has been measured"""
+    if not encode_track(*args):
+        return False
+    measured.add(args[2])
+    return True
+
+
+async def flac_stage(tmp_dir, info, wav_dir=None):
+    """Compress disc.wav, then drop the chunks of the rip now that the
+    audio is safe in disc.flac"""
+    if not await run_cmd(to_flac_cmd, tmp_dir, wav_dir):
+        return False
+    if os.path.exists(os.path.join(tmp_dir, FLACFILE)):
+        chunks.ChunkStore(tmp_dir, musz.musicbrainz_disc_id(info)).clear()
+    return True
 
-    do_mp3 = yes_or_no("Convert to MP3?")
-    if do_mp3:
-        to_mp3(tmp_dir, discInfo, do48k)
 
+async def run_cmd(cmd_func, *args):
+    """Build an encoder command and run it asynchronously"""
+    args, temp_file, out_file = cmd_func(*args)
+    return await pipeline.execute(priority.encoder(args), temp_file,
+        out_file)
+
+
+def check_library(args, tmp_dir, info):
+    """Look for the disc in the library before reading it, return False
+    if the rip should be skipped"""
+    index = library.open_index(args.library)
+    matches = index.lookup(info)
+    if not matches:
+        return True
+    for album_dir in matches:
+        print("Disc already ripped in '{}'".format(album_dir))
+    album_dir = matches[0]
+    archived = index.albums[album_dir].get("selected")
+    if archived:
+        missing = [track.num for track in selected_tracks(info)
+            if track.num not in archived]
+        if missing:
+            # Merge, the tracks archived are copied and the rest read
+            print("Only tracks {} are archived, reading tracks {}".format(
+                archived, missing))
+            select_tracks(info, sorted(set(archived) | set(
+                [track.num for track in selected_tracks(info)])))
+            library.seed_rip(album_dir, tmp_dir, info, missing, archived)
+            return True
+    if ask(args, "skip", "Skip the rip?"):
+        return False
+    if ask(args, "reread", "Only read the tracks that fail verification?"):
+        failed = library.verify_tracks(album_dir, info, archived)
+        if not failed:
+            print("All tracks verified, nothing to read")
+            return False
+        print("Reading tracks {}".format(failed))
+        library.seed_rip(album_dir, tmp_dir, info, failed, archived)
+    return True
+
+
+def lookup_disc(args, tmp_dir, info):
+    """Check the library and get the metadata of the disc, return False if
+    the rip should be skipped"""
+    if getattr(args, "tracks", None) and not args.only_convert:
+        if not select_tracks(info, args.tracks):
+            return False
+    if args.library and not args.only_convert:
+        if not check_library(args, tmp_dir, info):
+            return False
+    if not musz.get_track_info(info):
+        cddb.get_track_info(info)
+    save_pickle(tmp_dir, info)
+    return True
+
+
+def finish(args, tmp_dir, info, do_ogg, do_mp3):
+    """What is left to do once the pipeline has run"""
     if not do_ogg or not do_mp3:
-        do_tags = yes_or_no("Update tags?")
+        do_tags = ask(args, "tags", "Update tags?")
     else:
         do_tags = False
 
     if do_tags:
-        fix_ogg_tags(tmp_dir, discInfo)
-        fix_mp3_tags(tmp_dir, discInfo)
+        fix_ogg_tags(tmp_dir, info)
+        fix_mp3_tags(tmp_dir, info)
+
+    if do_ogg and getattr(args, "album_ogg", False):
+        album_ogg(tmp_dir, info)
 
 #   os.remove(wav)
 
-    rename_tmp_dir(tmp_dir, discInfo)
+    rename_tmp_dir(tmp_dir, info, args)
+
+
+def profile(do48k, do_ogg, do_mp3):
+    """Name of the formats and rate encoded, e.g. ogg-mp3-48k"""
+    return "-".join([name for name, given in (("ogg", do_ogg),
+        ("mp3", do_mp3), ("48k", do48k)) if given])
+
+
+def stage_audio(info, name):
+    """Seconds of audio a stage of the pipeline handles, a track for the
+    per track stages and the tracks ripped for the others"""
+    num = name[len(name.rstrip("0123456789")):]
+    if num:
+        return info.get_track(int(num)).length / float(info.fps)
+    return sum([track.length for track in selected_tracks(info)]) / \
+        float(info.fps)
+
+
+def record_timings(flow, info, encoded):
+    """Add the timings of the stages run to the calibration of --plan"""
+    if not flow.timings:
+        return
+    calibration = plan.Calibration()
+    for name, (wall, written) in flow.timings.items():
+        calibration.record(plan.stage_kind(name, encoded),
+            stage_audio(info, name), wall, written)
+    try:
+        calibration.save()
+    except OSError as err:
+        logger.warning("Cannot save the calibration %s", repr(err))
+
+
+def plan_all(args, directories):
+    """Print how long the albums would take and the disk they need,
+    without running any stage"""
+    do48k, do_ogg, do_mp3 = args.do48k, args.ogg, args.mp3
+    calibration = plan.Calibration()
+    albums = []
+    for src_dir in directories:
+        tmp_dir = wip_dir(src_dir)
+        info = load_pickle(tmp_dir)
+        if info is None:
+            logger.error("No disc information in %s", tmp_dir)
+            continue
+        flow = build_pipeline(args, tmp_dir, info, do48k, do_ogg, do_mp3)
+        albums.append(plan.AlbumPlan(src_dir, flow,
+            functools.partial(stage_audio, info), calibration,
+            profile(do48k, do_ogg, do_mp3)))
+    return plan.print_plan(albums)
+
+
+def release_cache(tmp_dir, info, do_ogg, do_mp3):
+    """Drop the album from the page cache once it has been converted, the
+    intermediate WAVs are gone already as the scratch space deletes them"""
+    cache.drop(os.path.join(tmp_dir, FLACFILE))
+    for track in selected_tracks(info):
+        if do_ogg:
+            cache.drop(ogg_filename(tmp_dir, track.num), written=True)
+        if do_mp3:
+            cache.drop(mp3_filename(tmp_dir, track.num), written=True)
+
+
+def main(args, working_dir):
+    tmp_dir = get_wip_dir(working_dir)
+
+    discInfo = disc_info.DiscInfo()
+    if args.only_convert or not discInfo.read_disk(DEVICE):
+        logger.info("Reading from pickle file (no disc detected)")
+        discInfo = load_pickle(tmp_dir)
+    if not discInfo:
+        logger.error("No disc information available")
+        return
+    if not lookup_disc(args, tmp_dir, discInfo):
+        return
+
+    # Ask everything up front so the whole pipeline can run unattended
+    do48k = ask(args, "48k", "Use 48K sample rate?")
+    do_ogg = ask(args, "ogg", "Convert to OGG?")
+    do_mp3 = ask(args, "mp3", "Convert to MP3?")
+
+    scratch_space = make_scratch(args, tmp_dir, discInfo)
+    flow = build_pipeline(args, tmp_dir, discInfo, do48k, do_ogg, do_mp3,
+        scratch_space)
+    try:
+        flow.run()
+    finally:
+        scratch_space.close()
+    record_timings(flow, discInfo, profile(do48k, do_ogg, do_mp3))
+    release_cache(tmp_dir, discInfo, do_ogg, do_mp3)
+
+    finish(args, tmp_dir, discInfo, do_ogg, do_mp3)
+
+
+def main_all(args, directories):
+    """Run each directory in turn. When converting, the disc.flac of the
+    next album is read ahead while the current one is encoded"""
+    prefetcher = cache.Prefetcher()
+    try:
+        for num, src_dir in enumerate(directories):
+            if args.only_convert and num + 1 < len(directories):
+                prefetcher.add(os.path.join(wip_dir(directories[num + 1]),
+                    FLACFILE))
+            main(args, src_dir)
+    finally:
+        prefetcher.close()
@@ -5,19 +5,107 @@
 # Licensed under the GPL License. See LICENSE file in the project root for full license information.  
 ##
 
+import io
+import http.client
 import urllib.request
+import urllib.response
+import urllib.error
 import urllib.parse
 import hashlib
 import base64
 import json
+import collections
 import logging
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+import rip_lib.rank as rank
+
 MUSICBRAINZ_SERVER = 'http://musicbrainz.org/ws/2/'
 COVER_SERVER = 'http://coverartarchive.org/release/'
+MIN_INTERVAL = 1.0  # Musicbrainz asks for no more than one request a second
+RATE_LIMITED_HOST = urllib.parse.urlparse(MUSICBRAINZ_SERVER).hostname
+RELEASE_CACHE = 32  # Number of releases kept
+
+
+class RateLimiter(object):
+    """Space out the requests made to a server, safe to share between
+    threads"""
+
+    def __init__(self, interval=MIN_INTERVAL):
+        self.interval = interval
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.last = time.monotonic()
+
+
+class KeepAliveHandler(urllib.request.BaseHandler):
+    """Keeps one HTTP(S) connection open per host, so the lookups of a long
+    running process do not each pay for a new connection. The response is
+    read in full before it is returned so the connection is free for the
+    next request"""
+
+    handler_order = 400     # Before the standard HTTP(S) handlers
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def _open(self, conn_class, req):
+        key = (conn_class, req.host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update([(name, value) for name, value in req.headers.items()
+            if name not in headers])
+        with self.lock:
+            while 1:
+                conn = self.connections.pop(key, None)
+                reused = conn is not None
+                if not reused:
+                    conn = conn_class(req.host, timeout=req.timeout)
+                try:
+                    conn.request(req.get_method(), req.selector, req.data,
+                        headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.HTTPException, OSError) as err:
+                    conn.close()
+                    if reused:
+                        continue    # The server closed it, try a new one
+                    raise urllib.error.URLError(err)
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                self.connections[key] = conn
+        result = urllib.response.addinfourl(io.BytesIO(data), response.msg,
+            req.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+    def http_open(self, req):
+        return self._open(http.client.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open(http.client.HTTPSConnection, req)
+
+
+def keep_alive():
+    """Reuse the connections to the servers from now on"""
+    urllib.request.install_opener(
+        urllib.request.build_opener(KeepAliveHandler()))
+
+
+rate_limiter = RateLimiter()
+_releases = collections.OrderedDict()
 
 def mbase64(data):
     """musicbrainz version of base64 encoding"""
@@ -47,12 +135,16 @@ def musicbrainz_disc_id(disc_info):
     return magic
 
 
-def perform_request(url):
-    """Perform a read request to server"""
+def open_url(url):
+    """Open url, trying again while the server is busy. Returns the
+    response or None"""
     logging.debug("Getting %s", url)
     headers = { 'User-Agent' : 'CD-RIP/1.0 (peter1010 at the github)' }
     req = urllib.request.Request(url, headers=headers)
+    limited = urllib.parse.urlparse(url).hostname == RATE_LIMITED_HOST
     for i in range(5):
+        if limited:
+            rate_limiter.wait()
         try:
             response = urllib.request.urlopen(req)
         except urllib.error.HTTPError as err:
@@ -71,7 +163,14 @@ def perform_request(url):
     else:
         logger.error("Failed to connect to '%s' after %i attempts", url, i)
         return None
+    return response
+
 
+def perform_request(url):
+    """Perform a read request to server"""
+    response = open_url(url)
+    if response is None:
+        return None
     lines = []
     for line in response.readlines():
         try:
@@ -84,10 +183,18 @@ def perform_request(url):
     return "".join(lines)
 
 
+def cache_release(server_url, obj):
+    _releases[(server_url, obj["id"])] = obj
+    while len(_releases) > RELEASE_CACHE:
+        _releases.popitem(last=False)
+
+
 def query_database(disc_info, server_url=MUSICBRAINZ_SERVER):
-    """Query the musicbrainz server using disc ID"""
+    """Query the musicbrainz server using disc ID. The releases come back
+    with their tracks, so they are cached and fetch_release need not ask
+    for them again"""
     disc_id = musicbrainz_disc_id(disc_info)
-    url = "{0}discid/{1}/?fmt=json".format(
+    url = "{0}discid/{1}/?inc=recordings+artist-credits&fmt=json".format(
         server_url, disc_id
     )
     data = perform_request(url)
@@ -100,24 +207,18 @@ def query_database(disc_info, server_url=MUSICBRAINZ_SERVER):
     except KeyError:
         print(json.dumps(obj, sort_keys=True, indent=4))
         return None
-    possible_discs = []
+    candidates = []
     for rel in releases:
         mbid, title = rel["id"], rel["title"]
         logger.info("MBID=%s title=%s", mbid, title)
-        # print(json.dumps(rel, sort_keys=True, indent=4))
-        possible_discs.append((title, mbid))
-    if possible_discs is None:
+        if "media" in rel:
+            cache_release(server_url, rel)
+        candidates.append(rank.release_candidate(rel, disc_info, disc_id))
+    rel = rank.choose(candidates, "release")
+    if rel is None:
+        logger.warning("No release matches the disc")
         return None
-
-    for i, entry in enumerate(possible_discs):
-        print("[{}]\t{}".format(i, entry[0]))
-
-    if len(possible_discs) > 1:
-        selection = input("Select an entry [default=0]?")
-        selection = 0 if selection == "" else int(selection)
-    else:
-        selection = 0
-    return possible_discs[selection]
+    return rel["title"], rel["id"]
 
 def _extract_artist(json_obj):
     artists = json_obj["artist-credit"]
@@ -131,48 +232,49 @@ def _extract_artist(json_obj):
     return artist
 
 def _select_media(json_obj, disc_info):
-    choice = []
-    for media in json_obj:
-        num_of_tracks = media["track-count"]
-        if num_of_tracks != len(disc_info.tracks):
-            logger.warn("Reject media Num tracks %i != %i",
-                num_of_tracks, len(disc_info.tracks)
-            )
-            continue
-        for track in media["tracks"]:
-            length = (int(track["length"]) + 500)//1000 # In seconds
-            idx = int(track["number"])
-            t_length = (disc_info.get_track(idx).length + disc_info.fps/2) // disc_info.fps
-            diff = t_length - length
-            if diff > 2 or diff < -2:
-                logger.warn("Reject media track %i length %i s != %i s",
-                    idx, length, t_length
-                )
-                break
-        else:
-            choice.append(media)
-    print( len(choice))
-    assert len(choice) == 1
-    return choice[0]
+    """The medium of the release that is the disc, or None"""
+    release = {"media": json_obj}
+    return rank.choose(rank.media_candidates(release, disc_info,
+        musicbrainz_disc_id(disc_info)), "medium")
 
 
-def read_track_metadata(disc_info, server_url=MUSICBRAINZ_SERVER):
+def fetch_release(mbid, server_url=MUSICBRAINZ_SERVER):
+    """Get the release, the result is kept so the discs of a multi-disc
+    set only fetch it once"""
+    key = (server_url, mbid)
+    if key in _releases:
+        _releases.move_to_end(key)
+        return _releases[key]
     url = "{0}release/{1}/?inc=artist-credits+recordings&fmt=json".format(
-        server_url, disc_info.mbid
+        server_url, mbid
     )
     data = perform_request(url)
     if data is None:
-        return False
+        return None
     obj = json.loads(data)
     result = json.dumps(obj, sort_keys=True, indent=4)
     for line in result.splitlines():
         logger.debug(">> %s", line)
-    assert obj["id"] == disc_info.mbid
+    assert obj["id"] == mbid
+    cache_release(server_url, obj)
+    return obj
+
+
+def read_track_metadata(disc_info, server_url=MUSICBRAINZ_SERVER):
+    obj = fetch_release(disc_info.mbid, server_url)
+    if obj is None:
+        return False
     media = _select_media(obj["media"], disc_info)
+    if media is None:
+        logger.warning("No medium of %s matches the disc", disc_info.mbid)
+        return False
     disc_info.set_artist(_extract_artist(obj))
+    if len(obj["media"]) > 1:
+        disc_info.disc_number = media.get("position")
+        disc_info.disc_count = len(obj["media"])
     for track in media["tracks"]:
 #        print(json.dumps(track, sort_keys=True, indent=4))
-        num = int(track["number"])
+        num = rank.track_number(track)
         title = track["title"]
         artist = _extract_artist(track)
         logger.info("[%i] %s / %s", num, artist, title)
@@ -185,8 +287,9 @@ def read_track_metadata(disc_info, server_url=MUSICBRAINZ_SERVER):
 def get_coverart(disc_info, filename="cover.jpg",
     server_url=COVER_SERVER
 ):
-    """Read the covert art, the mbid must be known"""
-    if not hasattr(disc_info, "mbid") or disc_info is None:
+    """Read the covert art, uses the mbid found by get_track_info if there
+    is one. The front-500 address redirects straight to the image"""
+    if getattr(disc_info, "mbid", None) is None:
         entry = query_database(disc_info, MUSICBRAINZ_SERVER)
         if entry is None:
             disc_info.title = "unknown"
@@ -194,38 +297,27 @@ def get_coverart(disc_info, filename="cover.jpg",
         disc_info.title = entry[0]
         disc_info.mbid = entry[1]
 
-    url = "{0}{1}".format(
+    url = "{0}{1}/front-500".format(
         server_url, disc_info.mbid
     )
-    data = perform_request(url)
-    if data is None:
-        return None
-    obj = json.loads(data)
-    for image in obj["images"]:
-        if not image["back"]:
-            resource = image["image"]
-    for line in json.dumps(obj, sort_keys=True, indent=4).splitlines():
-        logger.debug(">> %s", line)
-
-    try:
-        response = urllib.request.urlopen(resource)
-    except urllib.error.URLError as err:
-        print("Failed to connect to '{}' {}".format(url, err))
+    response = open_url(url)
+    if response is None:
         return None
     with open(filename, "wb") as out_fp:
         out_fp.write(response.read())
+    response.close()
 
 
 def get_track_info(disc_info, server_url=MUSICBRAINZ_SERVER):
     """Get the Track Info"""
-    if not hasattr(disc_info, "mbid") or disc_info is None:
+    if getattr(disc_info, "mbid", None) is None:
         entry = query_database(disc_info, server_url)
         if entry is None:
             return False
         disc_info.set_title(entry[0])
         disc_info.mbid = entry[1]
 
-    return read_track_metadata(disc_info)
+    return read_track_metadata(disc_info, server_url)
 
 
 if __name__ == "__main__":
@@ -6,7 +6,9 @@
 
 import subprocess
 import base64
+import re
 import struct
+import zlib
 import os
 import sys
 
@@ -15,6 +17,19 @@ VORBIS_COMMENT_EXE = "vorbiscomment"
 IMAGE_IDENTIFY_EXE = "identify"
 OGG_ENC_EXE = "oggenc"
 
+# Escapes of vorbiscomment -e, the backslash first
+ESCAPES = (("\\", "\\\\"), ("\n", "\\n"), ("\r", "\\r"), ("\0", "\\0"))
+
+OGG_HEADER = struct.Struct("<4sBBqIIIB")
+CRC_OFFSET = 22
+CONTINUED = 0x01
+BOS = 0x02          # First page of a logical stream
+EOS = 0x04          # Last page of a logical stream
+
+# The Ogg CRC is the unreflected form of the zlib one, so reversing the bits
+# of each byte and of the result lets zlib do the work
+_REVERSED = bytes([int("{:08b}".format(x)[::-1], 2) for x in range(256)])
+
 
 def identify(filename):
     #tmp_rip/cover.jpg JPEG 1000x1000 1000x1000+0+0 8-bit sRGB 332KB 0.000u 0:00.000
@@ -65,6 +80,14 @@ def rm_file(temp_file):
         os.unlink(temp_file)
         
 
+def update_comments(ogg_file, new_comments):
+    """Set the comments, replacing any existing ones with the same names"""
+    names = set([name.upper() for name, _ in new_comments])
+    comments = [(name, value) for name, value in read_comments(ogg_file)
+        if name.upper() not in names]
+    write_comments(ogg_file, comments + list(new_comments))
+
+
 def add_coverart(ogg_file, image_file):
     temp = "temp.com"
     rm_file(temp)
@@ -84,6 +107,62 @@ def add_coverart(ogg_file, image_file):
         rm_file(temp)
 
 
+def escape(value):
+    """Escape a comment value the way vorbiscomment -e reads it, so a value
+    can hold newlines"""
+    for char, escaped in ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def unescape(value):
+    """Undo the escapes of vorbiscomment -e"""
+    unescaped = dict([(escaped[1], char) for char, escaped in ESCAPES])
+    return re.sub(r"\\(.)", lambda match: unescaped.get(match.group(1),
+        match.group(0)), value)
+
+
+def read_comments(ogg_file):
+    """Return the list of (name, value) comments in the ogg file"""
+    args = [
+        VORBIS_COMMENT_EXE,
+        "-l",
+        "-e",
+        "--raw",
+        ogg_file
+    ]
+    data = subprocess.check_output(args)
+    comments = []
+    for line in data.decode("utf-8").splitlines():
+        try:
+            name, value = line.split("=", 1)
+        except ValueError:
+            continue
+        comments.append((name, unescape(value)))
+    return comments
+
+
+def write_comments(ogg_file, comments):
+    """Replace all the comments in the ogg file"""
+    temp = ogg_file + ".com"
+    rm_file(temp)
+    with open(temp, "w", encoding="utf-8") as out_fp:
+        for name, value in comments:
+            out_fp.write("{}={}\n".format(name, escape(value)))
+    try:
+        args = [
+            VORBIS_COMMENT_EXE,
+            "-w",
+            "-e",
+            "--raw",
+            "-c", temp,
+            ogg_file
+        ]
+        subprocess.check_call(args)
+    finally:
+        rm_file(temp)
+
+
 def execute(args, temp_file, out_file):
     rm_file(temp_file)
     try:
@@ -97,10 +176,12 @@ def execute(args, temp_file, out_file):
         rm_file(temp_file)
 
 
-def oggenc(wav_file, ogg_file, performer, album_title, track_title, idx):
-    """Encode a OGG file from the wav file, if idx <= 0 then this is the
-    complete album"""
-    temp_file = "temp.ogg"
+def oggenc_cmd(wav_file, out_file, performer, album_title, track_title,
+    idx, raw=None
+):
+    """Return the oggenc command line, if idx <= 0 then this is the
+    complete album. If raw is (rate, channels) the input is raw PCM
+    read from stdin"""
     args = [
         OGG_ENC_EXE,
         "-q", "7", "--utf8",
@@ -112,11 +193,115 @@ def oggenc(wav_file, ogg_file, performer, album_title, track_title, idx):
         args += [
             "-N", str(idx)
         ]
+    if raw:
+        args += [
+            "--raw", "--raw-bits=16", "--raw-endianness=0",
+            "--raw-rate={}".format(raw[0]),
+            "--raw-chan={}".format(raw[1])
+        ]
+        wav_file = "-"
     args += [
-        "-o", temp_file, wav_file
+        "-o", out_file, wav_file
     ]
+    return args
+
+
+def oggenc(wav_file, ogg_file, performer, album_title, track_title, idx):
+    """Encode a OGG file from the wav file, if idx <= 0 then this is the
+    complete album"""
+    head, tail = os.path.split(ogg_file)
+    temp_file = os.path.join(head, "temp." + tail)
+    args = oggenc_cmd(wav_file, temp_file, performer, album_title,
+        track_title, idx
+    )
     execute(args, temp_file, ogg_file)
  
 
+def ogg_crc(data):
+    """CRC-32 of an Ogg page (polynomial 0x04c11db7, no reflection, zero
+    initial value)"""
+    crc = zlib.crc32(data.translate(_REVERSED), 0xffffffff) ^ 0xffffffff
+    return int("{:032b}".format(crc)[::-1], 2)
+
+
+class Page(object):
+    """An Ogg page"""
+
+    def __init__(self, flags, granule, serial, seq, lacing, body):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.seq = seq
+        self.lacing = lacing
+        self.body = body
+
+    def pack(self):
+        header = OGG_HEADER.pack(b"OggS", 0, self.flags, self.granule,
+            self.serial, self.seq, 0, len(self.lacing)) + self.lacing
+        crc = ogg_crc(header + self.body)
+        return header[:CRC_OFFSET] + struct.pack("<I", crc) + \
+            header[CRC_OFFSET + 4:] + self.body
+
+
+def read_pages(in_fp):
+    """Yield the pages of an Ogg file, checking their CRCs"""
+    while 1:
+        header = in_fp.read(OGG_HEADER.size)
+        if not header:
+            break
+        if len(header) < OGG_HEADER.size:
+            raise ValueError("Truncated Ogg page")
+        magic, version, flags, granule, serial, seq, crc, count = \
+            OGG_HEADER.unpack(header)
+        if magic != b"OggS" or version != 0:
+            raise ValueError("Not an Ogg page")
+        lacing = in_fp.read(count)
+        body = in_fp.read(sum(lacing))
+        if len(lacing) != count or len(body) != sum(lacing):
+            raise ValueError("Truncated Ogg page")
+        page = Page(flags, granule, serial, seq, lacing, body)
+        if ogg_crc(header[:CRC_OFFSET] + b"\0\0\0\0" +
+                header[CRC_OFFSET + 4:] + lacing + body) != crc:
+            raise ValueError("Bad Ogg page CRC")
+        yield page
+
+
+def chain(ogg_files, out_file):
+    """Join the OGG files end to end into one chained OGG. The pages are
+    copied as they are, so each track keeps its own comments and there is
+    no gap, only the serial numbers, page sequence numbers and CRCs are
+    rewritten so each link is a stream of its own"""
+    head, tail = os.path.split(out_file)
+    temp_file = os.path.join(head, "temp." + tail)
+    rm_file(temp_file)
+    next_serial = 1
+    try:
+        with open(temp_file, "wb") as out_fp:
+            for ogg_file in ogg_files:
+                with open(ogg_file, "rb") as in_fp:
+                    pages = list(read_pages(in_fp))
+                serials = {}
+                last = {}
+                for page in pages:
+                    if page.serial not in serials:
+                        serials[page.serial] = [next_serial, 0]
+                        next_serial += 1
+                        page.flags |= BOS
+                    else:
+                        page.flags &= ~BOS
+                    page.flags &= ~EOS
+                    last[page.serial] = page
+                for page in last.values():
+                    page.flags |= EOS
+                for page in pages:
+                    stream = serials[page.serial]
+                    page.serial, page.seq = stream
+                    stream[1] += 1
+                    out_fp.write(page.pack())
+        os.rename(temp_file, out_file)
+    finally:
+        rm_file(temp_file)
+
+
 if __name__ == "__main__":
     print(create_metadata_block_picture("tmp_rip/cover.jpg"))
@@ -0,0 +1,323 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DRIVE = "drive"
+CPU = "cpu"
+NETWORK = "network"
+
+
+def default_limits():
+    """How many stages may use each resource at the same time"""
+    return {
+        DRIVE: 1,
+        CPU: os.cpu_count() or 1,
+        NETWORK: 2
+    }
+
+
+def rm_file(temp_file):
+    try:
+        os.unlink(temp_file)
+    except FileNotFoundError:
+        pass
+
+
+async def execute(args, temp_file, out_file):
+    """Run a command that writes temp_file, then rename it to out_file.
+    Returns False, leaving out_file alone, if the command fails"""
+    rm_file(temp_file)
+    try:
+        print(args)
+        proc = await asyncio.create_subprocess_exec(*args)
+        await proc.wait()
+        if proc.returncode != 0:
+            logger.error("%s failed with %i", args[0], proc.returncode)
+            return False
+        os.rename(temp_file, out_file)
+    except FileNotFoundError:
+        print("Check %s is installed\n" % args[0])
+        return False
+    finally:
+        rm_file(temp_file)
+    return True
+
+
+def mtime(filename):
+    try:
+        return os.path.getmtime(filename)
+    except FileNotFoundError:
+        return None
+
+
+class Limiter(object):
+    """Like asyncio.Semaphore, but the limit can be changed while stages
+    are waiting on it"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    async def set_limit(self, limit):
+        async with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+
+class Stage(object):
+    """A step of the pipeline. The action is either a coroutine function
+    or a plain function (which is run in a thread), and it is called
+    once the stages producing the inputs have finished"""
+
+    def __init__(self, name, action, inputs=(), outputs=(), resource=None):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.resource = resource
+
+    def up_to_date(self):
+        """Make style check, all outputs exist and are newer than any
+        inputs that still exist"""
+        out_times = [mtime(x) for x in self.outputs]
+        if not out_times or None in out_times:
+            return False
+        in_times = [x for x in [mtime(x) for x in self.inputs] if x]
+        return not in_times or min(out_times) >= max(in_times)
+
+    async def run(self, loop, executor=None):
+        if asyncio.iscoroutinefunction(self.action):
+            result = await self.action()
+        else:
+            result = await loop.run_in_executor(executor, self.action)
+        if result is False:
+            raise RuntimeError("Stage {} failed".format(self.name))
+
+    def __repr__(self):
+        return "Stage({})".format(self.name)
+
+
+class Pipeline(object):
+    """A DAG of stages, linked by their input and output files. Plain
+    function stages run on executor (a new default one if None), progress
+    if given is called with the stage name and "queued", "start", "done"
+    or "failed" as the stages run. Pipelines run on the same event loop
+    can share a dictionary of limiters, so that between them they keep to
+    the limits"""
+
+    def __init__(self, limits=None, scratch=None, executor=None,
+        progress=None, limiters=None
+    ):
+        self.stages = []
+        self.scratch = scratch
+        self.executor = executor
+        self.progress = progress
+        self._loop = None
+        self._limiters = {} if limiters is None else limiters
+        self.timings = {}   # Stage name -> (wall secs, bytes written)
+        self.limits = default_limits()
+        if limits:
+            self.limits.update(limits)
+
+    def set_limit(self, resource, limit):
+        """Change how many stages using the resource may run at once, this
+        may be called from any thread"""
+        self.limits[resource] = limit
+        limiter = self._limiters.get(resource)
+        if limiter and self._loop:
+            self._loop.call_soon_threadsafe(asyncio.ensure_future,
+                limiter.set_limit(limit))
+
+    def add(self, name, action, inputs=(), outputs=(), resource=None):
+        stage = Stage(name, action, inputs, outputs, resource)
+        self.stages.append(stage)
+        return stage
+
+    def _producers(self):
+        producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise RuntimeError("{} produced by {} and {}".format(
+                        output, producers[output], stage))
+                producers[output] = stage
+        return producers
+
+    def _deps(self):
+        producers = self._producers()
+        deps = {}
+        for stage in self.stages:
+            deps[stage] = [producers[x] for x in stage.inputs
+                if x in producers]
+        return deps
+
+    def _sorted(self, deps):
+        """Topological sort of the stages"""
+        order = []
+        state = {}
+
+        def visit(stage):
+            if state.get(stage) == 1:
+                raise RuntimeError("Cycle in pipeline at {}".format(stage))
+            if stage not in state:
+                state[stage] = 1
+                for dep in deps[stage]:
+                    visit(dep)
+                state[stage] = 2
+                order.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        return order
+
+    def needed(self):
+        """Return the stages that need to run, like make. A stage whose
+        outputs all exist runs if it is out of date or depends on a stage
+        that runs. A stage with a missing output runs if it is a final
+        stage or feeds a stage that runs, so deleted intermediates are
+        only made again when something still needs them"""
+        deps = self._deps()
+        order = self._sorted(deps)
+        consumers = dict([(stage, []) for stage in order])
+        for stage in order:
+            for dep in deps[stage]:
+                consumers[dep].append(stage)
+        missing = set([stage for stage in order
+            if None in [mtime(x) for x in stage.outputs]])
+        stale = set([stage for stage in order if not stage.up_to_date()])
+        run = set()
+        changed = True
+        while changed:
+            changed = False
+            for stage in order:
+                if stage in run:
+                    continue
+                if stage in missing:
+                    go = not consumers[stage] or \
+                        any([x in run for x in consumers[stage]])
+                else:
+                    go = stage in stale or \
+                        any([x in run for x in deps[stage]])
+                if go:
+                    run.add(stage)
+                    changed = True
+        return [stage for stage in order if stage in run]
+
+    async def _run_stage(self, stage, deps, tasks, loop):
+        for dep in deps[stage]:
+            if dep in tasks:
+                await tasks[dep]
+        scratch = self.scratch
+        if scratch:
+            fresh = not any([scratch.manages(x) for x in stage.inputs])
+            for output in stage.outputs:
+                if scratch.manages(output):
+                    await scratch.reserve(output, fresh)
+        limiter = self._limiters.get(stage.resource)
+        try:
+            if limiter:
+                async with limiter:
+                    await self._start(stage, loop)
+            else:
+                await self._start(stage, loop)
+        except:
+            self._report(stage, "failed")
+            raise
+        logger.info("Done %s", stage.name)
+        self._report(stage, "done")
+        if scratch:
+            for output in stage.outputs:
+                if scratch.manages(output):
+                    scratch.written(output)
+            for filename in stage.inputs:
+                if scratch.manages(filename):
+                    scratch.consumed(filename)
+
+    async def _start(self, stage, loop):
+        logger.info("Start %s", stage.name)
+        self._report(stage, "start")
+        started = time.monotonic()
+        await stage.run(loop, self.executor)
+        written = sum([os.path.getsize(x) for x in stage.outputs
+            if os.path.exists(x)])
+        self.timings[stage.name] = (time.monotonic() - started, written)
+
+    def _report(self, stage, state):
+        if self.progress:
+            self.progress(stage.name, state)
+
+    def _track_scratch(self, needed):
+        """Count the pending jobs for each scratch file and evict those
+        that no pending job needs"""
+        scratch = self.scratch
+        for stage in needed:
+            for filename in stage.inputs:
+                if scratch.manages(filename):
+                    scratch.need(filename)
+        for filename in list(scratch.sizes):
+            scratch.existing(filename)
+            if scratch.pending[filename] <= 0 and \
+                    filename not in sum([x.outputs for x in needed], []):
+                scratch.evict(filename)
+
+    async def run_async(self):
+        """Run every needed stage as soon as its inputs are ready"""
+        loop = asyncio.get_event_loop()
+        deps = self._deps()
+        for resource, limit in self.limits.items():
+            if resource not in self._limiters:
+                self._limiters[resource] = Limiter(limit)
+        self._loop = loop
+        needed = self.needed()
+        for stage in needed:
+            self._report(stage, "queued")
+        if self.scratch:
+            self._track_scratch(needed)
+        tasks = {}
+        for stage in needed:
+            tasks[stage] = asyncio.ensure_future(
+                self._run_stage(stage, deps, tasks, loop)
+            )
+        for stage in self.stages:
+            if stage not in tasks:
+                logger.info("%s already done", stage.name)
+        if tasks:
+            try:
+                results = await asyncio.gather(*tasks.values(),
+                    return_exceptions=True)
+            finally:
+                self._loop = None
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+    def run(self):
+        """Run the pipeline to completion"""
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.run_async())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
@@ -0,0 +1,223 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Predict how long a batch will take and how much disk it needs, from the
+stages of each album's pipeline and the throughput of the stages measured
+by earlier runs on this machine"""
+
+import os
+import pickle
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+CALIBRATION_FILE = os.path.join(os.path.expanduser("~"),
+    ".rip_lib-calibration")
+CPU = "cpu"
+FIXED = ("cue", "coverart", "replaygain")   # Take as long whatever the disc
+
+# Used until a stage has been measured. Stages in FIXED give seconds and
+# bytes per stage, the others seconds of audio per second and bytes
+# written per second of audio
+DEFAULTS = {
+    "read": (8.0, 176400),
+    "cue": (0.1, 2000),
+    "coverart": (2.0, 100000),
+    "flac": (60.0, 105000),
+    "wav": (150.0, 176400),
+    "encode": (25.0, 20000),
+    "replaygain": (0.5, 0),
+}
+
+
+def stage_kind(name, profile=None):
+    """The kind of stage, e.g. "wav" for "wav3". Encoding is measured for
+    each profile (the formats and rate) separately"""
+    kind = name.rstrip("0123456789")
+    if kind == "encode" and profile:
+        kind = "{}-{}".format(kind, profile)
+    return kind
+
+
+class Calibration(object):
+    """Totals of the audio, wall time and bytes written by each kind of
+    stage in the runs so far"""
+
+    def __init__(self, filename=None):
+        self.filename = filename or CALIBRATION_FILE
+        try:
+            with open(self.filename, "rb") as pkl_fd:
+                self.kinds = pickle.load(pkl_fd)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.kinds = {}
+
+    def save(self):
+        temp_file = self.filename + ".tmp"
+        with open(temp_file, "wb") as pkl_fd:
+            pickle.dump(self.kinds, pkl_fd)
+        os.rename(temp_file, self.filename)
+
+    def record(self, kind, audio, wall, written):
+        """A stage of the kind took wall seconds for audio seconds"""
+        totals = self.kinds.setdefault(kind, [0.0, 0.0, 0, 0])
+        totals[0] += audio
+        totals[1] += wall
+        totals[2] += written
+        totals[3] += 1
+
+    def measured(self, kind):
+        return kind in self.kinds
+
+    def estimate(self, kind, audio):
+        """The (wall seconds, bytes written) of a stage"""
+        base = kind.split("-")[0]
+        totals = self.kinds.get(kind)
+        if base in FIXED:
+            if totals:
+                return totals[1] / totals[3], totals[2] // totals[3]
+            return DEFAULTS[base]
+        if totals and totals[0] > 0:
+            return audio * totals[1] / totals[0], \
+                int(audio * totals[2] / totals[0])
+        speed, rate = DEFAULTS.get(base, DEFAULTS["encode"])
+        return audio / speed, int(audio * rate)
+
+
+class StagePlan(object):
+    """When a stage is expected to run and what it costs"""
+
+    def __init__(self, stage, kind, wall, written, measured=False):
+        self.stage = stage
+        self.kind = kind
+        self.measured = measured
+        self.wall = wall
+        self.cpu = wall if stage.resource == CPU else 0.0
+        self.written = written
+        self.start = None
+
+    @property
+    def end(self):
+        return self.start + self.wall
+
+
+def schedule(plans, deps, limits):
+    """Set the start of each stage, as soon as the stages it depends on
+    have ended and its resource has a free slot, the way the pipeline
+    runs them"""
+    pending = list(plans)
+    now = 0.0
+    while pending:
+        for plan in list(pending):
+            if any([dep.start is None or dep.end > now
+                    for dep in deps[plan]]):
+                continue
+            resource = plan.stage.resource
+            if resource is not None:
+                busy = len([x for x in plans if x.start is not None and
+                    x.stage.resource == resource and x.start <= now < x.end])
+                if busy >= limits.get(resource, 1):
+                    continue
+            plan.start = now
+            pending.remove(plan)
+        ends = [x.end for x in plans if x.start is not None and x.end > now]
+        if not ends:
+            break
+        now = min(ends)
+    for plan in pending:
+        logger.error("Cannot schedule %s", plan.stage.name)
+        plan.start = now
+
+
+def peak_usage(plans, consumers, scratch_files):
+    """The most disk used at any time, scratch files are deleted once
+    the stages consuming them have ended. Returns (peak, kept)"""
+    events = []
+    for plan in plans:
+        events.append((plan.end, plan.written))
+        freed = [consumers[x] for x in plan.stage.outputs
+            if x in scratch_files and consumers[x]]
+        if freed:
+            events.append((max([max([x.end for x in c]) for c in freed]),
+                -plan.written))
+    used = peak = 0
+    for when, change in sorted(events, key=lambda x: (x[0], x[1] > 0)):
+        used += change
+        peak = max(peak, used)
+    return peak, used
+
+
+class AlbumPlan(object):
+    """The schedule of the needed stages of one album's pipeline"""
+
+    def __init__(self, album_dir, flow, audio_of, calibration, profile=None):
+        self.album_dir = album_dir
+        deps = flow._deps()
+        needed = flow.needed()
+        self.plans = []
+        by_stage = {}
+        for stage in needed:
+            kind = stage_kind(stage.name, profile)
+            wall, written = calibration.estimate(kind, audio_of(stage.name))
+            plan = StagePlan(stage, kind, wall, written,
+                calibration.measured(kind))
+            by_stage[stage] = plan
+            self.plans.append(plan)
+        plan_deps = dict([(by_stage[x], [by_stage[d] for d in deps[x]
+            if d in by_stage]) for x in needed])
+        schedule(self.plans, plan_deps, flow.limits)
+        consumers = {}
+        for plan in self.plans:
+            for filename in plan.stage.inputs:
+                consumers.setdefault(filename, []).append(plan)
+        scratch_files = set([x for x in consumers if x.endswith(".wav")])
+        self.peak, self.kept = peak_usage(self.plans, consumers,
+            scratch_files)
+        self.wall = max([x.end for x in self.plans] or [0.0])
+        self.cpu = sum([x.cpu for x in self.plans])
+        self.written = sum([x.written for x in self.plans])
+
+    def print_details(self, offset=0.0):
+        print("{}  {} stages  wall {}  cpu {}  written {}  peak {}".format(
+            self.album_dir, len(self.plans), duration(self.wall),
+            duration(self.cpu), size(self.written), size(self.peak)))
+        for plan in sorted(self.plans, key=lambda x: (x.start, x.stage.name)):
+            print("  {:>9} {:<12} {:>8} {:>9}{}".format(
+                duration(offset + plan.start), plan.stage.name,
+                duration(plan.wall), size(plan.written),
+                "" if plan.measured else "  (default rate)"))
+
+
+def duration(secs):
+    secs = int(secs + 0.5)
+    return "{}:{:02}:{:02}".format(secs // 3600, secs // 60 % 60, secs % 60)
+
+
+def size(num):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return "{:.0f}{}".format(num, unit) if unit == "B" else \
+                "{:.1f}{}".format(num, unit)
+        num /= 1024.0
+
+
+def print_plan(albums):
+    """Print the schedule of the albums, run one after another, and the
+    totals. Returns the (wall, cpu, written, peak) of the batch"""
+    offset = 0.0
+    kept = 0
+    peak = 0
+    for album in albums:
+        album.print_details(offset)
+        offset += album.wall
+        peak = max(peak, kept + album.peak)
+        kept += album.kept
+    cpu = sum([x.cpu for x in albums])
+    written = sum([x.written for x in albums])
+    print("{} albums  wall {}  cpu {}  written {}  peak disk {}".format(
+        len(albums), duration(offset), duration(cpu), size(written),
+        size(peak)))
+    return offset, cpu, written, peak
@@ -0,0 +1,115 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import shutil
+import subprocess
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ENCODE_SLICE = "rip_lib-encode.slice"
+SLOW = 0.75         # Rip rate, relative to the best seen, that sheds a job
+RECOVER = 0.9       # Rip rate at which a job is given back
+READ_RT_PRIORITY = 10   # Round robin priority of the read, low in 1..99
+
+_config = {
+    "quota": None
+}
+
+
+def have(exe):
+    return shutil.which(exe) is not None
+
+
+def privileged():
+    return os.geteuid() == 0
+
+
+def reader(args):
+    """Prefix the command that reads the CD so it is served first. The
+    realtime CPU and I/O classes need root (without chrt a negative nice
+    is used), otherwise it gets the highest best effort I/O priority"""
+    if not have(args[0]):
+        return list(args)   # Let it fail the usual way
+    prefix = []
+    if privileged():
+        if have("chrt"):
+            prefix += ["chrt", "-r", str(READ_RT_PRIORITY)]
+        elif have("nice"):
+            prefix += ["nice", "-n", "-10"]
+        if have("ionice"):
+            prefix += ["ionice", "-c", "1", "-n", "4"]
+    elif have("ionice"):
+        prefix += ["ionice", "-c", "2", "-n", "0"]
+    return prefix + list(args)
+
+
+def encoder(args):
+    """Prefix an encoder command so it only uses what the rip leaves,
+    and if a CPU quota is set, run it in the slice holding the quota"""
+    if not have(args[0]):
+        return list(args)
+    prefix = []
+    if _config["quota"]:
+        prefix += ["systemd-run", "--user", "--scope", "--quiet",
+            "--slice=" + ENCODE_SLICE]
+    if have("nice"):
+        prefix += ["nice", "-n", "19"]
+    if have("ionice"):
+        prefix += ["ionice", "-c", "3"]
+    return prefix + list(args)
+
+
+def set_cpu_quota(percent):
+    """Cap the CPU used by all encoders together (100 is one core), the
+    cap is held by a systemd user slice that every encoder is run in"""
+    if not percent:
+        _config["quota"] = None
+        return True
+    args = ["systemctl", "--user", "set-property", "--runtime",
+        ENCODE_SLICE, "CPUQuota={}%".format(percent)]
+    print(args)
+    try:
+        ok = subprocess.call(args) == 0
+    except FileNotFoundError:
+        ok = False
+    if not ok or not have("systemd-run"):
+        logger.warning("Cannot set a CPU quota without systemd, ignored")
+        _config["quota"] = None
+        return False
+    _config["quota"] = percent
+    return True
+
+
+class Throttle(object):
+    """Told the rate of each chunk read from the CD, lowers the number of
+    CPU stages the pipeline runs at once when the rip slows, and raises
+    it again when the rip recovers"""
+
+    def __init__(self, flow, resource):
+        self.flow = flow
+        self.resource = resource
+        self.most = flow.limits[resource]
+        self.limit = self.most
+        self.best = 0.0
+
+    def __call__(self, sectors, secs):
+        if secs <= 0:
+            return
+        rate = sectors / secs
+        self.best = max(self.best, rate)
+        limit = self.limit
+        if rate < SLOW * self.best and limit > 1:
+            limit -= 1
+        elif rate >= RECOVER * self.best and limit < self.most:
+            limit += 1
+        if limit != self.limit:
+            logger.info("Rip at %.0f sectors/s (best %.0f), %i encoders",
+                rate, self.best, limit)
+            self.limit = limit
+            self.flow.set_limit(self.resource, limit)
@@ -0,0 +1,185 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Rank the releases (and their media) a disc lookup returns, so the best
+match is taken without asking unless it is too close to call"""
+
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Costs are in seconds of track length deviation from the TOC
+MARGIN = 3.0            # The best must be this far ahead to be taken
+UNKNOWN_LENGTH = 2.0    # Track without a length
+NO_MEDIA = 10.0         # Release listed without its media
+EXACT_DISC = -5.0       # Medium carrying the disc ID of the disc
+COUNTRY_COST = 1.0      # For each place down the preferred list
+STATUS_COST = {
+    "Official": 0.0,
+    "Promotion": 4.0,
+    "Bootleg": 8.0,
+    "Pseudo-Release": 8.0
+}
+OTHER_STATUS = 4.0
+
+_config = {
+    "countries": [],    # Preferred release countries, best first
+    "latest": False,    # Prefer the latest release date, not the earliest
+    "interactive": None     # None means ask only if stdin is a terminal
+}
+
+
+def set_preferences(countries=None, latest=False):
+    _config["countries"] = [x.strip().upper() for x in countries or []
+        if x.strip()]
+    _config["latest"] = latest
+
+
+def set_interactive(flag):
+    """True to ask the user when a lookup is ambiguous, False to never
+    ask, None to ask if there is a terminal"""
+    _config["interactive"] = flag
+
+
+def interactive():
+    if _config["interactive"] is None:
+        try:
+            return sys.stdin.isatty()
+        except (AttributeError, ValueError):
+            return False
+    return _config["interactive"]
+
+
+class Candidate(object):
+    """Something to choose between. content is what the choice gives (e.g.
+    the track titles), candidates with the same content are not a reason
+    to ask"""
+
+    def __init__(self, item, cost, label, content=None, date=None):
+        self.item = item
+        self.cost = cost
+        self.label = label
+        self.content = content
+        self.date = date
+
+
+def ranked(candidates):
+    """The candidates that can match, best first. Equal costs go by the
+    preferred release date, undated last"""
+    dated = sorted([x for x in candidates if x.cost is not None and x.date],
+        key=lambda x: x.date, reverse=_config["latest"])
+    candidates = dated + [x for x in candidates
+        if x.cost is not None and not x.date]
+    candidates.sort(key=lambda x: x.cost)   # Stable, keeps the date order
+    return candidates
+
+
+def rivals(candidates):
+    """The candidates too close to the best to be told apart"""
+    best = candidates[0]
+    return [x for x in candidates[1:] if x.cost - best.cost < MARGIN
+        and (x.content is None or x.content != best.content)]
+
+
+def choose(candidates, what="entry"):
+    """Return the item of the best candidate, or None if none can match.
+    The user is only asked if the best is not clearly ahead"""
+    candidates = ranked(candidates)
+    if not candidates:
+        return None
+    for i, entry in enumerate(candidates):
+        print("[{}]\t{}\t(cost {:.1f})".format(i, entry.label, entry.cost))
+    if len(candidates) == 1 or not rivals(candidates):
+        return candidates[0].item
+    if not interactive():
+        logger.warning("Ambiguous %s, taking %s", what, candidates[0].label)
+        return candidates[0].item
+    while 1:
+        try:
+            selection = input("Select an {} [default=0]?".format(what))
+        except EOFError:
+            selection = ""  # Nobody to ask after all
+        try:
+            selection = 0 if selection == "" else int(selection)
+            return candidates[selection].item
+        except (ValueError, IndexError):
+            print("Please type a number between 0 and {}".format(
+                len(candidates) - 1))
+
+
+def country_cost(country):
+    countries = _config["countries"]
+    if not countries:
+        return 0.0
+    try:
+        return COUNTRY_COST * countries.index(country)
+    except ValueError:
+        return COUNTRY_COST * len(countries)
+
+
+def track_number(track):
+    """Position of a musicbrainz track on its medium"""
+    return int(track.get("position", track.get("number")))
+
+
+def media_cost(media, disc_info, disc_id=None):
+    """How far the track lengths of a musicbrainz medium are from the TOC,
+    None if it cannot be the disc"""
+    tracks = media.get("tracks")
+    if media.get("track-count") != len(disc_info.tracks) or not tracks:
+        return None
+    cost = 0.0
+    for track in tracks:
+        toc_track = disc_info.get_track(track_number(track))
+        if toc_track is None:
+            return None
+        if not track.get("length"):
+            cost += UNKNOWN_LENGTH
+            continue
+        toc_secs = toc_track.length / disc_info.fps
+        cost += abs(toc_secs - track["length"] / 1000.0)
+    if disc_id and disc_id in [x.get("id") for x in media.get("discs", [])]:
+        cost += EXACT_DISC
+    return cost
+
+
+def media_candidates(release, disc_info, disc_id=None):
+    candidates = []
+    for media in release.get("media", []):
+        tracks = media.get("tracks") or []
+        candidates.append(Candidate(media,
+            media_cost(media, disc_info, disc_id),
+            "{} {}".format(media.get("format") or "Medium",
+                media.get("position", "")).strip(),
+            tuple([x.get("title") for x in tracks])))
+    return candidates
+
+
+def release_candidate(release, disc_info, disc_id=None):
+    """A musicbrainz release scored by its best medium, its status and
+    its country"""
+    if "media" in release:
+        media = ranked(media_candidates(release, disc_info, disc_id))
+        if not media:
+            cost = None
+            content = None
+        else:
+            cost = media[0].cost
+            content = media[0].content
+    else:
+        cost = NO_MEDIA
+        content = None
+    if cost is not None:
+        cost += STATUS_COST.get(release.get("status"), OTHER_STATUS)
+        cost += country_cost(release.get("country"))
+    label = " ".join([x for x in (release.get("title"),
+        release.get("country"), release.get("date"), release.get("status"))
+        if x])
+    if content is not None:
+        content = (release.get("title"),) + content
+    return Candidate(release, cost, label, content, release.get("date"))
@@ -0,0 +1,158 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import copy
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.main as rip
+import rip_lib.musicbrainz as musz
+import rip_lib.ogg as ogg
+import rip_lib.id3 as id3
+
+QUEUE_LEN = 8   # Albums looked up ahead of the retagging
+
+OGG_NAMES = {
+    "album": "ALBUM",
+    "artist": "ARTIST",
+    "title": "TITLE",
+    "tracknumber": "TRACKNUMBER"
+}
+
+MP3_NAMES = {
+    "album": "TALB",
+    "artist": "TPE1",
+    "title": "TIT2",
+    "tracknumber": "TRCK"
+}
+
+
+def wanted_tags(info, idx):
+    """The tags track idx (1 based) should have"""
+    track = info.tracks[idx-1]
+    return {
+        "album": rip.extractStr(info.title),
+        "artist": rip.extractStr(track.artist),
+        "title": rip.extractStr(track.title),
+        "tracknumber": str(idx)
+    }
+
+
+def describe(info):
+    """Summary of the metadata, used to see if a refresh changed it"""
+    return (info.title, info.artist,
+        [(track.artist, track.title) for track in info.tracks])
+
+
+def refresh(info):
+    """Fetch the metadata for the album again, return the refreshed copy
+    or the original if it could not be fetched"""
+    if getattr(info, "mbid", None) is None:
+        return info
+    fresh = copy.deepcopy(info)
+    try:
+        if musz.read_track_metadata(fresh):
+            return fresh
+    except (AssertionError, KeyError, ValueError) as err:
+        logger.warning("Failed to refresh %s %s", info.mbid, repr(err))
+    return info
+
+
+def retag_ogg(ogg_file, wanted):
+    """Rewrite the comments if they differ, return True if rewritten"""
+    comments = ogg.read_comments(ogg_file)
+    have = {}
+    for name, value in comments:
+        have.setdefault(name.upper(), value)
+    if all([have.get(OGG_NAMES[key]) == value
+            for key, value in wanted.items()]):
+        return False
+    names = set(OGG_NAMES.values())
+    comments = [(name, value) for name, value in comments
+        if name.upper() not in names]
+    comments += [(OGG_NAMES[key], wanted[key]) for key in sorted(wanted)]
+    logger.info("Retag %s", ogg_file)
+    ogg.write_comments(ogg_file, comments)
+    return True
+
+
+def retag_mp3(mp3_file, wanted):
+    """Rewrite the tags if they differ, return True if rewritten"""
+    have = id3.read_tags(mp3_file)
+    if "TRCK" in have:
+        have["TRCK"] = have["TRCK"].split("/")[0]
+    if all([have.get(MP3_NAMES[key]) == value
+            for key, value in wanted.items()]):
+        return False
+    logger.info("Retag %s", mp3_file)
+    id3.update_frames(mp3_file, [id3.text_frame(MP3_NAMES[key], value)
+        for key, value in sorted(wanted.items())])
+    return True
+
+
+def retag_album(src_dir, info):
+    """Retag the tracks in src_dir, return the number of files looked at
+    and the number rewritten"""
+    checked = rewritten = 0
+    for idx in range(1, info.num_tracks+1):
+        wanted = wanted_tags(info, idx)
+        for filename, retag in (
+            (rip.ogg_filename(src_dir, idx), retag_ogg),
+            (rip.mp3_filename(src_dir, idx), retag_mp3)
+        ):
+            if not os.path.exists(filename):
+                continue
+            checked += 1
+            if retag(filename, wanted):
+                rewritten += 1
+    return checked, rewritten
+
+
+def lookup(directories, jobs):
+    """Load and refresh each album, the lookups are rate limited by the
+    musicbrainz module"""
+    for src_dir in directories:
+        try:
+            info = rip.load_pickle(src_dir)
+            fresh = refresh(info) if info else None
+        except Exception as err:
+            logger.error("Failed to look up %s %s", src_dir, repr(err))
+            info = fresh = None
+        jobs.put((src_dir, info, fresh))
+    jobs.put(None)
+
+
+def retag_library(directories):
+    """Refresh the metadata of every album and rewrite only the tags
+    that have changed"""
+    jobs = queue.Queue(QUEUE_LEN)
+    thread = threading.Thread(target=lookup, args=(directories, jobs))
+    thread.daemon = True
+    thread.start()
+    albums = checked = rewritten = 0
+    while 1:
+        job = jobs.get()
+        if job is None:
+            break
+        src_dir, info, fresh = job
+        if fresh is None:
+            logger.error("No disc information in %s", src_dir)
+            continue
+        if describe(fresh) != describe(info):
+            logger.info("Metadata changed for %s", src_dir)
+            rip.save_pickle(src_dir, fresh)
+        got = retag_album(src_dir, fresh)
+        albums += 1
+        checked += got[0]
+        rewritten += got[1]
+    thread.join()
+    logger.info("Rewrote %i of %i files in %i albums", rewritten, checked,
+        albums)
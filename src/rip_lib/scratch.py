@@ -0,0 +1,163 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import shutil
+import hashlib
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+FAST_VOLUMES = ["/dev/shm"]
+DEF_BUDGET = 2 * 1024 * 1024 * 1024
+HEADROOM = 64 * 1024 * 1024     # Always leave this much free on the volume
+POLL_SECS = 5
+
+
+def free_space(path):
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return 0
+
+
+def choose_volume(work_dir, budget=DEF_BUDGET, volume=None):
+    """Pick where the intermediates go, the volume asked for, else a
+    fast (tmpfs) volume if the whole budget fits on it, else the work
+    directory"""
+    candidates = [volume] if volume else FAST_VOLUMES
+    for candidate in candidates:
+        if os.path.isdir(candidate) and os.access(candidate, os.W_OK) \
+                and free_space(candidate) >= budget + HEADROOM:
+            name = hashlib.sha1(
+                os.path.abspath(work_dir).encode("utf-8")
+            ).hexdigest()[:12]
+            return os.path.join(candidate, "rip_lib-" + name)
+    return work_dir
+
+
+class Scratch(object):
+    """Bounded space for intermediate files, e.g. disc.wav and the track
+    WAVs. Each managed file has an estimated size and a count of pending
+    jobs that need it, once no pending job needs it the file is deleted.
+    Producers wait for space rather than failing when the budget or the
+    volume is full.
+
+    This stands in for least-recently-needed eviction: the pipeline knows
+    every job that will read a file before it starts, so a file nothing
+    is pending on will not be needed again and can go at once, rather
+    than sit in the budget until a producer is short of space"""
+
+    def __init__(self, work_dir, budget=DEF_BUDGET, volume=None):
+        self.budget = budget
+        self.root = choose_volume(work_dir, budget, volume)
+        self.separate = self.root != work_dir
+        if self.separate:
+            try:
+                os.mkdir(self.root)
+            except FileExistsError:
+                pass
+        logger.info("Scratch space in '%s' budget %i MB", self.root,
+            budget // (1024 * 1024))
+        self.sizes = {}     # Estimated size of each managed file
+        self.pending = {}   # Number of pending jobs that need the file
+        self.used = 0       # Bytes reserved or written
+        self._held = {}
+        self._cond = None
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def add(self, filename, size):
+        """Manage filename, size is the estimate used for reserving"""
+        self.sizes[filename] = size
+        self.pending[filename] = 0
+
+    def manages(self, filename):
+        return filename in self.sizes
+
+    def need(self, filename, count=1):
+        """Record that count more pending jobs need filename"""
+        self.pending[filename] += count
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _fits(self, size, fresh):
+        if free_space(self.root) < size + HEADROOM:
+            return False
+        # Jobs that consume intermediates are allowed over the budget
+        # as they lead to space being freed, otherwise they could
+        # deadlock waiting on the producers they follow
+        return not fresh or self.used == 0 or \
+            self.used + size <= self.budget
+
+    async def reserve(self, filename, fresh=True):
+        """Wait until there is room to write filename"""
+        size = self.sizes[filename]
+        cond = self._condition()
+        async with cond:
+            while not self._fits(size, fresh):
+                logger.info("Waiting for scratch space for %s", filename)
+                try:
+                    await asyncio.wait_for(cond.wait(), POLL_SECS)
+                except asyncio.TimeoutError:
+                    pass
+            self._hold(filename, size)
+
+    def _hold(self, filename, size):
+        self.used += size - self._held.get(filename, 0)
+        self._held[filename] = size
+
+    def written(self, filename):
+        """Correct the accounting with the real size of filename"""
+        try:
+            self._hold(filename, os.path.getsize(filename))
+        except FileNotFoundError:
+            self._hold(filename, 0)
+
+    def existing(self, filename):
+        """Account for a file left by an earlier run"""
+        if os.path.exists(filename):
+            self.written(filename)
+
+    def consumed(self, filename):
+        """A job that needed filename has finished with it"""
+        self.pending[filename] -= 1
+        if self.pending[filename] <= 0:
+            self.evict(filename)
+
+    def evict(self, filename):
+        """Delete filename and give back its space"""
+        try:
+            os.unlink(filename)
+            logger.debug("Evicted %s", filename)
+        except FileNotFoundError:
+            pass
+        self.used -= self._held.pop(filename, 0)
+        if self._cond is not None:
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        cond = self._condition()
+        async with cond:
+            cond.notify_all()
+
+    def close(self):
+        """Remove the scratch directory if it is separate and empty"""
+        self._cond = None
+        for filename in list(self._held):
+            if self.pending.get(filename, 0) <= 0:
+                self.evict(filename)
+        if self.separate:
+            try:
+                os.rmdir(self.root)
+            except OSError:
+                pass
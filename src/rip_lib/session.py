@@ -0,0 +1,198 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import copy
+import time
+import fcntl
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.main as rip
+import rip_lib.rank as rank
+import rip_lib.freedb as cddb
+import rip_lib.disc_info as disc_info
+import rip_lib.toc as toc
+
+POLL_SECS = 2           # How often the drive is checked for a new disc
+IDLE_SECS = 15 * 60     # The session ends if no disc arrives for this long
+
+# From linux/cdrom.h
+CDROMEJECT = 0x5309
+CDROM_DRIVE_STATUS = 0x5326
+CDSL_CURRENT = 0x7FFFFFFF
+CDS_DISC_OK = 4
+
+
+def drive_status(device):
+    """The CDS_* status of the drive, None if it cannot be asked"""
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as err:
+        logger.error("Cannot open %s %s", device, repr(err))
+        return None
+    try:
+        return fcntl.ioctl(fd, CDROM_DRIVE_STATUS, CDSL_CURRENT)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def eject(device):
+    """Open the tray so the next disc can go in"""
+    logger.info("Ejecting %s", device)
+    toc.forget(device)
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as err:
+        logger.error("Cannot open %s %s", device, repr(err))
+        return
+    try:
+        fcntl.ioctl(fd, CDROMEJECT)
+    except OSError as err:
+        logger.error("Eject failed %s", repr(err))
+    finally:
+        os.close(fd)
+
+
+def wait_for_disc(device, last=None, idle_secs=IDLE_SECS):
+    """Poll the drive until a disc other than last is loaded, return its
+    DiscInfo or None if none came"""
+    give_up = time.monotonic() + idle_secs
+    while time.monotonic() < give_up:
+        status = drive_status(device)
+        if status is None or status == CDS_DISC_OK:
+            # If the drive cannot say, reading the TOC is the only test
+            info = disc_info.DiscInfo()
+            if info.read_disk(device) and repr(info) != last:
+                return info
+        time.sleep(POLL_SECS)
+    return None
+
+
+def disc_dir(working_dir, num):
+    tmp_dir = os.path.join(working_dir, "tmp_rip{:02d}".format(num))
+    try:
+        os.mkdir(tmp_dir)
+    except FileExistsError:
+        pass
+    return tmp_dir
+
+
+class Session(object):
+    """Rip disc after disc. Once a disc has been read it is ejected and
+    the next one is looked for straight away, while the FLAC and lossy
+    encoding of the discs already read go on in the background. All the
+    discs share one set of resource limits so the drive is never kept
+    waiting by the encoders"""
+
+    def __init__(self, args, working_dir, device=rip.DEVICE):
+        self.args = copy.copy(args)
+        self.args.limiters = {}
+        self.working_dir = working_dir
+        self.device = device
+        self.discs = 0
+
+    async def rip_disc(self, loop, info, drive_free):
+        """Run the pipeline of one disc, drive_free is set once the disc
+        has been read and ejected, or the disc has failed"""
+        self.discs += 1
+        tmp_dir = disc_dir(self.working_dir, self.discs)
+        args = self.args
+        ejected = []
+        try:
+            found = await loop.run_in_executor(None, rip.lookup_disc, args,
+                tmp_dir, info)
+            if not found:
+                return
+            answers = args.answers
+            scratch_space = rip.make_scratch(args, tmp_dir, info)
+            try:
+                flow = rip.build_pipeline(args, tmp_dir, info,
+                    answers["48k"], answers["ogg"], answers["mp3"],
+                    scratch_space)
+
+                read = [stage for stage in flow.stages
+                    if stage.name == "read"][0]
+                read_cd = read.action
+
+                def read_and_eject():
+                    ejected.append(True)
+                    try:
+                        return read_cd()
+                    finally:
+                        eject(self.device)
+                        loop.call_soon_threadsafe(drive_free.set)
+
+                read.action = read_and_eject
+                if read not in flow.needed():
+                    ejected.append(True)
+                    eject(self.device)
+                    drive_free.set()
+                await flow.run_async()
+            finally:
+                scratch_space.close()
+            await loop.run_in_executor(None, rip.finish, args, tmp_dir,
+                info, answers["ogg"], answers["mp3"])
+            logger.info("Disc %s done", info.title)
+        finally:
+            # The disc is ejected, whatever went wrong, so the session
+            # carries on with the next one
+            if not ejected:
+                eject(self.device)
+            drive_free.set()
+
+    async def run_async(self):
+        loop = asyncio.get_event_loop()
+        running = []
+        last = None
+        while 1:
+            print("Waiting for a disc in {}".format(self.device))
+            info = await loop.run_in_executor(None, wait_for_disc,
+                self.device, last)
+            if info is None:
+                break
+            last = repr(info)
+            drive_free = asyncio.Event()
+            running.append(asyncio.ensure_future(
+                self.rip_disc(loop, info, drive_free)))
+            await drive_free.wait()
+        cddb.close_sessions()
+        if running:
+            print("No more discs, finishing the conversions")
+            results = await asyncio.gather(*running, return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    logger.error("Disc failed %s", repr(result))
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.run_async())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def main(args, working_dir):
+    """Ask the questions once, then rip every disc put in the drive"""
+    answers = dict(args.answers)
+    for name, question in (("48k", "Use 48K sample rate?"),
+            ("ogg", "Convert to OGG?"), ("mp3", "Convert to MP3?")):
+        if name not in answers:
+            answers[name] = rip.yes_or_no(question)
+    # Nobody is watching each disc, so take the unattended choices
+    answers.setdefault("tags", False)
+    answers.setdefault("rename", True)
+    answers.setdefault("skip", True)
+    args.answers = answers
+    rank.set_interactive(False)
+    Session(args, working_dir).run()
@@ -0,0 +1,195 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import wave
+import subprocess
+import logging
+
+import numpy as np
+
+import rip_lib.priority as priority
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+BLOCK_FRAMES = 16384    # Frames read from the WAV at a time
+
+
+def rm_file(temp_file):
+    try:
+        os.unlink(temp_file)
+    except FileNotFoundError:
+        pass
+
+
+class Encoder(object):
+    """An encoder process that reads raw 16 bit little endian PCM on its
+    stdin and writes temp_file, renamed to out_file when it is done"""
+
+    def __init__(self, args, temp_file, out_file):
+        self.args = args
+        self.temp_file = temp_file
+        self.out_file = out_file
+        self.proc = None
+
+    def start(self):
+        rm_file(self.temp_file)
+        print(self.args)
+        try:
+            self.proc = subprocess.Popen(priority.encoder(self.args),
+                stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            print("Check %s is installed\n" % self.args[0])
+            return False
+        return True
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def finish(self):
+        self.proc.stdin.close()
+        status = self.proc.wait()
+        try:
+            if status != 0:
+                logger.error("%s failed with %i", self.args[0], status)
+                return False
+            os.rename(self.temp_file, self.out_file)
+        except FileNotFoundError:
+            return False
+        finally:
+            rm_file(self.temp_file)
+        return True
+
+    def abort(self):
+        if self.proc:
+            self.proc.kill()
+            self.proc.wait()
+        rm_file(self.temp_file)
+
+
+def pcm_blocks(wav_file, block=BLOCK_FRAMES):
+    """Yield the sample rate, channels and raw PCM of a 16 bit WAV file,
+    one block at a time"""
+    in_fp = wave.open(wav_file, "rb")
+    try:
+        if in_fp.getsampwidth() != 2:
+            raise RuntimeError("{} is not 16 bit".format(wav_file))
+        rate = in_fp.getframerate()
+        channels = in_fp.getnchannels()
+        while 1:
+            data = in_fp.readframes(block)
+            if not data:
+                break
+            yield rate, channels, data
+    finally:
+        in_fp.close()
+
+
+def to_float(data, channels):
+    """Raw 16 bit PCM to float samples in -1..1 as (samples, channels)"""
+    samples = np.frombuffer(data, dtype="<i2").reshape(-1, channels)
+    return samples / 32768.0
+
+
+def to_pcm(samples):
+    """Float samples as (samples, channels) to raw 16 bit PCM"""
+    samples = np.clip(np.round(samples * 32768.0), -32768, 32767)
+    return samples.astype("<i2").tobytes()
+
+
+def make_chain(filters, rate, channels):
+    """Make the filters, returns them and the sample rate that comes out of
+    the last one. A filter that changes the rate (e.g. a resampler) says
+    so with its out_rate, a filter function may return None if it has
+    nothing to do"""
+    chain = []
+    for make in filters:
+        filt = make(rate, channels)
+        if filt is None:
+            continue
+        chain.append(filt)
+        rate = getattr(filt, "out_rate", rate)
+    return chain, rate
+
+
+def flush_chain(chain):
+    """The samples the filters still hold once the input has ended, or
+    None"""
+    samples = None
+    for filt in chain:
+        if samples is not None and len(samples):
+            samples = filt.process(samples)
+        flush = getattr(filt, "flush", None)
+        if flush:
+            tail = flush()
+            samples = tail if samples is None else np.concatenate(
+                (samples, tail))
+    return samples
+
+
+def convert(wav_file, encoders, analysers=(), filters=(), taps=()):
+    """Read the WAV once and send the same PCM to every encoder and every
+    analyser. encoders are functions of (rate, channels) that return the
+    (args, temp_file, out_file) of an encoder command, analysers are
+    functions of (rate, channels) that return an object with a process()
+    method taking float samples. filters are made the same way, but their
+    process() returns the samples changed, they are applied in order
+    before the encoders and analysers see the PCM and may change its
+    sample rate. taps are analysers of the PCM as read, before the
+    filters. Returns the analysers followed by the taps"""
+    running = []
+    active = None
+    tapped = []
+    chain = []
+
+    def send(data, samples):
+        for encoder in running:
+            encoder.write(data)
+        if active:
+            if samples is None:
+                samples = to_float(data, channels)
+            for analyser in active:
+                analyser.process(samples)
+
+    try:
+        for rate, channels, data in pcm_blocks(wav_file):
+            if active is None:
+                chain, out_rate = make_chain(filters, rate, channels)
+                for make in encoders:
+                    encoder = Encoder(*make(out_rate, channels))
+                    if not encoder.start():
+                        raise RuntimeError("Encoder failed to start")
+                    running.append(encoder)
+                active = [make(out_rate, channels) for make in analysers]
+                tapped = [make(rate, channels) for make in taps]
+            samples = None
+            if tapped:
+                samples = to_float(data, channels)
+                for analyser in tapped:
+                    analyser.process(samples)
+            if chain:
+                if samples is None:
+                    samples = to_float(data, channels)
+                for filt in chain:
+                    samples = filt.process(samples)
+                if not len(samples):
+                    continue
+                data = to_pcm(samples)
+            send(data, samples)
+        samples = flush_chain(chain)
+        if samples is not None and len(samples):
+            send(to_pcm(samples), samples)
+    except:
+        for encoder in running:
+            encoder.abort()
+        raise
+    ok = True
+    for encoder in running:
+        ok = encoder.finish() and ok
+    if not ok:
+        return None
+    return (active or []) + tapped
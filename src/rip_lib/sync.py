@@ -0,0 +1,241 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Keep a copy of the converted tracks in a player or export directory.
+The target holds a manifest of what was copied, with the hash of every
+block of each file, so a re-sync only writes the blocks that changed and
+renames and deletions never copy data"""
+
+import os
+import pickle
+import hashlib
+import concurrent.futures
+import logging
+
+import rip_lib.discover as discover
+import rip_lib.verify as verify
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+MANIFEST = ".rip_lib-sync"
+BLOCK_SIZE = 64 * 1024
+SAVE_EVERY = 50         # Files synced between saves of the manifest
+FORMATS = [".mp3"]
+
+
+def source_files(root, formats):
+    """The {relative path: filename} of the tracks to sync under root"""
+    files = {}
+    for album_dir in discover.find_directories(root):
+        for name in os.listdir(album_dir):
+            if name.startswith("temp.") or \
+                    os.path.splitext(name)[1] not in formats:
+                continue
+            filename = os.path.join(album_dir, name)
+            files[os.path.normpath(os.path.relpath(filename, root))] = \
+                filename
+    return files
+
+
+def block_hashes(filename, bucket=None):
+    """The sha1 of the file and of each of its blocks"""
+    whole = hashlib.sha1()
+    blocks = []
+    with open(filename, "rb") as in_fp:
+        while 1:
+            data = in_fp.read(BLOCK_SIZE)
+            if not data:
+                break
+            if bucket:
+                bucket.take(len(data))
+            whole.update(data)
+            blocks.append(hashlib.sha1(data).digest())
+    return whole.hexdigest(), blocks
+
+
+class Manifest(object):
+    """What is in the target, keyed by relative path. Each entry holds the
+    size, the sha1, the block hashes and the key of the source it was
+    copied from"""
+
+    def __init__(self, target):
+        self.filename = os.path.join(target, MANIFEST)
+        try:
+            with open(self.filename, "rb") as pkl_fd:
+                self.files = pickle.load(pkl_fd)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.files = {}
+
+    def save(self):
+        temp_file = self.filename + ".tmp"
+        with open(temp_file, "wb") as pkl_fd:
+            pickle.dump(self.files, pkl_fd)
+        os.rename(temp_file, self.filename)
+
+
+def copy_file(filename, dest, bucket=None):
+    """Copy the whole file, through a temp file so an interrupted copy is
+    never taken for a good one. Returns the bytes written"""
+    temp_file = os.path.join(os.path.dirname(dest),
+        "temp." + os.path.basename(dest))
+    written = 0
+    try:
+        with open(filename, "rb") as in_fp, open(temp_file, "wb") as out_fp:
+            while 1:
+                data = in_fp.read(BLOCK_SIZE)
+                if not data:
+                    break
+                if bucket:
+                    bucket.take(len(data))
+                out_fp.write(data)
+                written += len(data)
+        os.rename(temp_file, dest)
+    finally:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+    return written
+
+
+def patch_file(filename, dest, old_blocks, new_blocks, bucket=None):
+    """Write only the blocks of dest that differ from the source. Blocks
+    are either old or new, so an interrupted patch is finished by the next
+    one. Returns the bytes written"""
+    written = 0
+    with open(filename, "rb") as in_fp, open(dest, "r+b") as out_fp:
+        for num, block in enumerate(new_blocks):
+            if num < len(old_blocks) and old_blocks[num] == block:
+                continue
+            in_fp.seek(num * BLOCK_SIZE)
+            data = in_fp.read(BLOCK_SIZE)
+            if bucket:
+                bucket.take(len(data))
+            out_fp.seek(num * BLOCK_SIZE)
+            out_fp.write(data)
+            written += len(data)
+        out_fp.truncate(os.path.getsize(filename))
+    return written
+
+
+def sync_file(filename, dest, entry, bucket=None):
+    """Bring dest up to date with filename, entry is what the manifest
+    says dest holds. Returns the new entry and the bytes written"""
+    sha1, blocks = block_hashes(filename, bucket)
+    key = verify.file_key(filename)
+    new_entry = {"size": key[0], "sha1": sha1, "blocks": blocks, "key": key}
+    if entry and entry["sha1"] == sha1:
+        return new_entry, 0
+    if entry and os.path.exists(dest) and \
+            os.path.getsize(dest) == entry["size"]:
+        written = patch_file(filename, dest, entry["blocks"], blocks, bucket)
+    else:
+        dest_dir = os.path.dirname(dest)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir, exist_ok=True)
+        written = copy_file(filename, dest, bucket)
+    return new_entry, written
+
+
+def remove_empty_dirs(target, rel_path):
+    """Remove the directories left empty by rel_path going"""
+    rel_dir = os.path.dirname(rel_path)
+    while rel_dir:
+        try:
+            os.rmdir(os.path.join(target, rel_dir))
+        except OSError:
+            break
+        rel_dir = os.path.dirname(rel_dir)
+
+
+def sync_library(root, target, formats=None, jobs=None, bandwidth=None):
+    """Copy the tracks under root into target, only files that are new or
+    changed are written, and only the changed blocks of those. bandwidth
+    limits the bytes read and written per second by all the copies
+    together. Returns the number of files and bytes written"""
+    formats = formats or FORMATS
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    manifest = Manifest(target)
+    files = source_files(root, formats)
+
+    todo = []
+    for rel_path, filename in sorted(files.items()):
+        entry = manifest.files.get(rel_path)
+        dest = os.path.join(target, rel_path)
+        if entry and entry["key"] == verify.file_key(filename) and \
+                os.path.exists(dest):
+            continue
+        todo.append(rel_path)
+
+    # Files gone from the source are renames if the content turns up
+    # again under a new path, else deletions. Identical files can go at
+    # once, so each content maps to all the paths it had
+    gone = {}
+    for rel_path in sorted(manifest.files):
+        if rel_path not in files:
+            entry = manifest.files[rel_path]
+            gone.setdefault((entry["size"], entry["sha1"]), []).append(
+                rel_path)
+    if gone:
+        sizes = set([size for size, sha1 in gone])
+        for rel_path in list(todo):
+            filename = files[rel_path]
+            size = os.path.getsize(filename)
+            if size not in sizes or rel_path in manifest.files:
+                continue
+            old_paths = gone.get((size, block_hashes(filename)[0]))
+            if not old_paths:
+                continue
+            old_path = old_paths.pop(0)
+            dest = os.path.join(target, rel_path)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.rename(os.path.join(target, old_path), dest)
+            except FileNotFoundError:
+                del manifest.files[old_path]
+                continue
+            logger.info("Renamed %s to %s", old_path, rel_path)
+            manifest.files[rel_path] = manifest.files.pop(old_path)
+            manifest.files[rel_path]["key"] = verify.file_key(filename)
+            todo.remove(rel_path)
+            remove_empty_dirs(target, old_path)
+        for rel_path in sorted([x for paths in gone.values() for x in paths]):
+            logger.info("Deleting %s", rel_path)
+            try:
+                os.unlink(os.path.join(target, rel_path))
+            except FileNotFoundError:
+                pass
+            del manifest.files[rel_path]
+            remove_empty_dirs(target, rel_path)
+    logger.info("%i of %i files to sync", len(todo), len(files))
+
+    bucket = verify.TokenBucket(bandwidth) if bandwidth else None
+    synced = 0
+    done = 0
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) \
+            as pool:
+        futures = dict([(pool.submit(sync_file, files[rel_path],
+            os.path.join(target, rel_path), manifest.files.get(rel_path),
+            bucket), rel_path) for rel_path in todo])
+        for future in concurrent.futures.as_completed(futures):
+            rel_path = futures[future]
+            try:
+                entry, written = future.result()
+            except OSError as err:
+                logger.error("Cannot sync %s %s", rel_path, repr(err))
+                continue
+            manifest.files[rel_path] = entry
+            if written:
+                done += 1
+                total += written
+            synced += 1
+            if synced % SAVE_EVERY == 0:
+                manifest.save()
+    manifest.save()
+    logger.info("Wrote %i bytes to %i files", total, done)
+    return done, total
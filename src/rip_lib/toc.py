@@ -0,0 +1,113 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+"""Read the TOC of a CD with the CDROMREADTOC ioctls, and remember what
+was read for each device until the disc in it is changed, so the drive is
+only spun up once per disc"""
+
+import os
+import struct
+import fcntl
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# From linux/cdrom.h
+CDROMREADTOCHDR = 0x5305
+CDROMREADTOCENTRY = 0x5306
+CDROM_MEDIA_CHANGED = 0x5325
+CDROM_TIMED_MEDIA_CHANGE = 0x5396
+CDSL_CURRENT = 0x7FFFFFFF
+CDROM_LBA = 0x01
+CDROM_LEADOUT = 0xAA
+CTRL_PRE_EMPHASIS = 0x01
+CTRL_DATA = 0x04
+
+TOCHDR = "BB"
+TOCENTRY = "BBBiB3x"            # track, adr:4 ctrl:4, format, lba, datamode
+TIMED_CHANGE = "qQ"             # last_media_change (ms), media_flags
+LBA_OFFSET = 150                # Sectors before LBA 0, the 2 second pregap
+SESSION_GAP = 11400             # Lead out and lead in before a data session
+
+_lock = threading.Lock()
+_cache = {}         # device -> (media key, what was read)
+_changes = {}       # device -> count of media changes seen
+
+
+def read_entries(device):
+    """The [(track, offset, ctrl)] of the tracks and the offset of the lead
+    out, in sectors from the start of the disc. Raises OSError if the TOC
+    cannot be read"""
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        first, last = struct.unpack(TOCHDR, fcntl.ioctl(fd, CDROMREADTOCHDR,
+            struct.pack(TOCHDR, 0, 0)))
+        entries = []
+        for num in list(range(first, last + 1)) + [CDROM_LEADOUT]:
+            data = fcntl.ioctl(fd, CDROMREADTOCENTRY,
+                struct.pack(TOCENTRY, num, 0, CDROM_LBA, 0, 0))
+            track, adr_ctrl, _, lba, _ = struct.unpack(TOCENTRY, data)
+            entries.append((num, lba + LBA_OFFSET, adr_ctrl >> 4))
+    finally:
+        os.close(fd)
+    leadout = entries.pop()[1]
+    return entries, leadout
+
+
+def media_key(device):
+    """A value that changes whenever the disc in the drive does, None if
+    the drive cannot tell. The kernel keeps the time of the last change,
+    older kernels only say if there was a change since last asked so the
+    changes are counted"""
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        try:
+            data = fcntl.ioctl(fd, CDROM_TIMED_MEDIA_CHANGE,
+                struct.pack(TIMED_CHANGE, 0, 0))
+            return struct.unpack(TIMED_CHANGE, data)[0]
+        except OSError:
+            pass
+        try:
+            changed = fcntl.ioctl(fd, CDROM_MEDIA_CHANGED, CDSL_CURRENT)
+        except OSError:
+            return None
+        if changed:
+            _changes[device] = _changes.get(device, 0) + 1
+        return ("count", _changes.get(device, 0))
+    finally:
+        os.close(fd)
+
+
+def cached(device, probe):
+    """What probe() reads of the disc in device, probe is only called when
+    the disc has changed since it last was. None (no disc) is not kept"""
+    with _lock:
+        key = media_key(device)
+        if key is not None:
+            found = _cache.get(device)
+            if found and found[0] == key:
+                logger.debug("TOC of %s unchanged", device)
+                return found[1]
+        result = probe()
+        if result is None or key is None:
+            _cache.pop(device, None)
+        else:
+            _cache[device] = (key, result)
+        return result
+
+
+def forget(device=None):
+    """Read the disc again next time, e.g. after ejecting it"""
+    with _lock:
+        if device is None:
+            _cache.clear()
+        else:
+            _cache.pop(device, None)
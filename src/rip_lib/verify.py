@@ -0,0 +1,154 @@
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import os
+import time
+import threading
+import subprocess
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+import rip_lib.library as library
+
+READ_SIZE = 1 << 18     # Bytes fed to a checker at a time
+SAVE_EVERY = 50         # Results between saves of the index
+
+CHECKERS = {
+    # Extension, command that checks the file read on stdin
+    ".flac": ["flac", "-t", "-s", "-"],
+    ".ogg": ["oggdec", "-Q", "-o", os.devnull, "-"],
+    ".mp3": ["mpg123", "-q", "-t", "-"],
+}
+
+
+class TokenBucket(object):
+    """Limit the rate of reads shared by all the checker threads"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(rate, READ_SIZE)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, num):
+        """Wait until num bytes may be read"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= num
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def file_key(filename):
+    """A file is checked again if its size, mtime or inode change"""
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def check_file(filename, bucket=None):
+    """Decode the file, feeding it through stdin so the reads can be
+    rate limited. Return True if it decodes without error"""
+    args = CHECKERS[os.path.splitext(filename)[1]]
+    try:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        logger.error("Check %s is installed", args[0])
+        return None
+    try:
+        with open(filename, "rb") as in_fp:
+            while 1:
+                data = in_fp.read(READ_SIZE)
+                if not data:
+                    break
+                if bucket:
+                    bucket.take(len(data))
+                proc.stdin.write(data)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass    # The checker gave up early, its status says why
+    except OSError as err:
+        logger.error("Reading %s %s", filename, repr(err))
+        proc.kill()
+        proc.wait()
+        return False
+    return proc.wait() == 0
+
+
+def album_files(album_dir):
+    """The archive and lossy files of an album that can be checked"""
+    return sorted([os.path.join(album_dir, name)
+        for name in os.listdir(album_dir)
+        if not name.startswith("temp.") and
+        os.path.splitext(name)[1] in CHECKERS])
+
+
+def verify_library(root, jobs=None, bandwidth=None):
+    """Check every archived album under root, only files that are new or
+    changed since they were last checked are decoded. bandwidth is the
+    read limit in bytes per second for all checks together. Return the
+    list of bad files"""
+    index = library.LibraryIndex(root)
+    index.update()
+    todo = []
+    bad = []
+    cached = 0
+    for album_dir, entry in sorted(index.albums.items()):
+        results = entry.setdefault("verified", {})
+        names = set()
+        for filename in album_files(album_dir):
+            name = os.path.basename(filename)
+            names.add(name)
+            key = file_key(filename)
+            result = results.get(name)
+            if result and result[0] == key:
+                cached += 1
+                if not result[1]:
+                    bad.append(filename)
+                continue
+            todo.append((album_dir, name, key))
+        for name in list(results):
+            if name not in names:
+                del results[name]
+                index.mark(album_dir, "verified")
+    logger.info("%i files to check, %i unchanged since last checked",
+        len(todo), cached)
+
+    bucket = TokenBucket(bandwidth) if bandwidth else None
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) \
+            as pool:
+        futures = dict([(pool.submit(check_file,
+            os.path.join(album_dir, name), bucket), (album_dir, name, key))
+            for album_dir, name, key in todo])
+        for future in concurrent.futures.as_completed(futures):
+            album_dir, name, key = futures[future]
+            filename = os.path.join(album_dir, name)
+            ok = future.result()
+            if ok is None:
+                continue    # No checker, so nothing learnt
+            if not ok:
+                logger.error("%s failed verification", filename)
+                bad.append(filename)
+            entry = index.albums.get(album_dir)
+            if entry is None:
+                continue    # Removed from the library meanwhile
+            entry.setdefault("verified", {})[name] = (key, ok)
+            index.mark(album_dir, "verified")
+            done += 1
+            if done % SAVE_EVERY == 0:
+                index.save()
+    index.save()
+    logger.info("Checked %i files, %i bad", done + cached, len(bad))
+    return sorted(bad)
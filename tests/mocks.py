@@ -10,6 +10,23 @@
 import builtins
 import urllib.request
 
+from rip_lib import disc_info
+
+
+def make_disc(lengths=(7500, 7500), title=None, first=150):
+    """A disc of audio tracks lengths sectors long, the default is two
+    tracks of 100 seconds"""
+    info = disc_info.DiscInfo()
+    offset = first
+    for num, length in enumerate(lengths, 1):
+        track = info.add_track(num, offset)
+        track.add_toc_info(False, length)
+        offset += length
+    if title is not None:
+        info.title = title
+    return info
+
+
 class PatchInput:
     """A mock for input()
 
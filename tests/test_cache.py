@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import cache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "disc.flac")
+        with open(self.filename, "wb") as out_fp:
+            out_fp.write(b"fLaC" * 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_prefetch(self):
+        """The read ahead stops at the limit"""
+        self.assertEqual(cache.prefetch(self.filename), 4 * 1024 * 1024)
+        self.assertEqual(cache.prefetch(self.filename, cache.BLOCK_SIZE),
+            cache.BLOCK_SIZE)
+        self.assertEqual(cache.prefetch(self.filename + ".missing"), 0)
+
+    def test_prefetcher(self):
+        prefetcher = cache.Prefetcher()
+        prefetcher.add(self.filename)
+        prefetcher.add(self.filename + ".missing")
+        prefetcher.close()
+        self.assertIsNone(prefetcher.thread)
+
+    def test_drop(self):
+        """Dropping is only a hint, the file is unchanged"""
+        cache.drop(self.filename, written=True)
+        cache.drop(self.filename + ".missing")
+        self.assertEqual(os.path.getsize(self.filename), 4 * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,8 @@ import sys
 import os
 import unittest
 import socket
+import socketserver
+import threading
 import urllib.request
 
 import mocks
@@ -18,6 +20,8 @@ lib_path = os.path.join(os.path.dirname(__file__), "..")
 sys.path.insert(0, lib_path)
 
 from rip_lib import freedb
+from rip_lib import rank
+from rip_lib import disc_info
 from rip_lib import __main__ as rip_lib_main
 
 class Dummy:
@@ -92,6 +96,7 @@ class TestCddbFunctions(unittest.TestCase):
    
     def setUp(self):
         freedb.get_hello_str.cache_clear()
+        freedb.use_cddbp = False
 
     def tearDown(self):
         pass
@@ -209,15 +214,32 @@ class TestCddbFunctions(unittest.TestCase):
     def test_query_cddb210(self):
         obj = Disc()
         obj.test_create1()
-        with mocks.PatchUrlOpen(Response(2), 0, None) as opener:
-            with mocks.PatchInput(["1"]) as p:
-                result = freedb.query_cddb(obj)
+        rank.set_interactive(True)
+        try:
+            with mocks.PatchUrlOpen(Response(2), 0, None) as opener:
+                with mocks.PatchInput(["1"]) as p:
+                    result = freedb.query_cddb(obj)
+        finally:
+            rank.set_interactive(None)
         self.assertEqual(result.category, "category2")
         self.assertEqual(result.disc_id, "disc-id2")
         self.assertEqual(result.artist, None)
         self.assertEqual(result.title, "title2")
         self.assertEqual(result.name(), "title2")
 
+    def test_query_cddb210_unattended(self):
+        """With nobody to ask the first match is taken"""
+        obj = Disc()
+        obj.test_create1()
+        rank.set_interactive(False)
+        try:
+            with mocks.PatchUrlOpen(Response(2), 0, None) as opener:
+                with mocks.PatchInput([]) as p:
+                    result = freedb.query_cddb(obj)
+        finally:
+            rank.set_interactive(None)
+        self.assertEqual(result.disc_id, "disc-id1")
+
     def test_query_cddb200(self):
         obj = Disc()
         obj.test_create1()
@@ -243,6 +265,86 @@ class TestCddbFunctions(unittest.TestCase):
         self.assertEqual(items['name2'], 'value2')
 
 
+class CddbpHandler(socketserver.StreamRequestHandler):
+    """A CDDBP server that knows one disc"""
+
+    replies = {
+        "cddb hello": ["200 Hello and welcome"],
+        "proto": ["201 OK, CDDB protocol level now: 5"],
+        "cddb query": ["200 rock abcd Artist / Album"],
+        "cddb read": ["210 rock abcd CD database entry follows",
+            "# comment", "DTITLE=Artist / Album", "TTITLE0=Song", "."],
+    }
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b"201 test CDDBP server v1.5 ready\r\n")
+        for line in self.rfile:
+            cmd = line.decode("utf-8").strip()
+            self.server.commands.append(cmd)
+            if cmd == "quit":
+                self.wfile.write(b"230 Goodbye\r\n")
+                break
+            for prefix, reply in self.replies.items():
+                if cmd.startswith(prefix):
+                    break
+            else:
+                reply = ["500 Unrecognized command"]
+            self.wfile.write("".join([x + "\r\n" for x in reply]).encode(
+                "utf-8"))
+
+
+class TestCddbpSession(unittest.TestCase):
+
+    def setUp(self):
+        freedb.use_cddbp = True
+        freedb._no_cddbp.clear()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0),
+            CddbpHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.commands = []
+        self.saved_port = freedb.CDDBP_PORT
+        freedb.CDDBP_PORT = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        freedb.close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+        freedb.CDDBP_PORT = self.saved_port
+        freedb.use_cddbp = False
+
+    def test_session_reused(self):
+        """One handshake serves several discs"""
+        url = "http://127.0.0.1/~cddb/cddb.cgi"
+        for i in range(2):
+            disc = disc_info.DiscInfo()
+            track = disc.add_track(1, 150)
+            track.add_toc_info(False, 1000)
+            disc.disc_len = 1000
+            freedb.get_track_info(disc, url)
+            self.assertEqual(disc.category, "rock")
+            self.assertEqual(disc.tracks[0].title, "Song")
+        self.assertEqual(self.server.connections, 1)
+        commands = [cmd.split()[0:2] for cmd in self.server.commands]
+        self.assertEqual(commands, [["cddb", "hello"], ["proto", "5"]] +
+            [["cddb", "query"], ["cddb", "read"]] * 2)
+
+    def test_http_fallback(self):
+        """If there is no CDDBP server HTTP is used"""
+        freedb.CDDBP_PORT = 1
+        disc = Disc()
+        disc.test_create1()
+        with mocks.PatchUrlOpen(Response(3), 0, None) as opener:
+            result = freedb.query_cddb(disc, "http://127.0.0.1/cddb.cgi")
+        self.assertEqual(result.disc_id, "disc-id")
+        self.assertIn("cmd=cddb+query+", opener.url)
+        self.assertIn("127.0.0.1", freedb._no_cddbp)
+
+
 if __name__ == '__main__':
     rip_lib_main.config_logging()
     unittest.main()
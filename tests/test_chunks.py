@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import wave
+import shutil
+import tempfile
+import unittest
+
+import mocks
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import chunks
+from rip_lib import main as rip
+from rip_lib import musicbrainz as musz
+from rip_lib import pipeline
+
+
+class PatchRead:
+    """Fill the chunks read with a byte rather than running cdparanoia,
+    recording the ranges read"""
+
+    def __init__(self, tmp_dir, fill=b"\x01"):
+        self.tmp_dir = tmp_dir
+        self.fill = fill
+        self.reads = []
+
+    def rip_chunk(self, store, device, first, last):
+        temp_file = os.path.join(self.tmp_dir, "temp.raw")
+        with open(temp_file, "wb") as out_fp:
+            out_fp.write(self.fill * (last - first + 1) * chunks.SECTOR_SIZE)
+        self.reads.append((first, last))
+        return store.add(first, last, temp_file)
+
+    def __enter__(self):
+        self._saved = chunks.ChunkStore.rip_chunk
+        patch = self
+        chunks.ChunkStore.rip_chunk = \
+            lambda store, *args: patch.rip_chunk(store, *args)
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        chunks.ChunkStore.rip_chunk = self._saved
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_tracks(self):
+        self.assertEqual(rip.parse_tracks("5-7,2, 6"), [2, 5, 6, 7])
+        self.assertRaises(ValueError, rip.parse_tracks, "3-1")
+        self.assertRaises(ValueError, rip.parse_tracks, "a")
+
+    def test_selected_spans(self):
+        """Neighbouring tracks are read in one span"""
+        info = mocks.make_disc([10, 20, 30, 40])
+        self.assertEqual(chunks.selected_spans(info, [4, 1, 2]),
+            [(0, 29), (60, 99)])
+        self.assertTrue(rip.select_tracks(info, [2, 4]))
+        self.assertEqual([track.num for track in rip.selected_tracks(info)],
+            [2, 4])
+        self.assertFalse(rip.select_tracks(info, [5]))
+        self.assertTrue(rip.select_tracks(info, [1, 2, 3, 4]))
+        self.assertIsNone(info.selected)
+
+    def test_assemble_fill(self):
+        """The sectors of the tracks not read are silent in the WAV"""
+        store = chunks.ChunkStore(self.tmp_dir, "disc-id")
+        temp_file = os.path.join(self.tmp_dir, "part.raw")
+        with open(temp_file, "wb") as out_fp:
+            out_fp.write(b"\x01" * 5 * chunks.SECTOR_SIZE)
+        self.assertTrue(store.add(2, 6, temp_file))
+        wav_file = os.path.join(self.tmp_dir, "disc.wav")
+        self.assertRaises(RuntimeError, store.assemble, wav_file, 0, 9)
+        store.assemble(wav_file, 0, 9, True)
+        in_fp = wave.open(wav_file, "rb")
+        data = in_fp.readframes(in_fp.getnframes())
+        in_fp.close()
+        size = chunks.SECTOR_SIZE
+        self.assertEqual(len(data), 10 * size)
+        self.assertEqual(data, bytes(2 * size) + b"\x01" * 5 * size +
+            bytes(3 * size))
+
+    def add_chunk(self, store, first, last, fill=b"\x01"):
+        temp_file = os.path.join(self.tmp_dir, "part.raw")
+        with open(temp_file, "wb") as out_fp:
+            out_fp.write(fill * (last - first + 1) * chunks.SECTOR_SIZE)
+        self.assertTrue(store.add(first, last, temp_file))
+
+    def test_verify(self):
+        """Chunks that are missing, truncated or changed are dropped, the
+        store reopened keeps the good ones"""
+        store = chunks.ChunkStore(self.tmp_dir, "disc-id", 10)
+        for first in range(0, 40, 10):
+            self.add_chunk(store, first, first + 9)
+        os.unlink(store._chunk_file(10, 19))
+        with open(store._chunk_file(20, 29), "r+b") as out_fp:
+            out_fp.truncate(5 * chunks.SECTOR_SIZE)
+        with open(store._chunk_file(30, 39), "r+b") as out_fp:
+            out_fp.write(b"\x02")
+        self.assertEqual(store.verify(), 10)
+        self.assertEqual(store.present(), [(0, 9)])
+        self.assertFalse(os.path.exists(store._chunk_file(20, 29)))
+        self.assertEqual(chunks.ChunkStore(self.tmp_dir, "disc-id",
+            10).present(), [(0, 9)])
+        # The chunks of another disc are not used
+        self.assertEqual(chunks.ChunkStore(self.tmp_dir, "other-id",
+            10).present(), [])
+
+    def test_missing(self):
+        """The ranges still to read stay on the chunk grid around the
+        chunks held"""
+        store = chunks.ChunkStore(self.tmp_dir, "disc-id", 10)
+        self.assertEqual(store.missing(5, 24), [(5, 9), (10, 19), (20, 24)])
+        self.add_chunk(store, 12, 15)
+        self.add_chunk(store, 20, 29)
+        self.assertEqual(store.missing(0, 35),
+            [(0, 9), (10, 11), (16, 19), (30, 35)])
+        self.assertEqual(store.missing(21, 28), [])
+        self.assertEqual(store.missing(14, 22), [(16, 19)])
+
+    def test_resume(self):
+        """A re-run rip only reads the chunks that went bad"""
+        info = mocks.make_disc([3000, 3000])
+        with PatchRead(self.tmp_dir) as patch:
+            rip.read_cd(self.tmp_dir, info)
+        self.assertEqual(patch.reads, [(0, 2249), (2250, 4499),
+            (4500, 5999)])
+        os.unlink(os.path.join(self.tmp_dir, rip.WAVFILE))
+        store = chunks.ChunkStore(self.tmp_dir,
+            musz.musicbrainz_disc_id(info))
+        with open(store._chunk_file(2250, 4499), "r+b") as out_fp:
+            out_fp.seek(1000)
+            out_fp.write(b"\x02")
+        os.unlink(store._chunk_file(4500, 5999))
+        with PatchRead(self.tmp_dir, b"\x03") as patch:
+            rip.read_cd(self.tmp_dir, info)
+        self.assertEqual(patch.reads, [(2250, 4499), (4500, 5999)])
+        in_fp = wave.open(os.path.join(self.tmp_dir, rip.WAVFILE), "rb")
+        data = in_fp.readframes(in_fp.getnframes())
+        in_fp.close()
+        size = chunks.SECTOR_SIZE
+        self.assertEqual(len(data), 6000 * size)
+        self.assertEqual(data[:2250 * size], b"\x01" * 2250 * size)
+        self.assertEqual(data[2250 * size:], b"\x03" * 3750 * size)
+
+    def test_read_selected(self):
+        """A partial rip still gives a WAV of the whole disc"""
+        info = mocks.make_disc([10, 20, 30, 40])
+        rip.select_tracks(info, [2])
+        with PatchRead(self.tmp_dir) as patch:
+            rip.read_cd(self.tmp_dir, info)
+        self.assertEqual(patch.reads, [(10, 29)])
+        in_fp = wave.open(os.path.join(self.tmp_dir, rip.WAVFILE), "rb")
+        self.assertEqual(in_fp.getnframes() * 4, 100 * chunks.SECTOR_SIZE)
+        in_fp.close()
+
+    def test_read_fails(self):
+        """A failed read fails the stage, not the whole process"""
+        info = mocks.make_disc([10, 20])
+        saved = chunks.ChunkStore.rip_chunk
+        chunks.ChunkStore.rip_chunk = lambda store, *args: False
+        try:
+            flow = pipeline.Pipeline()
+            flow.add("read", lambda: rip.read_cd(self.tmp_dir, info),
+                outputs=[os.path.join(self.tmp_dir, rip.WAVFILE)])
+            self.assertRaises(RuntimeError, flow.run)
+        finally:
+            chunks.ChunkStore.rip_chunk = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
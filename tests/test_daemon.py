@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import unittest
+
+import mocks
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import client
+from rip_lib import daemon
+from rip_lib import main as rip
+from rip_lib import rank
+
+
+class PatchMain:
+    """Stand in for rip.main, recording the jobs run"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def main(self, args, wdir):
+        args.progress("read", "start")
+        args.progress("read", "done")
+        self.jobs.append((wdir, args.only_convert, dict(args.answers)))
+        if wdir.endswith("bad"):
+            raise RuntimeError("No disc")
+
+    def __enter__(self):
+        self._saved = rip.main
+        rip.main = self.main
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        rip.main = self._saved
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_env = os.environ.get("XDG_RUNTIME_DIR")
+        os.environ["XDG_RUNTIME_DIR"] = self.tmp_dir
+        self.wdir = os.path.join(self.tmp_dir, "album")
+        os.mkdir(self.wdir)
+
+    def tearDown(self):
+        if self.saved_env is None:
+            del os.environ["XDG_RUNTIME_DIR"]
+        else:
+            os.environ["XDG_RUNTIME_DIR"] = self.saved_env
+        rank.set_interactive(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def start(self):
+        defaults = argparse.Namespace(library=None)
+        self.daemon = daemon.Daemon(defaults, workers=1)
+        self.server = threading.Thread(target=self.daemon.serve)
+        self.server.start()
+        for i in range(100):
+            if client.running():
+                return
+            time.sleep(0.05)
+        self.fail("Daemon did not start")
+
+    def stop(self):
+        self.assertEqual(client.main(["--shutdown"]), 0)
+        self.server.join(30)
+        self.assertFalse(self.server.is_alive())
+        self.assertFalse(os.path.exists(client.socket_path()))
+
+    def test_no_daemon(self):
+        """Any options, even ones the client does not know, are left for
+        rip_lib to run locally"""
+        self.assertEqual(client.main(["--tracks", "2", self.wdir]),
+            client.NO_DAEMON)
+        self.assertNotEqual(client.NO_DAEMON, 2)
+
+    def test_submit(self):
+        with PatchMain() as patch:
+            self.start()
+            try:
+                self.assertEqual(client.main(["--ogg", "--wait", self.wdir]),
+                    0)
+                bad = os.path.join(self.tmp_dir, "bad")
+                os.mkdir(bad)
+                self.assertEqual(client.main(["--only-convert", "--mp3",
+                    "--wait", bad]), 1)
+                jobs = client.request({"cmd": "list"})["jobs"]
+                self.assertEqual([x["state"] for x in jobs],
+                    ["done", "failed"])
+                self.assertEqual(jobs[0]["stages"]["done"], 1)
+                self.assertIn("No disc", jobs[1]["error"])
+                self.assertEqual(client.main(["--status"]), 0)
+                reply = client.request({"cmd": "status", "id": 99})
+                self.assertFalse(reply["ok"])
+            finally:
+                self.stop()
+        self.assertEqual(patch.jobs[0][:2], (self.wdir, False))
+        self.assertEqual([patch.jobs[0][2][x] for x in ("ogg", "mp3", "48k")],
+            [True, False, False])
+        self.assertTrue(patch.jobs[1][1])
+
+    def test_unknown_option(self):
+        """Options only rip_lib takes are refused, rather than ripping
+        locally while the daemon has the drive"""
+        self.start()
+        try:
+            self.assertEqual(client.main(["--tracks", "2", self.wdir]), 1)
+        finally:
+            self.stop()
+
+    def test_ask(self):
+        """With no formats given the user is asked, not the daemon"""
+        saved = sys.stdin.isatty
+        sys.stdin.isatty = lambda: True
+        with PatchMain() as patch:
+            self.start()
+            try:
+                with mocks.PatchInput(["n", "y", "y"]):
+                    self.assertEqual(client.main(["--wait", self.wdir]), 0)
+            finally:
+                sys.stdin.isatty = saved
+                self.stop()
+        answers = patch.jobs[0][2]
+        self.assertEqual([answers[x] for x in ("48k", "ogg", "mp3")],
+            [False, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import analysis
+from rip_lib import disc_info
+from rip_lib import distribute
+from rip_lib import id3
+from rip_lib import loudness
+from rip_lib import main as rip
+
+
+def make_album(album_dir, num_tracks):
+    info = disc_info.DiscInfo()
+    info.title = "Album " + os.path.basename(album_dir)
+    for num in range(1, num_tracks + 1):
+        track = info.add_track(num, 150 + num * 1000)
+        track.add_toc_info(False, 1000)
+        track.title = "Track {}".format(num)
+        track.artist = "Artist"
+    os.mkdir(album_dir)
+    rip.save_pickle(album_dir, info)
+    return album_dir
+
+
+class FakeWorker(distribute.Worker):
+    """Worker that makes up the encoded files rather than running the
+    encoders"""
+
+    rates = []
+    fail = set()    # (album, track) to fail once
+
+    def encode(self, tmp_dir, formats, track, do48k=False):
+        if (self.album, track["idx"]) in self.fail:
+            self.fail.discard((self.album, track["idx"]))
+            raise RuntimeError("Track failed to encode")
+        self.rates.append(do48k)
+        meter = loudness.LoudnessMeter(44100)
+        data = "{} {} {}".format(self.album, track["idx"], track["title"])
+        return [data.encode("utf-8")] * len(formats), \
+            loudness.pack(meter.result()), \
+            analysis.TrackAnalyser(44100).result()
+
+
+class TestDistribute(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_leases(self):
+        """A track is only ever leased to one worker, the workers share
+        the tracks of an album"""
+        albums = [make_album(os.path.join(self.root, name), 2)
+            for name in ("a", "b")]
+        coordinator = distribute.Coordinator(albums, ["mp3"])
+        leases = [coordinator.lease(x) for x in ("w1", "w2", "w3", "w4")]
+        self.assertEqual([(album.id, idx) for album, idx in leases],
+            [(1, 1), (1, 2), (2, 1), (2, 2)])
+        self.assertEqual(coordinator.lease("w1"), leases[0])
+        self.assertIsNone(coordinator.lease("w5"))
+        self.assertIs(coordinator.held("w2", 1, 2), leases[1][0])
+        self.assertRaises(ValueError, coordinator.held, "w2", 1, 1)
+        self.assertRaises(ValueError, coordinator.held, "w5", 1, 1)
+
+    def test_lease_lapses(self):
+        """A silent worker loses its track"""
+        albums = [make_album(os.path.join(self.root, "a"), 1)]
+        coordinator = distribute.Coordinator(albums, ["mp3"], lease_secs=-1)
+        album, idx = coordinator.lease("w1")
+        self.assertEqual(coordinator.lease("w2"), (album, idx))
+        self.assertRaises(ValueError, coordinator.held, "w1", album.id, idx)
+
+    def test_failed(self):
+        """A track that fails goes back in the pool, until it has failed
+        too often"""
+        albums = [make_album(os.path.join(self.root, "a"), 2)]
+        coordinator = distribute.Coordinator(albums, ["mp3"])
+        album, idx = coordinator.lease("w1")
+        coordinator.failed("w1", album.id, idx, "error")
+        self.assertEqual(coordinator.lease("w2"), (album, idx))
+        for i in range(distribute.MAX_TRIES - 1):
+            coordinator.failed("w2", album.id, idx, "error")
+            coordinator.lease("w2")
+        self.assertEqual(album.failed, [idx])
+        self.assertEqual(album.todo, set([2]))
+        self.assertEqual(coordinator.lease("w3"), None)
+
+    def test_localhost(self):
+        """Several workers on localhost convert every track once"""
+        albums = [make_album(os.path.join(self.root, name), 3)
+            for name in ("a", "b", "c")]
+        with open(os.path.join(albums[0], rip.COVERFILE), "wb") as out_fp:
+            out_fp.write(b"JPEG")
+        FakeWorker.rates = []
+        FakeWorker.fail = set([(1, 2), (3, 1)])
+        coordinator = distribute.Coordinator(albums, ["mp3"], do48k=True)
+        host, port = coordinator.bind("127.0.0.1", 0)
+        server = threading.Thread(target=coordinator.serve)
+        server.start()
+        counts = []
+        workers = [threading.Thread(target=lambda: counts.append(
+            FakeWorker(host, port).run())) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        server.join(30)
+        self.assertEqual(sum(counts), 9)
+        self.assertEqual(FakeWorker.rates, [True] * 9)
+        for album_dir in albums:
+            for idx in range(1, 4):
+                mp3 = rip.mp3_filename(album_dir, idx)
+                with open(mp3, "rb") as in_fp:
+                    data = in_fp.read()
+                self.assertTrue(data.endswith("Track {}".format(idx).encode(
+                    "utf-8")))
+                tags = id3.read_tags(mp3)
+                self.assertEqual(tags["TRCK"], "{}/3".format(idx))
+                with open(mp3, "rb") as in_fp:
+                    frames = dict(id3.read_frames(in_fp)[1])
+                self.assertIn("TXXX", frames)
+                self.assertEqual("APIC" in frames, album_dir == albums[0])
+            info = rip.load_pickle(album_dir)
+            self.assertIn("REPLAYGAIN_ALBUM_GAIN", info.replaygain)
+
+
+if __name__ == '__main__':
+    unittest.main()
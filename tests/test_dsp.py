@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import wave
+import shutil
+import tempfile
+import functools
+import unittest
+
+import numpy as np
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import analysis
+from rip_lib import disc_info
+from rip_lib import dsp
+from rip_lib import loudness
+from rip_lib import stream
+
+
+def sine(rate, freq, level_db, secs, channels=2):
+    t = np.arange(int(rate * secs)) / float(rate)
+    x = 10 ** (level_db / 20.0) * np.sin(2 * np.pi * freq * t)
+    return np.stack([x] * channels, axis=1)
+
+
+class TestDspFunctions(unittest.TestCase):
+
+    def test_iir_blocks(self):
+        """Filtering in blocks matches the plain difference equation"""
+        b, a = dsp.biquad_highpass(44100, 38.0, 0.5)
+        x = np.random.RandomState(1).uniform(-1, 1, (3000, 1))
+        expect = np.zeros(len(x))
+        for n in range(len(x)):
+            acc = 0.0
+            for j in range(3):
+                if n - j >= 0:
+                    acc += b[j] * x[n - j, 0]
+                if j > 0 and n - j >= 0:
+                    acc -= a[j] * expect[n - j]
+            expect[n] = acc
+        filt = dsp.IIRFilter(b, a, 1, block=256)
+        got = np.concatenate([filt.process(x[:1000]), filt.process(x[1000:])])
+        self.assertTrue(np.allclose(got[:, 0], expect, atol=1e-9))
+
+    def test_deemphasis(self):
+        """De-emphasis follows the 50/15us curve"""
+        b, a = dsp.deemphasis(44100)
+        for freq in (100, 1000, 5000, 10000, 16000):
+            z = np.exp(-2j * np.pi * freq / 44100)
+            got = np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+            w = 2j * np.pi * freq
+            expect = (1 + w * 15e-6) / (1 + w * 50e-6)
+            self.assertAlmostEqual(20 * np.log10(abs(got)),
+                20 * np.log10(abs(expect)), delta=0.1)
+
+    def test_resample(self):
+        """44.1k to 48k in uneven blocks keeps the timing and the level of
+        a sine, and gives the right number of samples"""
+        x = sine(44100, 1000, -6.0, 2)
+        resampler = dsp.Resampler(44100, 48000, 2, dither=False)
+        blocks = [resampler.process(x[i:i+3001])
+            for i in range(0, len(x), 3001)]
+        y = np.concatenate(blocks + [resampler.flush()])
+        self.assertEqual(len(y), 96000)
+        expect = sine(48000, 1000, -6.0, 2)
+        error = np.abs(y - expect)[500:-500].max()
+        self.assertLess(error, 10 ** (-80 / 20.0))
+
+    def test_dither(self):
+        """TPDF dither is at most one 16 bit step either way"""
+        x = np.zeros((44100, 2))
+        resampler = dsp.Resampler(44100, 48000, 2, seed=1)
+        y = np.concatenate([resampler.process(x), resampler.flush()])
+        self.assertLessEqual(np.abs(y).max(), 1.0 / 32768)
+        self.assertGreater(y.std(), 0.3 / 32768)
+
+    def test_stream_48k(self):
+        """The resampler in the conversion stream gives 48k PCM to the
+        analysers, tail included"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            wav_file = os.path.join(tmp_dir, "track01.wav")
+            out_fp = wave.open(wav_file, "wb")
+            out_fp.setnchannels(2)
+            out_fp.setsampwidth(2)
+            out_fp.setframerate(44100)
+            out_fp.writeframes(stream.to_pcm(sine(44100, 997, -20.0, 1)))
+            out_fp.close()
+            seen = []
+
+            class Counter(object):
+                def __init__(self, rate, channels):
+                    seen.append(rate)
+
+                def process(self, x):
+                    seen.append(len(x))
+
+            stream.convert(wav_file, [], [Counter],
+                [functools.partial(dsp.resampler, 48000)])
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(seen[0], 48000)
+        self.assertEqual(sum(seen[1:]), 48000)
+
+    def test_analysis(self):
+        """Silence, hidden audio and clipping are found in the PCM as read,
+        before it is resampled"""
+        rate = 44100
+        silence = lambda secs: np.zeros((int(rate * secs), 2))
+        loud = sine(rate, 997, -6.0, 0.5)
+        loud[1000:1010] = 1.0
+        x = np.concatenate((silence(1), loud, silence(12),
+            sine(rate, 997, -6.0, 1), silence(0.25)))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            wav_file = os.path.join(tmp_dir, "track01.wav")
+            out_fp = wave.open(wav_file, "wb")
+            out_fp.setnchannels(2)
+            out_fp.setsampwidth(2)
+            out_fp.setframerate(rate)
+            out_fp.writeframes(stream.to_pcm(x))
+            out_fp.close()
+            analysers = stream.convert(wav_file, [], [],
+                [functools.partial(dsp.resampler, 48000)],
+                [analysis.TrackAnalyser])
+        finally:
+            shutil.rmtree(tmp_dir)
+        result = analysers[0].result()
+        self.assertAlmostEqual(result["length"], 14.75)
+        self.assertAlmostEqual(result["lead_silence"], 1.0, places=3)
+        self.assertAlmostEqual(result["trail_silence"], 0.25, places=3)
+        self.assertAlmostEqual(result["longest_silence"], 12.0, places=3)
+        self.assertAlmostEqual(result["hidden_at"], 13.5, places=3)
+        self.assertEqual(result["clipped"], 20)
+        self.assertAlmostEqual(result["peak"], 1.0, places=3)
+        self.assertLess(result["rms"], 0.5)
+        info = disc_info.DiscInfo(lead_in=300)
+        info.add_track(1, 300).analysis = result
+        warnings = analysis.report(info)
+        self.assertEqual(len(warnings), 3)
+        self.assertIn("pregap", warnings[0])
+        self.assertIn("hidden track", warnings[1])
+
+    def test_sine_loudness(self):
+        """A -20 dBFS 997Hz sine in both channels is -20 LUFS"""
+        meter = loudness.LoudnessMeter(48000)
+        x = sine(48000, 997, -20.0, 5)
+        for i in range(0, len(x), 10000):
+            meter.process(x[i:i+10000])
+        result = meter.result()
+        self.assertAlmostEqual(result["histogram"].integrated(), -20.0,
+            places=1)
+        self.assertAlmostEqual(result["peak"], 0.1, places=3)
+        tags = loudness.track_tags(result)
+        self.assertEqual(tags["REPLAYGAIN_TRACK_GAIN"], "2.00 dB")
+
+    def test_album_gain(self):
+        """The album histogram is the sum of the track histograms"""
+        results = []
+        for level in (-20.0, -30.0):
+            meter = loudness.LoudnessMeter(44100)
+            meter.process(sine(44100, 997, level, 3))
+            results.append(meter.result())
+        tags = loudness.album_tags(results)
+        self.assertEqual(tags["REPLAYGAIN_ALBUM_PEAK"], "{:.6f}".format(
+            results[0]["peak"]))
+        gain = float(tags["REPLAYGAIN_ALBUM_GAIN"].split()[0])
+        # Both tracks are above the relative gate, so it is the mean power
+        expect = -18.0 - 10 * np.log10((10 ** -2.0 + 10 ** -3.0) / 2)
+        self.assertAlmostEqual(gain, expect, places=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
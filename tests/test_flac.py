@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import flac
+
+AUDIO = b"\xff\xf8audio frames" * 1000
+
+
+def make_flac(filename, padding):
+    blocks = [[flac.STREAMINFO, bytes(34)]]
+    if padding:
+        blocks.append([flac.PADDING, bytes(padding)])
+    with open(filename, "wb") as out_fp:
+        out_fp.write(b"fLaC" + flac.pack_blocks(blocks) + AUDIO)
+
+
+class TestFlac(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.flac_file = os.path.join(self.tmp_dir, "disc.flac")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def audio_offset(self):
+        with open(self.flac_file, "rb") as in_fp:
+            blocks, offset = flac.read_blocks(in_fp)
+            in_fp.seek(offset)
+            self.assertEqual(in_fp.read(), AUDIO)
+        return offset
+
+    def test_in_place(self):
+        """Tags, a picture and a cuesheet go in the padding"""
+        make_flac(self.flac_file, 4096)
+        offset = self.audio_offset()
+        self.assertTrue(flac.update_comments(self.flac_file,
+            [("ALBUM", "Album"), ("REPLAYGAIN_ALBUM_GAIN", "-1.00 dB")]))
+        metadata = flac.Metadata(self.flac_file)
+        metadata.add_picture(flac.picture(b"JPEG" * 100, "image/jpeg",
+            500, 500, 24))
+        metadata.set_block(flac.CUESHEET, b"cue" * 10)
+        self.assertTrue(metadata.save())
+        self.assertTrue(flac.update_comments(self.flac_file,
+            [("REPLAYGAIN_ALBUM_GAIN", "-2.00 dB")]))
+        self.assertEqual(self.audio_offset(), offset)
+        self.assertEqual(flac.read_comments(self.flac_file),
+            [("ALBUM", "Album"), ("REPLAYGAIN_ALBUM_GAIN", "-2.00 dB")])
+        metadata = flac.Metadata(self.flac_file)
+        self.assertEqual([block[0] for block in metadata.blocks],
+            [flac.STREAMINFO, flac.VORBIS_COMMENT, flac.PICTURE,
+            flac.CUESHEET])
+
+    def test_rewrite(self):
+        """Without padding the file is rewritten once, with padding for
+        next time"""
+        make_flac(self.flac_file, 0)
+        self.assertFalse(flac.update_comments(self.flac_file,
+            [("ALBUM", "Album")]))
+        offset = self.audio_offset()
+        self.assertGreater(offset, flac.PADDING_SIZE)
+        self.assertTrue(flac.update_comments(self.flac_file,
+            [("TITLE", "Title")]))
+        self.assertEqual(self.audio_offset(), offset)
+        self.assertEqual(flac.read_comments(self.flac_file),
+            [("ALBUM", "Album"), ("TITLE", "Title")])
+
+    def test_exact_fit(self):
+        """Metadata that fills the space exactly needs no padding block,
+        three bytes short cannot hold one so the file is rewritten"""
+        make_flac(self.flac_file, 0)
+        metadata = flac.Metadata(self.flac_file)
+        metadata.set_block(flac.APPLICATION, b"abcd")
+        metadata.save()
+        room = self.audio_offset() - 4
+        metadata = flac.Metadata(self.flac_file)
+        used = len(flac.pack_blocks(metadata.blocks))
+        metadata.set_block(flac.APPLICATION, b"abcd" + bytes(room - used))
+        self.assertTrue(metadata.save())
+        metadata = flac.Metadata(self.flac_file)
+        metadata.set_block(flac.APPLICATION, b"abcd" + bytes(room - used - 3))
+        self.assertFalse(metadata.save())
+        self.audio_offset()
+
+
+if __name__ == '__main__':
+    unittest.main()
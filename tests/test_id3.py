@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import disc_info
+from rip_lib import id3
+from rip_lib import main as rip
+
+AUDIO = b"\xff\xfb\x90\x00mp3 frames" * 100
+
+
+def v23_frame(frame_id, body, flags=0):
+    return frame_id.encode("ascii") + struct.pack(">IH", len(body), flags) + \
+        body
+
+
+def v24_frame(frame_id, body, flags=0):
+    return frame_id.encode("ascii") + id3.to_syncsafe(len(body)) + \
+        struct.pack(">H", flags) + body
+
+
+def tag(major, frames):
+    data = b"".join(frames)
+    return b"ID3" + bytes([major, 0, 0]) + id3.to_syncsafe(len(data)) + data
+
+
+class TestId3(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_album(self, num_tracks):
+        info = disc_info.DiscInfo()
+        info.title = "Album"
+        for num in range(1, num_tracks + 1):
+            track = info.add_track(num, 150 + num * 1000)
+            track.add_toc_info(False, 1000)
+            track.title = "Song {}".format(num)
+            track.artist = "Artist"
+            with open(rip.mp3_filename(self.tmp_dir, num), "wb") as out_fp:
+                out_fp.write(AUDIO)
+        return info
+
+    def read(self, filename):
+        with open(filename, "rb") as in_fp:
+            major, frames, size = id3.read_frames(in_fp)
+            in_fp.seek(size)
+            self.assertEqual(in_fp.read(), AUDIO)
+        return frames, size
+
+    def test_in_place(self):
+        """The first tag is padded so the next edit does not move the
+        audio"""
+        info = self.make_album(1)
+        mp3 = rip.mp3_filename(self.tmp_dir, 1)
+        self.assertFalse(id3.update_frames(mp3,
+            [id3.text_frame("TIT2", "Song")]))
+        size = self.read(mp3)[1]
+        self.assertTrue(id3.update_frames(mp3,
+            [id3.txxx_frame("REPLAYGAIN_TRACK_GAIN", "-3.00 dB")]))
+        self.assertEqual(self.read(mp3)[1], size)
+        self.assertEqual(id3.read_tags(mp3)["TIT2"], "Song")
+
+    def test_album(self):
+        """Each track gets its own number and the shared cover"""
+        info = self.make_album(3)
+        info.replaygain = {"REPLAYGAIN_ALBUM_GAIN": "-1.00 dB"}
+        with open(os.path.join(self.tmp_dir, rip.COVERFILE), "wb") as out_fp:
+            out_fp.write(b"JPEG")
+        self.assertTrue(rip.fix_mp3_tags(self.tmp_dir, info))
+        for num in range(1, 4):
+            mp3 = rip.mp3_filename(self.tmp_dir, num)
+            tags = id3.read_tags(mp3)
+            self.assertEqual(tags["TRCK"], "{}/3".format(num))
+            self.assertEqual(tags["TIT2"], "Song {}".format(num))
+            self.assertEqual(tags["TALB"], "Album")
+            frames = dict(self.read(mp3)[0])
+            self.assertTrue(frames["APIC"].endswith(b"\x00JPEG"))
+            self.assertTrue(frames["APIC"].startswith(b"\x03image/jpeg\x00"))
+
+    def test_v23(self):
+        """A v2.3 tag is rewritten as v2.4, the year and date become TDRC
+        and compressed frames are kept"""
+        mp3 = os.path.join(self.tmp_dir, "track.mp3")
+        title = b"\x00Song"
+        with open(mp3, "wb") as out_fp:
+            out_fp.write(tag(3, [
+                v23_frame("TYER", b"\x002001"),
+                v23_frame("TDAT", b"\x000512"),
+                v23_frame("TIT2", struct.pack(">I", len(title)) +
+                    zlib.compress(title), 0x0080),
+                v23_frame("TPE1", b"\x01secret", 0x0040),
+                v23_frame("TALB", b"\x00Old", 0x8000),
+                v23_frame("TORY", b"\x001999")]) + AUDIO)
+        id3.update_frames(mp3, [id3.text_frame("TRCK", "1")])
+        with open(mp3, "rb") as in_fp:
+            major, frames, size = id3.read_frames(in_fp)
+        self.assertEqual(major, 4)
+        self.assertEqual([frame_id for frame_id, body in frames],
+            ["TIT2", "TDOR", "TDRC", "TRCK"])
+        tags = id3.read_tags(mp3)
+        self.assertEqual(tags["TIT2"], "Song")
+        self.assertEqual(tags["TDRC"], "2001-12-05")
+        self.assertEqual(self.read(mp3)[1], size)
+
+    def test_v24_flags(self):
+        """Unsynchronised frames, with or without a data length, are
+        decoded"""
+        mp3 = os.path.join(self.tmp_dir, "track.mp3")
+        title = "Song \u00ff\u00e9".encode("utf-16")
+        synced = title.replace(b"\xff", b"\xff\x00")
+        with open(mp3, "wb") as out_fp:
+            out_fp.write(tag(4, [
+                v24_frame("TIT2", b"\x01" + synced, 0x0002),
+                v24_frame("TALB", id3.to_syncsafe(6) + b"\x03Album",
+                    0x0001),
+                v24_frame("TPE1", b"\x03" + zlib.compress(b"Artist"),
+                    0x0008)]) + AUDIO)
+        tags = id3.read_tags(mp3)
+        self.assertEqual(tags["TIT2"], "Song \u00ff\u00e9")
+        self.assertEqual(tags["TALB"], "Album")
+        self.assertNotIn("TPE1", tags)
+
+    def test_id3v1(self):
+        """An ID3v1 tag at the end is kept in step with the new tag"""
+        mp3 = os.path.join(self.tmp_dir, "track.mp3")
+        old = b"TAG" + b"Old".ljust(90, b"\x00") + b"1999" + \
+            b"comment".ljust(28, b"\x00") + b"\x00\x05\x0c"
+        with open(mp3, "wb") as out_fp:
+            out_fp.write(AUDIO + old)
+        id3.update_frames(mp3, [id3.text_frame("TIT2", "Song"),
+            id3.text_frame("TALB", "Album"), id3.text_frame("TRCK", "2/3")])
+        with open(mp3, "rb") as in_fp:
+            self.assertEqual(id3.read_id3v1(in_fp), {"TIT2": "Song",
+                "TPE1": "", "TALB": "Album", "TRCK": "2"})
+            in_fp.seek(-128, 2)
+            data = in_fp.read()
+        self.assertEqual(data[93:], old[93:126] + b"\x02\x0c")
+
+
+if __name__ == '__main__':
+    unittest.main()
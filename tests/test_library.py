@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import stat
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import mocks
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import chunks
+from rip_lib import discover
+from rip_lib import library
+from rip_lib import main as rip
+
+# Decodes --skip..--until as silence, one sample short for the track
+# starting at the sample given
+FLAC_STUB = """#!{}
+import sys
+args = dict([x[2:].split("=", 1) for x in sys.argv if "=" in x])
+skip, until = int(args["skip"]), int(args["until"])
+if skip == {}:
+    until -= 1
+sys.stdout.buffer.write(bytes((until - skip) * 4))
+"""
+
+
+class PatchImport:
+    """Record the sectors imported from the archive rather than running
+    flac"""
+
+    def __init__(self):
+        self.spans = []
+
+    def import_flac(self, store, flac_file, first, last):
+        self.spans.append((first, last))
+        return True
+
+    def __enter__(self):
+        self._saved = chunks.ChunkStore.import_flac
+        patch = self
+        chunks.ChunkStore.import_flac = \
+            lambda store, *args: patch.import_flac(store, *args)
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        chunks.ChunkStore.import_flac = self._saved
+
+
+class TestLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, "library")
+        self.rip_dir = os.path.join(self.tmp_dir, "tmp_rip")
+        os.mkdir(self.root)
+        os.mkdir(self.rip_dir)
+        library._indexes.clear()
+
+    def tearDown(self):
+        library._indexes.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def archive(self, name, info, selected=None):
+        album_dir = os.path.join(self.root, name)
+        os.mkdir(album_dir)
+        info.selected = selected
+        rip.save_pickle(album_dir, info)
+        for other in (library.FLAC_FILE, "disc.cue"):
+            with open(os.path.join(album_dir, other), "wb") as out_fp:
+                out_fp.write(b"x")
+        return album_dir
+
+    def test_index(self):
+        """The index finds an archived disc, and picks up albums added
+        and removed since it was last used"""
+        album_dir = self.archive("Album", mocks.make_disc([1000, 2000]))
+        index = library.open_index(self.root)
+        self.assertEqual(index.lookup(mocks.make_disc([1000, 2000])),
+            [os.path.abspath(album_dir)])
+        self.assertEqual(index.lookup(mocks.make_disc([1500, 2000])), [])
+        other_dir = self.archive("Other", mocks.make_disc([3000]))
+        self.assertIs(library.open_index(self.root), index)
+        self.assertEqual(index.lookup(mocks.make_disc([3000])),
+            [os.path.abspath(other_dir)])
+        # A new process reads the saved index
+        self.assertEqual(sorted(library.LibraryIndex(self.root).albums),
+            sorted([os.path.abspath(album_dir), os.path.abspath(other_dir)]))
+        shutil.rmtree(album_dir)
+        self.assertEqual(sorted(library.open_index(self.root).albums),
+            [os.path.abspath(other_dir)])
+
+    def test_shared(self):
+        """Saving the index of one process keeps what another process
+        has written since, e.g. the results of a verify run"""
+        album_dir = os.path.abspath(self.archive("Album",
+            mocks.make_disc([1000, 2000])))
+        index = library.open_index(self.root)
+        other = library.LibraryIndex(self.root)
+        other.albums[album_dir]["verified"] = {"disc.flac": ("key", True)}
+        other.mark(album_dir, "verified")
+        other.save()
+        other_dir = os.path.abspath(self.archive("Other",
+            mocks.make_disc([3000])))
+        library.open_index(self.root)
+        albums = library.LibraryIndex(self.root).albums
+        self.assertEqual(sorted(albums), [album_dir, other_dir])
+        self.assertEqual(albums[album_dir]["verified"],
+            {"disc.flac": ("key", True)})
+        self.assertEqual(index.albums[album_dir]["verified"],
+            {"disc.flac": ("key", True)})
+
+    def test_rescan(self):
+        """Only the directories that have changed are listed again"""
+        self.archive("Album", mocks.make_disc([1000, 2000]))
+        os.mkdir(os.path.join(self.root, "Artist"))
+        self.archive(os.path.join("Artist", "Other"), mocks.make_disc([3000]))
+        listed = []
+        saved = discover.os.listdir
+
+        def listdir(path):
+            listed.append(os.path.relpath(path, self.root))
+            return saved(path)
+
+        discover.os.listdir = listdir
+        try:
+            index = library.open_index(self.root)
+            self.assertEqual(len(listed), 4)
+            # The root holds the index just written, so is listed again
+            del listed[:]
+            library.open_index(self.root)
+            self.assertEqual(listed, ["."])
+            del listed[:]
+            library.open_index(self.root)
+            self.assertEqual(listed, [])
+            self.archive(os.path.join("Artist", "New"),
+                mocks.make_disc([4000]))
+            library.open_index(self.root)
+            self.assertEqual(sorted(listed), ["Artist",
+                os.path.join("Artist", "New")])
+        finally:
+            discover.os.listdir = saved
+        self.assertEqual(len(index.albums), 3)
+
+    def test_verify_track(self):
+        info = mocks.make_disc([1000, 2000, 1500])
+        first = chunks.track_span(info, 2)[0] * chunks.SAMPLES_PER_SECTOR
+        stub = os.path.join(self.tmp_dir, "flac")
+        with open(stub, "w") as out_fp:
+            out_fp.write(FLAC_STUB.format(sys.executable, first))
+        os.chmod(stub, stat.S_IRWXU)
+        album_dir = self.archive("Album", info)
+        saved = library.FLAC_EXE
+        library.FLAC_EXE = stub
+        try:
+            self.assertEqual(library.verify_tracks(album_dir, info), [2])
+            self.assertEqual(library.verify_tracks(album_dir, info, [1, 3]),
+                [])
+        finally:
+            library.FLAC_EXE = saved
+
+    def test_archived(self):
+        """A disc already in the library is skipped if asked to"""
+        self.archive("Album", mocks.make_disc([1000, 2000]))
+        args = argparse.Namespace(library=self.root,
+            answers={"skip": True})
+        self.assertFalse(rip.check_library(args, self.rip_dir,
+            mocks.make_disc([1000, 2000])))
+        self.assertTrue(rip.check_library(args, self.rip_dir,
+            mocks.make_disc([1500, 2000])))
+        args.answers = {"skip": False, "reread": False}
+        self.assertTrue(rip.check_library(args, self.rip_dir,
+            mocks.make_disc([1000, 2000])))
+
+    def test_merge(self):
+        """When only some tracks are archived the rip reads the others,
+        the archived ones are copied from the archive"""
+        self.archive("Album", mocks.make_disc([1000, 2000, 1500]), [2])
+        info = mocks.make_disc([1000, 2000, 1500])
+        args = argparse.Namespace(library=self.root, answers={})
+        with PatchImport() as patch:
+            self.assertTrue(rip.check_library(args, self.rip_dir, info))
+        self.assertEqual(patch.spans, [chunks.track_span(info, 2)])
+        self.assertIsNone(info.selected)
+
+        # The archive and the rip together are still not the whole disc
+        info = mocks.make_disc([1000, 2000, 1500])
+        rip.select_tracks(info, [3])
+        with PatchImport() as patch:
+            self.assertTrue(rip.check_library(args, self.rip_dir, info))
+        self.assertEqual(patch.spans, [chunks.track_span(info, 2)])
+        self.assertEqual(info.selected, [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
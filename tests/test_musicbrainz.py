@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import io
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+import urllib.request
+
+import mocks
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import musicbrainz as musz
+from rip_lib import rank
+
+
+def medium(position, length, prefix="Song"):
+    credit = [{"artist": {"name": "Artist"}}]
+    return {
+        "position": position,
+        "track-count": 2,
+        "tracks": [{"number": str(num), "title": "{} {}".format(prefix, num),
+            "length": length, "artist-credit": credit} for num in (1, 2)]
+    }
+
+
+def release(mbid, media=None, **fields):
+    obj = {
+        "id": mbid,
+        "title": "Album",
+        "status": "Official",
+        "artist-credit": [{"artist": {"name": "Artist"}}],
+        "media": media or [medium(1, 100000)]
+    }
+    obj.update(fields)
+    return obj
+
+
+class PatchServers:
+    """Answer urlopen the way musicbrainz and the cover art archive do, and
+    count the requests"""
+
+    def __init__(self, disc_id, releases=None):
+        self.disc_id = disc_id
+        self.releases = releases or [release("mbid-1")]
+        self.urls = []
+
+    def mock_urlopen(self, req):
+        url = req.full_url if hasattr(req, "full_url") else req
+        self.urls.append(url)
+        if "/discid/" in url:
+            body = json.dumps({"id": self.disc_id,
+                "releases": self.releases}).encode("utf-8")
+        elif url.endswith("/front-500"):
+            body = b"JPEG"
+        else:
+            raise urllib.error.HTTPError(url, 404, None, None, None)
+        return io.BytesIO(body)
+
+    def __enter__(self):
+        self._saved_urlopen = urllib.request.urlopen
+        urllib.request.urlopen = self.mock_urlopen
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        urllib.request.urlopen = self._saved_urlopen
+
+
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers with the path, counting the connections made. /close
+    closes the connection after the reply"""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        CountingHandler.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        body = self.path.encode("ascii")
+        self.send_response(404 if self.path == "/missing" else 200)
+        self.send_header("Content-Length", str(len(body)))
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMusicbrainz(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_limiter = musz.rate_limiter
+        musz.rate_limiter = musz.RateLimiter(0)
+        musz._releases.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        musz.rate_limiter = self.saved_limiter
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trips(self):
+        """The discid lookup brings the tracks, the cover is one more and
+        is not held to the musicbrainz rate"""
+        info = mocks.make_disc()
+        waits = []
+        musz.rate_limiter.wait = lambda: waits.append(1)
+        with PatchServers(musz.musicbrainz_disc_id(info)) as servers:
+            self.assertTrue(musz.get_track_info(info))
+            cover_file = os.path.join(self.tmp_dir, "cover.jpg")
+            musz.get_coverart(info, cover_file)
+        self.assertEqual(len(servers.urls), 2)
+        self.assertEqual(len(waits), 1)
+        self.assertIn("inc=recordings+artist-credits", servers.urls[0])
+        self.assertTrue(servers.urls[1].endswith("/mbid-1/front-500"))
+        self.assertEqual(info.mbid, "mbid-1")
+        self.assertEqual(info.get_track(2).title, "Song 2")
+        self.assertEqual(info.get_track(2).artist, "Artist")
+        with open(cover_file, "rb") as in_fp:
+            self.assertEqual(in_fp.read(), b"JPEG")
+
+    def lookup(self, releases):
+        info = mocks.make_disc()
+        rank.set_interactive(True)
+        try:
+            with PatchServers(musz.musicbrainz_disc_id(info), releases):
+                with mocks.PatchInput([]):
+                    self.assertTrue(musz.get_track_info(info))
+        finally:
+            rank.set_interactive(None)
+        return info
+
+    def test_multi_disc(self):
+        """The medium whose track lengths match is taken"""
+        info = self.lookup([release("mbid-1", [medium(1, 200000, "One"),
+            medium(2, 100000, "Two")])])
+        self.assertEqual(info.get_track(1).title, "Two 1")
+
+    def test_status(self):
+        """An official release beats a bootleg without asking"""
+        info = self.lookup([release("mbid-1", status="Bootleg"),
+            release("mbid-2", [medium(1, 101000, "Other")])])
+        self.assertEqual(info.mbid, "mbid-2")
+
+    def test_duplicates(self):
+        """Releases giving the same tracks are no reason to ask, the
+        earliest is taken"""
+        info = self.lookup([release("mbid-1", date="2001", country="US"),
+            release("mbid-2", date="1999", country="GB")])
+        self.assertEqual(info.mbid, "mbid-2")
+
+    def test_keep_alive(self):
+        """Requests to one host share a connection, a new one is made
+        when the server closes it"""
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+            CountingHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        CountingHandler.connections = 0
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        musz.keep_alive()
+        try:
+            for path in ("/a", "/b", "/close", "/c"):
+                response = musz.open_url(url + path)
+                self.assertEqual(response.read(), path.encode("ascii"))
+            self.assertEqual(CountingHandler.connections, 2)
+            self.assertRaises(urllib.error.HTTPError, urllib.request.urlopen,
+                url + "/missing")
+            self.assertEqual(CountingHandler.connections, 2)
+        finally:
+            urllib.request.install_opener(None)
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import io
+import stat
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import ogg
+
+# Keeps the comments given with -c in the file itself, and lists them
+VORBISCOMMENT_STUB = """#!{}
+import sys
+args = sys.argv[1:]
+assert "-e" in args and "--raw" in args
+if "-w" in args:
+    with open(args[args.index("-c") + 1], "rb") as in_fp:
+        data = in_fp.read()
+    with open(args[-1], "wb") as out_fp:
+        out_fp.write(data)
+else:
+    with open(args[-1], "rb") as in_fp:
+        sys.stdout.buffer.write(in_fp.read())
+"""
+
+
+def make_stream(filename, serial, bodies):
+    """Write an Ogg file of one logical stream, a page per body"""
+    with open(filename, "wb") as out_fp:
+        for seq, body in enumerate(bodies):
+            flags = ogg.BOS if seq == 0 else 0
+            if seq == len(bodies) - 1:
+                flags |= ogg.EOS
+            lacing = bytes([255] * (len(body) // 255) + [len(body) % 255])
+            page = ogg.Page(flags, seq * 1000, serial, seq, lacing, body)
+            out_fp.write(page.pack())
+
+
+class TestOgg(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_crc(self):
+        """The check value of the Ogg CRC (CRC-32, unreflected, no xor)"""
+        self.assertEqual(ogg.ogg_crc(b"123456789"), 0x89A1897F)
+
+    def test_bad_crc(self):
+        filename = os.path.join(self.tmp_dir, "bad.ogg")
+        make_stream(filename, 7, [b"header", b"audio"])
+        with open(filename, "rb") as in_fp:
+            data = bytearray(in_fp.read())
+        data[-1] ^= 0xff
+        self.assertRaises(ValueError, list, ogg.read_pages(io.BytesIO(data)))
+
+    def test_chain(self):
+        """Each track becomes a link with its own serial, the pages are
+        otherwise unchanged"""
+        tracks = []
+        for num in range(1, 4):
+            filename = os.path.join(self.tmp_dir, "track{:02d}.ogg".format(num))
+            # oggenc picks serials at random so they may clash
+            make_stream(filename, 1234, [b"head", b"tags", b"x" * 600,
+                "track {}".format(num).encode("ascii")])
+            tracks.append(filename)
+        album = os.path.join(self.tmp_dir, "album.ogg")
+        ogg.chain(tracks, album)
+        with open(album, "rb") as in_fp:
+            pages = list(ogg.read_pages(in_fp))
+        self.assertEqual(len(pages), 12)
+        links = [pages[i:i + 4] for i in range(0, 12, 4)]
+        self.assertEqual(len(set([link[0].serial for link in links])), 3)
+        for num, link in enumerate(links, 1):
+            self.assertEqual([page.seq for page in link], [0, 1, 2, 3])
+            self.assertEqual(len(set([page.serial for page in link])), 1)
+            self.assertTrue(link[0].flags & ogg.BOS)
+            self.assertTrue(link[-1].flags & ogg.EOS)
+            self.assertEqual(link[2].body, b"x" * 600)
+            self.assertEqual(link[2].granule, 2000)
+            self.assertEqual(link[-1].body,
+                "track {}".format(num).encode("ascii"))
+
+    def test_comments(self):
+        """Values holding newlines and backslashes are kept whole"""
+        stub = os.path.join(self.tmp_dir, "vorbiscomment")
+        with open(stub, "w") as out_fp:
+            out_fp.write(VORBISCOMMENT_STUB.format(sys.executable))
+        os.chmod(stub, stat.S_IRWXU)
+        filename = os.path.join(self.tmp_dir, "track01.ogg")
+        comments = [("TITLE", "Song"), ("LYRICS", "One\nTwo\\n"),
+            ("ARTIST", "\u00c9")]
+        saved = ogg.VORBIS_COMMENT_EXE
+        ogg.VORBIS_COMMENT_EXE = stub
+        try:
+            ogg.write_comments(filename, comments)
+            self.assertEqual(ogg.read_comments(filename), comments)
+        finally:
+            ogg.VORBIS_COMMENT_EXE = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
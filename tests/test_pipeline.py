@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def touch(self, name, when):
+        with open(self.path(name), "w") as out_fp:
+            out_fp.write(name)
+        os.utime(self.path(name), (when, when))
+
+    def make_flow(self):
+        """disc.flac -> track.wav -> track.mp3, all made in order"""
+        flow = pipeline.Pipeline()
+        flow.add("wav", None, inputs=[self.path("disc.flac")],
+            outputs=[self.path("track.wav")])
+        flow.add("encode", None, inputs=[self.path("track.wav")],
+            outputs=[self.path("track.mp3")])
+        flow.add("tags", None, inputs=[self.path("track.mp3")],
+            outputs=[self.path("track.done")])
+        for when, name in enumerate(("disc.flac", "track.wav", "track.mp3",
+                "track.done")):
+            self.touch(name, 1000 + when)
+        return flow
+
+    def names(self, flow):
+        return [stage.name for stage in flow.needed()]
+
+    def test_up_to_date(self):
+        self.assertEqual(self.names(self.make_flow()), [])
+
+    def test_stale(self):
+        """A newer input makes everything after it run"""
+        flow = self.make_flow()
+        self.touch("disc.flac", 2000)
+        self.assertEqual(self.names(flow), ["wav", "encode", "tags"])
+        flow = self.make_flow()
+        self.touch("track.mp3", 2000)
+        self.assertEqual(self.names(flow), ["tags"])
+
+    def test_missing_intermediate(self):
+        """A deleted intermediate is not made again if nothing needs it"""
+        flow = self.make_flow()
+        os.unlink(self.path("track.wav"))
+        self.assertEqual(self.names(flow), [])
+
+    def test_deleted_final(self):
+        """A deleted final output is made again, and the intermediates it
+        needs that have gone too"""
+        flow = self.make_flow()
+        os.unlink(self.path("track.done"))
+        self.assertEqual(self.names(flow), ["tags"])
+        os.unlink(self.path("track.wav"))
+        self.assertEqual(self.names(flow), ["tags"])
+        os.unlink(self.path("track.mp3"))
+        self.assertEqual(self.names(flow), ["wav", "encode", "tags"])
+
+    def test_limits(self):
+        """No more stages than the limit use a resource at once"""
+        active = {pipeline.CPU: 0, pipeline.DRIVE: 0}
+        most = {pipeline.CPU: 0, pipeline.DRIVE: 0}
+
+        def make_action(resource):
+            async def action():
+                active[resource] += 1
+                most[resource] = max(most[resource], active[resource])
+                await asyncio.sleep(0.01)
+                active[resource] -= 1
+            return action
+
+        flow = pipeline.Pipeline(limits={pipeline.CPU: 2})
+        for num in range(6):
+            flow.add("encode{}".format(num), make_action(pipeline.CPU),
+                outputs=[self.path("track{}.mp3".format(num))],
+                resource=pipeline.CPU)
+        for num in range(3):
+            flow.add("read{}".format(num), make_action(pipeline.DRIVE),
+                outputs=[self.path("disc{}.wav".format(num))],
+                resource=pipeline.DRIVE)
+        flow.run()
+        self.assertEqual(most, {pipeline.CPU: 2, pipeline.DRIVE: 1})
+        self.assertEqual(len(flow.timings), 9)
+
+    def test_failing_stage(self):
+        """A failing stage fails the run, and the stages after it are not
+        started"""
+        progress = []
+        ran = []
+
+        def encode():
+            ran.append("encode")
+
+        flow = pipeline.Pipeline(progress=lambda name, state:
+            progress.append((name, state)))
+        flow.add("wav", lambda: False, outputs=[self.path("track.wav")])
+        flow.add("encode", encode, inputs=[self.path("track.wav")],
+            outputs=[self.path("track.mp3")])
+        self.assertRaises(RuntimeError, flow.run)
+        self.assertIn(("wav", "failed"), progress)
+        self.assertNotIn(("encode", "start"), progress)
+        self.assertEqual(ran, [])
+
+    def test_execute(self):
+        """The output is only renamed into place if the command worked"""
+        out_file = self.path("out.wav")
+        temp_file = self.path("temp.out.wav")
+        script = "open(r'{}', 'w').write('x'); raise SystemExit({})"
+        ok = asyncio.run(pipeline.execute([sys.executable, "-c",
+            script.format(temp_file, 1)], temp_file, out_file))
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(out_file))
+        self.assertFalse(os.path.exists(temp_file))
+        ok = asyncio.run(pipeline.execute([sys.executable, "-c",
+            script.format(temp_file, 0)], temp_file, out_file))
+        self.assertTrue(ok)
+        self.assertTrue(os.path.exists(out_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import argparse
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import disc_info
+from rip_lib import main as rip
+from rip_lib import plan
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_file = plan.CALIBRATION_FILE
+        plan.CALIBRATION_FILE = os.path.join(self.tmp_dir, "calibration")
+        self.album = os.path.join(self.tmp_dir, "album")
+        wip = rip.wip_dir(self.album)
+        os.makedirs(wip)
+        info = disc_info.DiscInfo()
+        for num in (1, 2):
+            track = info.add_track(num, 150 + (num - 1) * 7500)
+            track.add_toc_info(False, 7500)     # 100 seconds
+        rip.save_pickle(wip, info)
+        with open(os.path.join(wip, rip.FLACFILE), "wb") as out_fp:
+            out_fp.write(b"fLaC")
+        self.args = argparse.Namespace(only_convert=True, do48k=False,
+            ogg=True, mp3=True)
+
+    def tearDown(self):
+        plan.CALIBRATION_FILE = self.saved_file
+        shutil.rmtree(self.tmp_dir)
+
+    def test_defaults(self):
+        """Each track is decoded then encoded, nothing is written"""
+        before = sorted(os.listdir(rip.wip_dir(self.album)))
+        wall, cpu, written, peak = rip.plan_all(self.args, [self.album])
+        self.assertEqual(sorted(os.listdir(rip.wip_dir(self.album))), before)
+        wav, encode = plan.DEFAULTS["wav"], plan.DEFAULTS["encode"]
+        self.assertAlmostEqual(cpu, 2 * (100 / wav[0] + 100 / encode[0]))
+        self.assertEqual(written, 200 * (wav[1] + encode[1]))
+        # The WAV of a track is gone once encoded
+        self.assertLess(peak, written)
+        self.assertGreaterEqual(wall, cpu / os.cpu_count())
+
+    def test_calibrated(self):
+        """The speeds measured by earlier runs are used"""
+        calibration = plan.Calibration()
+        calibration.record("wav", 100.0, 1.0, 1000)
+        calibration.record(plan.stage_kind("encode3", "ogg-mp3"), 100.0,
+            10.0, 500)
+        calibration.save()
+        wall, cpu, written, peak = rip.plan_all(self.args, [self.album])
+        self.assertAlmostEqual(cpu, 22.0)
+        self.assertEqual(written, 3000)
+
+    def test_schedule(self):
+        """Stages wait for the stages they need and a free slot"""
+        class Stage:
+            def __init__(self, name, resource):
+                self.name = name
+                self.resource = resource
+        read = plan.StagePlan(Stage("read", "drive"), "read", 10.0, 0)
+        first = plan.StagePlan(Stage("a", "cpu"), "a", 5.0, 0)
+        second = plan.StagePlan(Stage("b", "cpu"), "b", 5.0, 0)
+        plans = [read, first, second]
+        plan.schedule(plans, {read: [], first: [read], second: [read]},
+            {"cpu": 1, "drive": 1})
+        self.assertEqual([x.start for x in plans], [0.0, 10.0, 15.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import pipeline
+from rip_lib import priority
+
+
+class FakeFlow(object):
+    """Records the limits a Throttle sets"""
+
+    def __init__(self, cpus):
+        self.limits = {pipeline.CPU: cpus}
+        self.calls = []
+
+    def set_limit(self, resource, limit):
+        self.limits[resource] = limit
+        self.calls.append((resource, limit))
+
+
+class PatchTools:
+    """Pretend only the given executables are installed, as root or not"""
+
+    def __init__(self, tools, root=False, quota=None):
+        self.tools = tools
+        self.root = root
+        self.quota = quota
+
+    def __enter__(self):
+        self._saved = priority.have, priority.privileged, \
+            priority._config["quota"]
+        priority.have = lambda exe: exe in self.tools
+        priority.privileged = lambda: self.root
+        priority._config["quota"] = self.quota
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        priority.have, priority.privileged, priority._config["quota"] = \
+            self._saved
+
+
+class TestPriority(unittest.TestCase):
+
+    def test_reader(self):
+        args = ["cdparanoia", "-d", "/dev/cdrom"]
+        with PatchTools(["cdparanoia", "chrt", "nice", "ionice"], root=True):
+            self.assertEqual(priority.reader(args), ["chrt", "-r", "10",
+                "ionice", "-c", "1", "-n", "4"] + args)
+        with PatchTools(["cdparanoia", "nice", "ionice"], root=True):
+            self.assertEqual(priority.reader(args), ["nice", "-n", "-10",
+                "ionice", "-c", "1", "-n", "4"] + args)
+        with PatchTools(["cdparanoia", "nice", "ionice"]):
+            self.assertEqual(priority.reader(args),
+                ["ionice", "-c", "2", "-n", "0"] + args)
+        with PatchTools(["cdparanoia"], root=True):
+            self.assertEqual(priority.reader(args), args)
+        with PatchTools(["nice", "ionice"], root=True):
+            self.assertEqual(priority.reader(args), args)
+
+    def test_encoder(self):
+        args = ["lame", "in.wav", "out.mp3"]
+        with PatchTools(["lame", "nice", "ionice"]):
+            self.assertEqual(priority.encoder(args), ["nice", "-n", "19",
+                "ionice", "-c", "3"] + args)
+        with PatchTools(["lame", "nice"], quota=150):
+            self.assertEqual(priority.encoder(args), ["systemd-run", "--user",
+                "--scope", "--quiet", "--slice=" + priority.ENCODE_SLICE,
+                "nice", "-n", "19"] + args)
+        with PatchTools(["nice", "ionice"]):
+            self.assertEqual(priority.encoder(args), args)
+
+    def test_throttle(self):
+        """A slow chunk sheds an encoder, each chunk back near the best
+        rate gives one back"""
+        flow = FakeFlow(3)
+        throttle = priority.Throttle(flow, pipeline.CPU)
+        throttle(1000, 1.0)
+        throttle(1000, 1.1)
+        self.assertEqual(flow.calls, [])
+        throttle(1000, 2.0)
+        throttle(1000, 2.0)
+        throttle(1000, 2.0)
+        self.assertEqual(flow.calls, [(pipeline.CPU, 2), (pipeline.CPU, 1)])
+        self.assertEqual(flow.limits[pipeline.CPU], 1)
+        throttle(1000, 1.0)
+        throttle(1000, 1.0)
+        throttle(1000, 1.0)
+        self.assertEqual(flow.calls[2:], [(pipeline.CPU, 2),
+            (pipeline.CPU, 3)])
+        self.assertEqual(throttle.limit, 3)
+        throttle(1000, 0)
+        self.assertEqual(len(flow.calls), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+import urllib.request
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import disc_info
+from rip_lib import id3
+from rip_lib import main as rip
+from rip_lib import musicbrainz as musz
+from rip_lib import ogg
+from rip_lib import retag
+
+AUDIO = b"\xff\xfb\x90\x00mp3 frames" * 100
+
+
+def release(mbid, titles):
+    credit = [{"artist": {"name": "Artist"}}]
+    return {
+        "id": mbid,
+        "title": "Album",
+        "status": "Official",
+        "artist-credit": credit,
+        "media": [{
+            "position": 1,
+            "track-count": len(titles),
+            "tracks": [{"number": str(num), "title": title,
+                "length": 100000, "artist-credit": credit}
+                for num, title in enumerate(titles, 1)]
+        }]
+    }
+
+
+class PatchServers:
+    """Answer the release lookups of musicbrainz from releases"""
+
+    def __init__(self, releases):
+        self.releases = dict([(x["id"], x) for x in releases])
+        self.urls = []
+
+    def mock_urlopen(self, req):
+        url = req.full_url if hasattr(req, "full_url") else req
+        self.urls.append(url)
+        for mbid, obj in self.releases.items():
+            if "/release/{}/".format(mbid) in url:
+                return io.BytesIO(json.dumps(obj).encode("utf-8"))
+        raise urllib.error.HTTPError(url, 404, None, None, None)
+
+    def __enter__(self):
+        self._saved_urlopen = urllib.request.urlopen
+        urllib.request.urlopen = self.mock_urlopen
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        urllib.request.urlopen = self._saved_urlopen
+
+
+class PatchComments:
+    """Keep the OGG comments in memory rather than running vorbiscomment,
+    recording the files written"""
+
+    def __init__(self):
+        self.comments = {}
+        self.written = []
+
+    def read_comments(self, ogg_file):
+        return list(self.comments[ogg_file])
+
+    def write_comments(self, ogg_file, comments):
+        self.comments[ogg_file] = list(comments)
+        self.written.append(os.path.basename(ogg_file))
+
+    def __enter__(self):
+        self._saved = ogg.read_comments, ogg.write_comments
+        ogg.read_comments = self.read_comments
+        ogg.write_comments = self.write_comments
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        ogg.read_comments, ogg.write_comments = self._saved
+
+
+class TestRetag(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_limiter = musz.rate_limiter
+        musz.rate_limiter = musz.RateLimiter(0)
+        musz._releases.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        musz.rate_limiter = self.saved_limiter
+        shutil.rmtree(self.tmp_dir)
+
+    def make_album(self, name, mbid, titles, patch):
+        """An album tagged with titles, in OGG and MP3"""
+        album_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(album_dir)
+        info = disc_info.DiscInfo()
+        info.title = "Album"
+        info.set_artist("Artist")
+        info.mbid = mbid
+        for num, title in enumerate(titles, 1):
+            track = info.add_track(num, 150 + (num - 1) * 7500)
+            track.add_toc_info(False, 7500)     # 100 seconds
+            track.title = title
+            track.artist = "Artist"
+        rip.save_pickle(album_dir, info)
+        for num in range(1, len(titles) + 1):
+            wanted = retag.wanted_tags(info, num)
+            patch.comments[rip.ogg_filename(album_dir, num)] = \
+                [("ENCODER", "test")] + [(retag.OGG_NAMES[key], value)
+                for key, value in sorted(wanted.items())]
+            with open(rip.ogg_filename(album_dir, num), "wb") as out_fp:
+                out_fp.write(b"OggS")
+            mp3 = rip.mp3_filename(album_dir, num)
+            with open(mp3, "wb") as out_fp:
+                out_fp.write(AUDIO)
+            id3.update_frames(mp3, [id3.text_frame(retag.MP3_NAMES[key],
+                value) for key, value in sorted(wanted.items())])
+        return album_dir
+
+    def test_retag(self):
+        """Only the tracks whose metadata changed are rewritten, and an
+        album that has not changed is left alone"""
+        with PatchComments() as patch:
+            changed = self.make_album("changed", "mbid-1",
+                ["Song 1", "Typo 2"], patch)
+            same = self.make_album("same", "mbid-2", ["Song 1", "Song 2"],
+                patch)
+            same_mp3 = rip.mp3_filename(same, 1)
+            same_times = [os.path.getmtime(os.path.join(same, x))
+                for x in ("pickle.info", "track01.mp3", "track02.mp3")]
+            with PatchServers([release("mbid-1", ["Song 1", "Song 2"]),
+                    release("mbid-2", ["Song 1", "Song 2"])]) as servers:
+                retag.retag_library([changed, same])
+        self.assertEqual(len(servers.urls), 2)
+        self.assertEqual(patch.written, ["track02.ogg"])
+        comments = patch.comments[rip.ogg_filename(changed, 2)]
+        self.assertIn(("TITLE", "Song 2"), comments)
+        self.assertIn(("ENCODER", "test"), comments)
+        self.assertEqual(len([x for x in comments if x[0] == "TITLE"]), 1)
+        tags = id3.read_tags(rip.mp3_filename(changed, 2))
+        self.assertEqual(tags["TIT2"], "Song 2")
+        self.assertEqual(tags["TRCK"], "2")
+        self.assertEqual(rip.load_pickle(changed).get_track(2).title,
+            "Song 2")
+        self.assertEqual([os.path.getmtime(os.path.join(same, x))
+            for x in ("pickle.info", "track01.mp3", "track02.mp3")],
+            same_times)
+        self.assertEqual(id3.read_tags(same_mp3)["TIT2"], "Song 1")
+
+
+if __name__ == '__main__':
+    unittest.main()
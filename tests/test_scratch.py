@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import scratch
+
+
+class TestScratch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.tmp_dir, "album")
+        self.volume = os.path.join(self.tmp_dir, "fast")
+        os.mkdir(self.work_dir)
+        os.mkdir(self.volume)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, filename, size):
+        with open(filename, "wb") as out_fp:
+            out_fp.write(b"\0" * size)
+
+    def test_volume(self):
+        space = scratch.Scratch(self.work_dir, 1000, self.volume)
+        self.assertTrue(space.separate)
+        self.assertEqual(os.path.dirname(space.root), self.volume)
+        space.close()
+        self.assertFalse(os.path.exists(space.root))
+        missing = os.path.join(self.tmp_dir, "missing")
+        space = scratch.Scratch(self.work_dir, 1000, missing)
+        self.assertEqual(space.root, self.work_dir)
+        self.assertFalse(space.separate)
+
+    def test_reserve(self):
+        space = scratch.Scratch(self.work_dir, 1000, self.volume)
+        wav = space.path("disc.wav")
+        space.add(wav, 600)
+
+        async def run():
+            await space.reserve(wav)
+            self.assertEqual(space.used, 600)
+            self.write(wav, 400)
+            space.written(wav)
+            self.assertEqual(space.used, 400)
+            space.evict(wav)
+
+        asyncio.run(run())
+        self.assertEqual(space.used, 0)
+        self.assertFalse(os.path.exists(wav))
+
+    def test_consumed(self):
+        """The file goes once the last job needing it is done"""
+        space = scratch.Scratch(self.work_dir, 1000, self.volume)
+        wav = space.path("track1.wav")
+        space.add(wav, 100)
+        space.need(wav, 2)
+        self.write(wav, 100)
+        space.existing(wav)
+        self.assertEqual(space.used, 100)
+        space.consumed(wav)
+        self.assertTrue(os.path.exists(wav))
+        space.consumed(wav)
+        self.assertFalse(os.path.exists(wav))
+        self.assertEqual(space.used, 0)
+
+    def test_close(self):
+        """Files still needed by a later run are kept"""
+        space = scratch.Scratch(self.work_dir, 1000, self.volume)
+        needed = space.path("track1.wav")
+        done = space.path("track2.wav")
+        for filename in (needed, done):
+            space.add(filename, 100)
+            self.write(filename, 100)
+            space.existing(filename)
+        space.need(needed)
+        space.close()
+        self.assertTrue(os.path.exists(needed))
+        self.assertFalse(os.path.exists(done))
+        self.assertTrue(os.path.isdir(space.root))
+
+    def test_budget_wait(self):
+        """A producer waits until an eviction makes room in the budget,
+        consumers are let over it"""
+        space = scratch.Scratch(self.work_dir, 1000, self.volume)
+        first = space.path("track1.wav")
+        second = space.path("track2.wav")
+        third = space.path("track3.wav")
+        for filename in (first, second, third):
+            space.add(filename, 600)
+        order = []
+
+        async def producer():
+            await space.reserve(second)
+            order.append("reserved")
+
+        async def run():
+            await space.reserve(first)
+            await space.reserve(third, fresh=False)
+            self.assertEqual(space.used, 1200)
+            space.evict(third)
+            task = asyncio.ensure_future(producer())
+            await asyncio.sleep(0.1)
+            self.assertEqual(order, [])
+            order.append("evict")
+            space.evict(first)
+            await asyncio.wait_for(task, 1)
+
+        saved = scratch.POLL_SECS
+        scratch.POLL_SECS = 30
+        try:
+            asyncio.run(run())
+        finally:
+            scratch.POLL_SECS = saved
+        self.assertEqual(order, ["evict", "reserved"])
+        self.assertEqual(space.used, 600)
+
+
+if __name__ == '__main__':
+    unittest.main()
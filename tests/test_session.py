@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import argparse
+import tempfile
+import unittest
+
+import mocks
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import main as rip
+from rip_lib import pipeline
+from rip_lib import session
+
+
+class FakeScratch(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class PatchDrive:
+    """A drive the discs are put in one after another, and stages that
+    write their outputs without any tools. The disc titled "lookup" fails
+    before it is read and the one titled "read" fails reading"""
+
+    def __init__(self, titles):
+        self.discs = [mocks.make_disc([1000], x) for x in titles]
+        self.ejects = 0
+        self.finished = []
+        self.scratches = []
+
+    def wait_for_disc(self, device, last=None, idle_secs=None):
+        return self.discs.pop(0) if self.discs else None
+
+    def eject(self, device):
+        self.ejects += 1
+
+    def lookup_disc(self, args, tmp_dir, info):
+        if info.title == "lookup":
+            raise RuntimeError("No metadata")
+        return True
+
+    def make_scratch(self, args, tmp_dir, info):
+        self.scratches.append(FakeScratch())
+        return self.scratches[-1]
+
+    def build_pipeline(self, args, tmp_dir, info, do48k, do_ogg, do_mp3,
+        scratch_space
+    ):
+        wav_file = os.path.join(tmp_dir, "disc.wav")
+        mp3_file = os.path.join(tmp_dir, "track.mp3")
+
+        def write(filename):
+            if info.title == "read" and filename == wav_file:
+                raise RuntimeError("Read error")
+            with open(filename, "w") as out_fp:
+                out_fp.write(info.title)
+
+        flow = pipeline.Pipeline(limiters=args.limiters)
+        flow.add("read", lambda: write(wav_file), outputs=[wav_file],
+            resource=pipeline.DRIVE)
+        flow.add("encode", lambda: write(mp3_file), inputs=[wav_file],
+            outputs=[mp3_file], resource=pipeline.CPU)
+        return flow
+
+    def finish(self, args, tmp_dir, info, do_ogg, do_mp3):
+        self.finished.append(info.title)
+        if args.answers.get("rename"):
+            rip.rename_tmp_dir(tmp_dir, info, args)
+
+    def __enter__(self):
+        self._saved = (session.wait_for_disc, session.eject, rip.lookup_disc,
+            rip.make_scratch, rip.build_pipeline, rip.finish)
+        session.wait_for_disc = self.wait_for_disc
+        session.eject = self.eject
+        rip.lookup_disc = self.lookup_disc
+        rip.make_scratch = self.make_scratch
+        rip.build_pipeline = self.build_pipeline
+        rip.finish = self.finish
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        (session.wait_for_disc, session.eject, rip.lookup_disc,
+            rip.make_scratch, rip.build_pipeline, rip.finish) = self._saved
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failing_disc(self):
+        """A disc that fails is ejected and the session goes on to the
+        next disc"""
+        args = argparse.Namespace(answers={"48k": False, "ogg": False,
+            "mp3": True})
+        with PatchDrive(["lookup", "read", "good"]) as drive:
+            session.Session(args, self.tmp_dir).run()
+        self.assertEqual(drive.ejects, 3)
+        self.assertEqual(drive.finished, ["good"])
+        self.assertTrue(all([x.closed for x in drive.scratches]))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir,
+            "tmp_rip03", "track.mp3")))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir,
+            "tmp_rip02", "track.mp3")))
+
+    def test_box_set(self):
+        """The discs of a box set are each renamed after the album and
+        their number, and a second copy of a disc does not replace the
+        first"""
+        args = argparse.Namespace(answers={"48k": False, "ogg": False,
+            "mp3": True, "rename": True})
+        with PatchDrive(["Box", "Box", "Box"]) as drive:
+            for number, info in zip((1, 2, 2), drive.discs):
+                info.disc_number = number
+                info.disc_count = 2
+            session.Session(args, self.tmp_dir).run()
+        self.assertEqual(drive.finished, ["Box"] * 3)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+            ["Box_disc_1", "Box_disc_2", "Box_disc_2_2"])
+        for name in os.listdir(self.tmp_dir):
+            self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, name,
+                "track.mp3")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import sync
+
+AUDIO = bytes(range(256)) * 4096     # 16 blocks
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.library = os.path.join(self.tmp_dir, "library")
+        self.target = os.path.join(self.tmp_dir, "player")
+        self.album = self.make_album("Album")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_album(self, name):
+        album_dir = os.path.join(self.library, name)
+        os.makedirs(album_dir)
+        for other in ("pickle.info", "disc.flac", "disc.cue"):
+            with open(os.path.join(album_dir, other), "wb") as out_fp:
+                out_fp.write(b"x")
+        for num in (1, 2):
+            self.write(os.path.join(album_dir, "track{:02d}.mp3".format(num)),
+                bytes([num]) + AUDIO)
+        return album_dir
+
+    def write(self, filename, data):
+        with open(filename, "wb") as out_fp:
+            out_fp.write(data)
+
+    def read(self, rel_path):
+        with open(os.path.join(self.target, rel_path), "rb") as in_fp:
+            return in_fp.read()
+
+    def test_sync(self):
+        size = len(AUDIO) + 1
+        self.assertEqual(sync.sync_library(self.library, self.target),
+            (2, 2 * size))
+        self.assertEqual(self.read("Album/track01.mp3"), b"\x01" + AUDIO)
+        self.assertFalse(os.path.exists(os.path.join(self.target, "Album",
+            "disc.flac")))
+        # Nothing changed
+        self.assertEqual(sync.sync_library(self.library, self.target),
+            (0, 0))
+        # A retag writes only the block holding the tag
+        self.write(os.path.join(self.album, "track02.mp3"), b"\x03" + AUDIO)
+        self.assertEqual(sync.sync_library(self.library, self.target),
+            (1, sync.BLOCK_SIZE))
+        self.assertEqual(self.read("Album/track02.mp3"), b"\x03" + AUDIO)
+
+    def test_rename_delete(self):
+        """Renames and deletions copy nothing"""
+        sync.sync_library(self.library, self.target)
+        os.rename(self.album, os.path.join(self.library, "Renamed"))
+        os.unlink(os.path.join(self.library, "Renamed", "track01.mp3"))
+        self.assertEqual(sync.sync_library(self.library, self.target),
+            (0, 0))
+        self.assertEqual(sorted(os.listdir(self.target)),
+            [sync.MANIFEST, "Renamed"])
+        self.assertEqual(os.listdir(os.path.join(self.target, "Renamed")),
+            ["track02.mp3"])
+        self.assertEqual(self.read("Renamed/track02.mp3"), b"\x02" + AUDIO)
+
+    def test_identical(self):
+        """Identical files gone at once are each renamed"""
+        copy_dir = self.make_album("Copy")
+        sync.sync_library(self.library, self.target)
+        os.rename(self.album, os.path.join(self.library, "Album 2"))
+        os.rename(copy_dir, os.path.join(self.library, "Copy 2"))
+        self.assertEqual(sync.sync_library(self.library, self.target),
+            (0, 0))
+        self.assertEqual(sorted(os.listdir(self.target)),
+            [sync.MANIFEST, "Album 2", "Copy 2"])
+        self.assertEqual(self.read("Copy 2/track01.mp3"), b"\x01" + AUDIO)
+
+
+if __name__ == '__main__':
+    unittest.main()
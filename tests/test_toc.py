@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import disc_info
+from rip_lib import musicbrainz as musz
+from rip_lib import toc
+
+DEVICE = "/dev/test-cd"
+ENTRIES = [(1, 150, 0), (2, 15150, toc.CTRL_PRE_EMPHASIS),
+    (3, 30150, toc.CTRL_DATA)]
+LEADOUT = 60150
+
+
+class PatchDrive:
+    """A drive that answers the TOC ioctls, counting the reads"""
+
+    def __init__(self):
+        self.key = 1
+        self.reads = 0
+
+    def read_entries(self, device):
+        self.reads += 1
+        return ENTRIES, LEADOUT
+
+    def media_key(self, device):
+        return self.key
+
+    def __enter__(self):
+        self._saved = toc.read_entries, toc.media_key
+        toc.read_entries = self.read_entries
+        toc.media_key = self.media_key
+        toc.forget()
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        toc.read_entries, toc.media_key = self._saved
+        toc.forget()
+
+
+class TestToc(unittest.TestCase):
+
+    def test_ioctl(self):
+        """The data track of an enhanced CD is left out like cdparanoia
+        does, with the gap before the data session"""
+        with PatchDrive():
+            info = disc_info.DiscInfo()
+            self.assertTrue(info.read_disk(DEVICE))
+        self.assertEqual(info.num_tracks, 2)
+        self.assertEqual(info.lead_in, 150)
+        self.assertEqual([track.length for track in info.tracks],
+            [15000, 15000 - toc.SESSION_GAP])
+        self.assertEqual(info.calc_disc_len(), 30150 - toc.SESSION_GAP)
+        self.assertFalse(info.get_track(1).pre_emphasis)
+        self.assertTrue(info.get_track(2).pre_emphasis)
+        self.assertIs(info.get_track(2).disc, info)
+        self.assertTrue(musz.musicbrainz_disc_id(info))
+
+    def test_cached(self):
+        """The drive is read once per disc"""
+        with PatchDrive() as drive:
+            first = disc_info.DiscInfo()
+            first.read_disk(DEVICE)
+            first.get_track(1).title = "Changed"
+            second = disc_info.DiscInfo()
+            second.read_disk(DEVICE)
+            self.assertEqual(drive.reads, 1)
+            self.assertEqual(second.get_track(1).title, "unknown")
+            drive.key = 2
+            disc_info.DiscInfo().read_disk(DEVICE)
+            self.assertEqual(drive.reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+##
+# Copyright (c) 2013 Peter Leese
+#
+# Licensed under the GPL License. See LICENSE file in the project root for full license information.
+##
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, lib_path)
+
+from rip_lib import disc_info
+from rip_lib import main as rip
+from rip_lib import verify
+
+# Fails any file holding BAD
+CHECKER = [sys.executable, "-c",
+    "import sys; sys.exit(b'BAD' in sys.stdin.buffer.read())"]
+
+
+class PatchCheckers:
+    """Check every format with CHECKER, recording the files checked"""
+
+    def __init__(self):
+        self.checked = []
+
+    def check_file(self, filename, bucket=None):
+        self.checked.append(os.path.basename(filename))
+        return self._saved[1](filename, bucket)
+
+    def __enter__(self):
+        self._saved = dict(verify.CHECKERS), verify.check_file
+        for ext in verify.CHECKERS:
+            verify.CHECKERS[ext] = CHECKER
+        verify.check_file = self.check_file
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        verify.CHECKERS.update(self._saved[0])
+        verify.check_file = self._saved[1]
+
+
+class FakeClock(object):
+    """Stands in for the time module, sleeping moves the clock on"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tmp_dir, "Album")
+        os.mkdir(self.album)
+        info = disc_info.DiscInfo()
+        track = info.add_track(1, 150)
+        track.add_toc_info(False, 1000)
+        rip.save_pickle(self.album, info)
+        self.write("disc.cue", b"cue")
+        self.write("disc.flac", b"flac")
+        self.write("track01.mp3", b"mp3")
+        self.write("temp.track02.mp3", b"BAD")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.album, name), "wb") as out_fp:
+            out_fp.write(data)
+
+    def test_cache(self):
+        """Only new or changed files are checked again, and bad files
+        stay bad"""
+        with PatchCheckers() as patch:
+            self.assertEqual(verify.verify_library(self.tmp_dir), [])
+            self.assertEqual(sorted(patch.checked),
+                ["disc.flac", "track01.mp3"])
+            self.write("track02.ogg", b"BAD ogg")
+            patch.checked = []
+            bad = [os.path.join(self.album, "track02.ogg")]
+            self.assertEqual(verify.verify_library(self.tmp_dir), bad)
+            self.assertEqual(patch.checked, ["track02.ogg"])
+            patch.checked = []
+            self.assertEqual(verify.verify_library(self.tmp_dir), bad)
+            self.assertEqual(patch.checked, [])
+            self.write("track02.ogg", b"ogg")
+            self.assertEqual(verify.verify_library(self.tmp_dir), [])
+            self.assertEqual(patch.checked, ["track02.ogg"])
+            os.unlink(os.path.join(self.album, "track02.ogg"))
+            patch.checked = []
+            self.assertEqual(verify.verify_library(self.tmp_dir), [])
+            self.assertEqual(patch.checked, [])
+
+    def test_no_checker(self):
+        """A missing checker is not taken as a bad file, nor cached"""
+        with PatchCheckers() as patch:
+            verify.CHECKERS[".mp3"] = ["no-such-checker"]
+            self.assertEqual(verify.verify_library(self.tmp_dir), [])
+            verify.CHECKERS[".mp3"] = CHECKER
+            patch.checked = []
+            self.assertEqual(verify.verify_library(self.tmp_dir), [])
+            self.assertEqual(patch.checked, ["track01.mp3"])
+
+    def test_file_key(self):
+        filename = os.path.join(self.album, "track01.mp3")
+        key = verify.file_key(filename)
+        self.assertEqual(verify.file_key(filename), key)
+        os.utime(filename, (1000, 1000))
+        moved = verify.file_key(filename)
+        self.assertNotEqual(moved, key)
+        self.write("track01.mp3", b"mp3 longer")
+        os.utime(filename, (1000, 1000))
+        self.assertNotEqual(verify.file_key(filename), moved)
+
+    def test_token_bucket(self):
+        """A burst is let through, then reads wait for the rate"""
+        clock = FakeClock()
+        saved = verify.time
+        verify.time = clock
+        try:
+            bucket = verify.TokenBucket(1000, burst=2000)
+            bucket.take(2000)
+            self.assertEqual(clock.slept, [])
+            bucket.take(500)
+            self.assertEqual(clock.slept, [0.5])
+            clock.now += 2.0
+            bucket.take(1000)
+            self.assertEqual(clock.slept, [0.5])
+        finally:
+            verify.time = saved
+
+
+if __name__ == '__main__':
+    unittest.main()